@@ -0,0 +1,68 @@
+# Python approximations of the analyzers in settings.json, used by the
+# backends that search without elasticsearch (replica.py, fake_es.py, db_sqlite.py)
+
+import re
+import unicodedata
+
+
+MIN_GRAM, MAX_GRAM = 3, 32
+
+
+def fold(text):
+  "Lowercase and asciifolding"
+  text = unicodedata.normalize('NFKD', text)
+  return ''.join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def analyze(text):
+  "Approximates the ascii_fold analyzer"
+  return re.findall(r'\w+', fold(text.replace('_', '-')))
+
+
+def edge_ngrams(text):
+  "Approximates the edge_ngram_3_16 analyzer"
+  return [
+    token[:n]
+    for token in analyze(text)
+    for n in range(MIN_GRAM, min(len(token), MAX_GRAM) + 1)
+  ]
+
+
+def text_trigrams(text):
+  "Approximates the trigram analyzer"
+  return {
+    word[i:i + 3]
+    for word in fold(text).split()
+    for i in range(len(word) - 2)
+  }
+
+
+ANALYZERS = {
+  'ascii_fold': analyze,
+  'edge_ngram_3_16': edge_ngrams,
+  'trigram': lambda text: sorted(text_trigrams(text)),
+  'standard': lambda text: re.findall(r'\w+', text.lower()),
+}
+
+
+def fuzziness(token):
+  "Max edit distance for fuzziness='AUTO:4,6'"
+  return 0 if len(token) < 4 else 1 if len(token) < 6 else 2
+
+
+def edit_distance(a, b, limit):
+  "Optimal string alignment distance, returns limit + 1 if it's larger than limit"
+  if abs(len(a) - len(b)) > limit:
+    return limit + 1
+  prev_prev, prev = None, list(range(len(b) + 1))
+  for i, ca in enumerate(a, 1):
+    cur = [i] + [0] * len(b)
+    for j, cb in enumerate(b, 1):
+      cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb))
+      if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+        cur[j] = min(cur[j], prev_prev[j - 2] + 1)
+    if min(cur) > limit:
+      return limit + 1
+    prev_prev, prev = prev, cur
+  return prev[-1]
+
@@ -7,12 +7,10 @@ from telethon import TelegramClient
 
 import proxy_globals
 import db
+from constants import PLUGINS
 
-client = TelegramClient('bot', 6, 'eb06d4abfb49dc3eeb1aeb98ae0f581e')
-mimetypes.add_type('application/x-tgsticker', '.tgs')
 
-
-async def main():
+async def main(client: TelegramClient):
   await db.init()
   # TODO: token from secrets
   await client.start()
@@ -20,10 +18,7 @@ async def main():
   proxy_globals.client = client
   proxy_globals.me = await client.get_me()
   load_callbacks = []
-  for module_name in [
-    'p_conv_grab', 'p_cached', 'p_help', 'p_media_mode',
-    'p_stats', 'p_tagging', 'p_search', 'p_mode_add'
-  ]:
+  for module_name in PLUGINS:
     proxy_globals.logger = logging.getLogger(module_name)
     module = importlib.import_module(module_name)
     init = getattr(module, 'on_done_loading', None)
@@ -36,4 +31,8 @@ async def main():
   await client.run_until_disconnected()
 
 
-client.loop.run_until_complete(main())
\ No newline at end of file
+# offload's worker processes import this module without running the bot
+if __name__ == '__main__':
+  mimetypes.add_type('application/x-tgsticker', '.tgs')
+  client = TelegramClient('bot', 6, 'eb06d4abfb49dc3eeb1aeb98ae0f581e')
+  client.loop.run_until_complete(main(client))
\ No newline at end of file
@@ -5,10 +5,83 @@ MAX_MEDIA_PER_USER = 1000
 
 # Telegram limitations
 MAX_RESULTS_PER_PAGE = 50
+MAX_MESSAGE_LENGTH = 4096
+# seconds an inline search can take before earlier results are shown instead
+INLINE_SEARCH_DEADLINE = 2
+# number of inline results pages kept for that
+INLINE_RESULTS_CACHE_SIZE = 4096
+# number of rendered inline results that are kept (see p_search.render_result)
+RENDERED_RESULTS_CACHE_SIZE = 16384
+# seconds a prefetched next page of inline results is kept for scrolling
+INLINE_PREFETCH_TTL = 60
+INLINE_PREFETCH_MAX_USERS = 4096
+# users whose recently used media are kept in memory (see recents.py)
+RECENTS_MAX_USERS = 256
+
+# outgoing messages (see outbox.py)
+# messages per second and burst size for each chat and for the whole bot
+OUTBOX_CHAT_RATE = 1
+OUTBOX_CHAT_BURST = 3
+OUTBOX_GLOBAL_RATE = 25
+OUTBOX_GLOBAL_BURST = 30
+# seconds a message can be edited by the next one with the same key
+OUTBOX_COALESCE_TIME = 60
+# idle chats are forgotten when more than this many are tracked
+OUTBOX_MAX_CHATS = 4096
+
+# cpu-bound work that is moved out of the event loop (see offload.py)
+OFFLOAD_THREADS = 4
+OFFLOAD_PROCESSES = 2
+# smallest inputs that are worth moving, in documents or stickers and in bytes
+OFFLOAD_MIN_ITEMS = 100
+OFFLOAD_MIN_BYTES = 64 * 2**10
+
+# loaded by bot.py in this order (and by scripts/loadgen.py)
+PLUGINS = [
+  'p_conv_grab', 'p_cached', 'p_help', 'p_media_mode',
+  'p_stats', 'p_tagging', 'p_search', 'p_mode_add', 'p_slowlog', 'p_profile'
+]
 
 # db
+# 'elasticsearch', 'sqlite' for small deployments (see db_sqlite.py)
+# or 'fake' for an in-memory stand-in for elasticsearch (see fake_es.py)
+DB_BACKEND = 'elasticsearch'
+SQLITE_PATH = 'tagbot.sqlite3'
+# requests to elasticsearch that can be in flight at once (see scheduler.py)
+ES_MAX_CONCURRENCY = 16
+# stale inline searches are dropped when more requests than this are waiting
+ES_SHED_QUEUE_DEPTH = 64
+# seconds between progress checks of background tasks like /purge
+TASK_POLL_INTERVAL = 2
+# seconds recent writes are merged into search results, has to be longer than
+# the refresh_interval in settings.json (see db.get_overlay)
+WRITE_OVERLAY_TTL = 15
+WRITE_OVERLAY_MAX_USERS = 4096
+# seconds the fake waits before answering each request
+FAKE_ES_LATENCY = 0
 ELASTIC_USERNAME = 'tagbot'
+# keep the collections of active users in memory and search them locally
+USE_REPLICA = False
+REPLICA_MAX_USERS = 256
+# seconds without a search until a user's replica is evicted
+REPLICA_IDLE_TIME = 60 * 30
+# slow query log (see slowlog.py)
+# seconds a db call can take before it's recorded
+SLOW_QUERY_TIME = 0.3
+# fraction of slow searches that are run again with profiling
+SLOW_QUERY_PROFILE_RATE = 0.1
+SLOWLOG_PATH = 'slowlog.jsonl'
+SLOWLOG_MAX_BYTES = 4 * 2**20
+SLOWLOG_BACKUPS = 3
+# profiles started with /profile (see profiler.py)
+PROFILE_DEFAULT_TIME = 30
+PROFILE_MAX_TIME = 600
+PROFILE_DIR = 'profiles'
+# functions listed in the summary sent in chat for each order
+PROFILE_TOP_N = 10
 class INDEX:
   main = 'tagbot'
   backup = 'tagbot_tmp'  # used for migrating when settings changes
-  transfer = 'tagbot_transfer'
\ No newline at end of file
+  transfer = 'tagbot_transfer'
+  # export selections, one document per user (see db.update_selection)
+  selection = 'tagbot_selection'
\ No newline at end of file
@@ -3,6 +3,7 @@ import struct
 from base64 import urlsafe_b64encode, urlsafe_b64decode
 import dataclasses
 from dataclasses import dataclass, field
+from typing import NamedTuple
 import time
 from boltons.setutils import IndexedSet
 
@@ -133,3 +134,29 @@ class TaggedDocument:
         val = list(val)
       d[field.name] = val
     return d
+
+
+class SearchHit(NamedTuple):
+  "Lightweight search result with only the fields needed for inline results"
+  id: int
+  access_hash: int
+  type: str
+  tags: list[str]
+  emoji: list[str]
+  title: str
+
+  # fields that are read from doc values, the rest come from _source
+  DOCVALUE_FIELDS = ['id', 'access_hash', 'type']
+  SOURCE_FIELDS = ['tags', 'emoji', 'title']
+
+  @classmethod
+  def from_hit(cls, hit):
+    fields, source = hit['fields'], hit.get('_source', {})
+    return cls(
+      int(fields['id'][0]),
+      int(fields['access_hash'][0]),
+      fields['type'][0],
+      source.get('tags', []),
+      source.get('emoji', []),
+      source.get('title', '')
+    )
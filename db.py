@@ -1,20 +1,31 @@
+import asyncio
 import functools
 import time
+import logging
+from collections import Counter, defaultdict
 from dataclasses import dataclass
 from typing import Callable
 from cachetools import TTLCache
 
-from elasticsearch import NotFoundError
+from elasticsearch import NotFoundError, RequestError
 from elasticsearch_dsl import Search
 
 import db_init
-from gen_search_query import gen_search_query
+import painless
+import slowlog
+import scheduler
+from scheduler import Priority, with_priority
+from gen_search_query import (
+  gen_search_query, plan_query, selection_filter, get_text_values, FALLBACK_PLANS, PLAN_SHAPES
+)
 from utils import acached
 from query_parser import ParsedQuery
-from data_model import TaggedDocument, DocumentID
+from data_model import TaggedDocument, DocumentID, SearchHit
 from constants import (
   MAX_MEDIA_PER_USER, MAX_EMOJI_PER_FILE, MAX_TAGS_PER_FILE, MAX_TAG_LENGTH,
-  MAX_RESULTS_PER_PAGE, INDEX
+  MAX_RESULTS_PER_PAGE, INDEX, USE_REPLICA, DB_BACKEND,
+  ES_MAX_CONCURRENCY, ES_SHED_QUEUE_DEPTH, INLINE_SEARCH_DEADLINE, TASK_POLL_INTERVAL,
+  WRITE_OVERLAY_TTL, WRITE_OVERLAY_MAX_USERS
 )
 
 
@@ -30,8 +41,175 @@ class CachedCounter:
   def set(self, value):
     self.offset = value - self.real
 
-es = db_init.es_main
+@dataclass
+class MediaWrite:
+  "Passed to write listeners after documents are changed"
+  owner: int
+  # None if an unknown set of the owner's documents was changed
+  id: int
+  index: str
+  # the new document, None if it was deleted or only some fields were changed
+  doc: TaggedDocument = None
+  created: bool = False
+  # the changed fields for partial updates
+  changes: dict = None
+
+  @property
+  def is_delete(self):
+    return self.doc is None and self.changes is None
+
+
+# inline searches that waited longer than their deadline were already answered
+request_scheduler = scheduler.RequestScheduler(
+  ES_MAX_CONCURRENCY, ES_SHED_QUEUE_DEPTH, shed_age=INLINE_SEARCH_DEADLINE
+)
+es = scheduler.ScheduledClient(db_init.es_main, request_scheduler)
 init = db_init.init
+logger = logging.getLogger('db')
+write_listeners: list[Callable[[MediaWrite], None]] = []
+# number of searches answered by each plan of gen_search_query
+plan_stats = Counter()
+# (index, owner) -> {id: (time of the write, document or None if it was deleted)}
+recent_writes = TTLCache(WRITE_OVERLAY_MAX_USERS, ttl=WRITE_OVERLAY_TTL)
+# kept up to date by writes, they expire so that any drift gets corrected
+# (index, owner) -> {type: ids}, see count_media_by_type
+type_ids = TTLCache(1024, ttl=60 * 10)
+# owner -> ids in the export selection
+selections = TTLCache(1024, ttl=60 * 10)
+
+
+def on_write(listener):
+  """Registers a function that is called with a MediaWrite after each write"""
+  write_listeners.append(listener)
+  return listener
+
+
+def notify_write(write: MediaWrite):
+  for listener in write_listeners:
+    try:
+      listener(write)
+    except Exception:
+      logger.exception(f'Unhandled exception in write listener {listener.__name__}')
+
+
+@on_write
+def record_write(write: MediaWrite):
+  """Keeps written documents until they are searchable, see get_overlay"""
+  if DB_BACKEND == 'sqlite' or write.id is None:
+    return
+  key = (write.index, write.owner)
+  writes = recent_writes.get(key, {})
+  if write.doc or write.is_delete:
+    writes[write.id] = (time.monotonic(), write.doc)
+  elif writes.get(write.id, (0, None))[1]:
+    writes[write.id] = (time.monotonic(), writes[write.id][1].merge(**write.changes))
+  else:
+    # only last_used changed, the order of recent results catches up after the refresh
+    return
+  recent_writes[key] = writes
+
+
+def get_overlay(owner: int, index: str) -> dict[int, TaggedDocument]:
+  """
+  Returns the documents of owner written since the last refresh of the index,
+  None for deleted ones, so that searches don't need refresh=True to see them
+  """
+  writes = recent_writes.get((index, owner))
+  if not writes:
+    return {}
+  expired = time.monotonic() - WRITE_OVERLAY_TTL
+  for id in [id for id, (written, _) in writes.items() if written < expired]:
+    del writes[id]
+  return {id: doc for id, (_, doc) in writes.items()}
+
+
+def without_overlay(q: Search, overlay: dict) -> Search:
+  """Excludes documents in the overlay, elasticsearch might still see an older version"""
+  return q.exclude('terms', id=[str(id) for id in overlay]) if overlay else q
+
+
+async def get_selection(owner: int) -> set[int]:
+  selection = selections.get(owner)
+  if selection is not None:
+    return selection
+  try:
+    r = await es.get(index=INDEX.selection, id=str(owner))
+    selection = {int(id) for id in r['_source']['ids']}
+  except NotFoundError:
+    selection = set()
+  selections[owner] = selection
+  return selection
+
+
+def sort_key(query: ParsedQuery, doc, last_used: int, shape='default'):
+  "Approximates the sort of gen_search_query, the score is estimated like in the replica"
+  score = replica.score_doc(doc, query, shape) if get_text_values(query) else 0
+  return -score, -last_used
+
+
+async def match_overlay(
+  owner: int, query: ParsedQuery, overlay: dict, plan: str = None
+) -> list[TaggedDocument]:
+  """Documents in the overlay that match query (with the shape of plan), sorted by sort_key"""
+  shape = PLAN_SHAPES[plan] if plan else 'default'
+  docs = [doc for doc in overlay.values() if doc and replica.match_doc(doc, query, shape)]
+  if not docs:
+    return []
+  for is_neg in (False, True):
+    if query.has('marked', is_neg):
+      selection = await get_selection(owner)
+      is_marked = (query.get_first('marked', is_neg) == 'yes') != is_neg
+      docs = [doc for doc in docs if (doc.id in selection) == is_marked]
+  docs.sort(key=lambda doc: sort_key(query, doc, doc.last_used, shape))
+  return docs
+
+
+@on_write
+def update_type_ids(write: MediaWrite):
+  if DB_BACKEND == 'sqlite':
+    return
+  key = (write.index, write.owner)
+  if write.id is None:
+    if write.changes is None or 'type' in write.changes:
+      type_ids.pop(key, None)
+    return
+  ids = type_ids.get(key)
+  if ids is None or not (write.doc or write.is_delete):
+    return
+  for same_type in ids.values():
+    same_type.discard(write.id)
+  if write.doc:
+    ids[write.doc.type.value].add(write.id)
+
+
+async def get_type_ids(owner: int, index: str) -> dict[str, set[int]]:
+  ids = type_ids.get((index, owner))
+  if ids is not None:
+    return ids
+  overlay = get_overlay(owner, index)
+  q = without_overlay(Search().filter('term', owner=owner), overlay).source(['id', 'type'])
+  r = await es.search(index=index, size=MAX_MEDIA_PER_USER, **q.to_dict())
+  ids = defaultdict(set)
+  for o in r['hits']['hits']:
+    ids[o['_source']['type']].add(o['_source']['id'])
+  for doc in overlay.values():
+    if doc:
+      ids[doc.type.value].add(doc.id)
+  type_ids[index, owner] = ids
+  return ids
+
+
+def type_counts(ids: dict[str, set[int]]):
+  """Counts in the shape of a filter aggregation with a terms aggregation on type"""
+  counts = Counter({type: len(same_type) for type, same_type in ids.items()})
+  return {
+    'doc_count': sum(counts.values()),
+    'types': {
+      'buckets': [
+        {'key': type, 'doc_count': count} for type, count in counts.most_common() if count
+      ]
+    },
+  }
 
 
 def resolve_index(func):
@@ -45,44 +223,145 @@ def resolve_index(func):
   return wrapper
 
 
+@slowlog.timed
 @resolve_index
 async def count_media_by_type(owner: int, only_marked=False, index: str = None):
-  q = Search()
-  aggs = q.aggs.bucket('user', 'filter', term={'owner': owner})
+  """
+  Returns the number of documents of each type, and of the selected ones with only_marked,
+  in the shape of the aggregation they used to come from
+  """
+  ids = await get_type_ids(owner, index)
+  r = type_counts(ids)
   if only_marked:
-    aggs = aggs.bucket('marked', 'filter', term={'marked': True})
-  aggs = aggs .bucket('types', 'terms', field='type')
-  r = await es.search(index=index, size=0, **q.to_dict())
-  return r['aggregations']['user']
+    selection = await get_selection(owner)
+    r['marked'] = type_counts({type: same_type & selection for type, same_type in ids.items()})
+  return r
 
 
-@acached(TTLCache(1024, ttl=60 * 10))
+@slowlog.timed
 @resolve_index
+# cached by the resolved index, so that every caller shares the same counter
+@acached(TTLCache(1024, ttl=60 * 10))
 async def count_media(owner: int, index: str):
   q = Search().filter('term', owner=owner)
   r = await es.count(index=index, body=q.to_dict())
   return CachedCounter(r['count'])
 
 
+# only keep what SearchHit needs from the response
+LEAN_FILTER_PATH = 'hits.total.value,hits.hits._source,hits.hits.fields,hits.hits.sort'
+
+
+@slowlog.timed
 async def search_media(
-  owner: int, query: ParsedQuery, page: int = 0
+  owner: int, query: ParsedQuery, page: int = 0, lean=False
 ):
-  q = gen_search_query(
-    owner, query, includes=['id', 'access_hash', 'type', 'tags', 'emoji', 'filename', 'title']
-  )
-
-  r = await es.search(
-    index=INDEX.transfer if query.has('show_transfer') else INDEX.main,
-    size=MAX_RESULTS_PER_PAGE,
-    from_=page * MAX_RESULTS_PER_PAGE,
-    **q.to_dict()
-  )
-  return (
-    r['hits']['total']['value'],
-    [TaggedDocument(**o['_source']) for o in r['hits']['hits']]
-  )
+  """
+  Returns the total number of hits and a page of results,
+  lean results are SearchHits instead of TaggedDocuments
+  """
+  # the replica doesn't know about export selections
+  uses_selection = query.has('marked') or query.has('marked', True)
+  if USE_REPLICA and not query.has('show_transfer') and not uses_selection:
+    return await replica.search_media(owner, query, page, lean)
+
+  plan = plan_query(query)
+  total, hits = await search_with_plan(owner, query, page, lean, plan)
+  # the fallback matches a superset, so it's only needed if the page
+  # isn't filled, later pages keep using the plan that filled the first one
+  if plan in FALLBACK_PLANS and total < MAX_RESULTS_PER_PAGE:
+    plan = FALLBACK_PLANS[plan]
+    total, hits = await search_with_plan(owner, query, page, lean, plan)
+  plan_stats[plan] += 1
+  return total, hits
+
+
+def overlay_positions(query: ParsedQuery, recent: list, hits: list, shape: str) -> list:
+  """
+  Returns (index of the hit it goes before, document) of each recent document, in order
+  The hits keep the order elasticsearch gave them. A recent document takes the score
+  elasticsearch gave the first hit that sort_key scores the same, and goes before the
+  first hit that doesn't sort above it. Without such a hit it's placed by sort_key.
+  """
+  es_keys = [tuple(-value for value in o['sort']) for o in hits]
+  hit_keys = [sort_key(query, o.get('_source', {}), o['sort'][-1], shape) for o in hits]
+  scored = get_text_values(query)
+  es_scores = {}
+  if scored:
+    for key, o in zip(hit_keys, hits):
+      es_scores.setdefault(key[0], o['sort'][0])
+  placed = []
+  for doc in recent:
+    key = sort_key(query, doc, doc.last_used, shape)
+    if not scored:
+      key, keys = (-doc.last_used,), es_keys
+    elif key[0] in es_scores:
+      key, keys = (-es_scores[key[0]], -doc.last_used), es_keys
+    else:
+      keys = hit_keys
+    # recent documents come first on ties
+    position = next((i for i, hit_key in enumerate(keys) if hit_key >= key), len(hits))
+    placed.append((position, doc))
+  placed.sort(key=lambda item: item[0])
+  return placed
+
+
+async def search_with_plan(owner: int, query: ParsedQuery, page: int, lean: bool, plan: str):
+  index = INDEX.transfer if query.has('show_transfer') else INDEX.main
+  # recently written documents are inserted into the results of elasticsearch,
+  # which needs all of them up to the end of the page, see overlay_positions
+  overlay = get_overlay(owner, index)
+  recent = await match_overlay(owner, query, overlay, plan)
+  start = page * MAX_RESULTS_PER_PAGE
+  kwargs = dict(index=index, size=MAX_RESULTS_PER_PAGE, from_=start)
+  if recent:
+    kwargs.update(size=start + MAX_RESULTS_PER_PAGE, from_=0)
+
+  if lean:
+    includes = SearchHit.SOURCE_FIELDS
+  else:
+    includes = ['id', 'access_hash', 'type', 'tags', 'emoji', 'filename', 'title']
+  if recent and get_text_values(query):
+    # for the score in sort_key
+    includes = list(dict.fromkeys(includes + replica.TEXT_FIELDS))
+  q = gen_search_query(owner, query, includes=includes, plan=plan)
+  q = without_overlay(q, overlay)
+  if lean:
+    q = q.extra(docvalue_fields=SearchHit.DOCVALUE_FIELDS)
+  slowlog.add_request(index, q.to_dict())
+  if lean:
+    r = await es.search(filter_path=LEAN_FILTER_PATH, **kwargs, **q.to_dict())
+    from_hit, from_doc = SearchHit.from_hit, replica.doc_to_hit
+  else:
+    r = await es.search(**kwargs, **q.to_dict())
+    from_hit, from_doc = lambda o: TaggedDocument(**o['_source']), lambda doc: doc
+  hits = r['hits'].get('hits', [])
+  total = r['hits']['total']['value'] + len(recent)
+  if not recent:
+    return total, [from_hit(o) for o in hits]
+
+  placed = overlay_positions(query, recent, hits, PLAN_SHAPES[plan])
+  merged, r = [], 0
+  for i, o in enumerate(hits):
+    while r < len(placed) and placed[r][0] <= i:
+      merged.append((from_doc, placed[r][1]))
+      r += 1
+    merged.append((from_hit, o))
+  merged += [(from_doc, doc) for _, doc in placed[r:]]
+  return total, [convert(item) for convert, item in merged[start:start + MAX_RESULTS_PER_PAGE]]
+
+
+@slowlog.timed
+@resolve_index
+async def get_all_media(owner: int, index: str = None):
+  overlay = get_overlay(owner, index)
+  q = without_overlay(Search().filter('term', owner=owner), overlay)
+  r = await es.search(index=index, size=MAX_MEDIA_PER_USER, **q.to_dict())
+  docs = [TaggedDocument(**o['_source']) for o in r['hits']['hits']]
+  return docs + [doc for doc in overlay.values() if doc]
 
 
+@slowlog.timed
 @resolve_index
 async def get_media(owner: int, id: int, index: str):
   try:
@@ -93,10 +372,7 @@ async def get_media(owner: int, id: int, index: str):
     return None
 
 
-@resolve_index
-async def update_media(
-  doc: TaggedDocument, index: str
-):
+def check_limits(doc: TaggedDocument):
   if any(len(tag) > MAX_TAG_LENGTH for tag in doc.tags):
     raise ValueError(f'Tags are limited to a length of {MAX_TAG_LENGTH}!')
   if len(doc.tags) > MAX_TAGS_PER_FILE:
@@ -104,6 +380,14 @@ async def update_media(
   if len(doc.emoji) > MAX_EMOJI_PER_FILE:
     raise ValueError(f'Only {MAX_EMOJI_PER_FILE} emoji are allowed per file!')
 
+
+@slowlog.timed
+@resolve_index
+async def update_media(
+  doc: TaggedDocument, index: str
+):
+  check_limits(doc)
+
   counter = await count_media(doc.owner, index=index)
   try:
     r = await es.update(
@@ -117,18 +401,86 @@ async def update_media(
   if r['result'] == 'created':
     counter.offset += 1
 
+  notify_write(MediaWrite(doc.owner, doc.id, index, doc, r['result'] == 'created'))
   return r
 
 
+def get_script_error(e: RequestError):
+  """Returns the message of an exception thrown by a script, if any"""
+  error = e.info.get('error') if isinstance(e.info, dict) else None
+  if not isinstance(error, dict):
+    return
+  while error.get('caused_by'):
+    error = error['caused_by']
+  if error.get('type') == 'illegal_argument_exception':
+    return error.get('reason')
+
+
+@slowlog.timed
+@resolve_index
+async def update_media_tags(
+  doc: TaggedDocument,
+  query: ParsedQuery,
+  gen_attrs: dict,
+  replace=False,
+  skip_untagged=False,
+  index: str = None
+):
+  """
+  Merges the tags and emoji from query and the generated attributes into
+  the stored document in a single request, doc is used if it doesn't exist yet
+  With replace, non-empty tags or emoji from query replace the existing ones
+  Returns the resulting document, or None if it was skipped because it has no tags
+  """
+  counter = await count_media(doc.owner, index=index)
+  kwargs = {}
+  if counter.count < MAX_MEDIA_PER_USER:
+    kwargs['upsert'] = doc.to_dict()
+
+  try:
+    r = await es.update(
+      index=index,
+      id=DocumentID.pack(doc.owner, doc.id),
+      script={
+        'id': painless.UPDATE_TAGS_SCRIPT,
+        'params': painless.update_tags_params(query, gen_attrs, replace, skip_untagged)
+      },
+      scripted_upsert=True,
+      retry_on_conflict=3,
+      _source=True,
+      **kwargs
+    )
+  except NotFoundError:
+    raise ValueError(f'Only {MAX_MEDIA_PER_USER} media allowed per user')
+  except RequestError as e:
+    message = get_script_error(e)
+    if not message:
+      raise
+    raise ValueError(message)
+
+  if r['result'] == 'noop':
+    return None
+  if r['result'] == 'created':
+    counter.offset += 1
+  new_doc = TaggedDocument(**r['get']['_source'])
+  notify_write(MediaWrite(doc.owner, doc.id, index, new_doc, r['result'] == 'created'))
+  return new_doc
+
+
+@slowlog.timed
 @resolve_index
 async def update_last_used(owner: int, id: int, index: str):
-  return await es.update(
+  changes = {'last_used': round(time.time())}
+  r = await es.update(
     index=index,
     id=DocumentID.pack(owner, id),
-    doc={'last_used': round(time.time())}
+    doc=changes
   )
+  notify_write(MediaWrite(owner, id, index, changes=changes))
+  return r
 
 
+@slowlog.timed
 @resolve_index
 async def delete_media(owner: int, id: int, index: str):
   try:
@@ -138,56 +490,85 @@ async def delete_media(owner: int, id: int, index: str):
       id=DocumentID.pack(owner, id)
     )
     count.offset -= 1
+    notify_write(MediaWrite(owner, id, index))
     return r
   except NotFoundError:
     return None
 
 
+async def update_selection(owner: int, ids: list[int], marked: bool):
+  """Adds ids to or removes them from the export selection of owner"""
+  r = await es.update(
+    index=INDEX.selection,
+    id=str(owner),
+    script={
+      'source': painless.SELECT_SOURCE,
+      'params': {'ids': [str(id) for id in ids], 'marked': marked},
+    },
+    upsert={'ids': []},
+    scripted_upsert=True,
+    retry_on_conflict=3
+  )
+  selection = selections.get(owner)
+  if selection is not None:
+    if marked:
+      selection.update(ids)
+    else:
+      selection.difference_update(ids)
+  return r
+
+
+@slowlog.timed
 @resolve_index
 async def mark_media(owner: int, id: int, marked=True, index: str = None):
+  """Adds media to or removes it from the export selection, only last_used of the document is changed"""
   try:
-    return await es.update(
-      index=index,
-      id=DocumentID.pack(owner, id),
-      doc={
-        'marked': marked,
-        'last_used': round(time.time())
-      },
-      refresh=True
-    )
+    # also checks that the media was saved
+    await update_last_used(owner, id, index=index)
   except NotFoundError:
     raise ValueError('You have not saved this media')
+  return await update_selection(owner, [id], marked)
 
 
+@slowlog.timed
 @resolve_index
 async def mark_all_media(
   owner: int,
   marked: bool,
-  refresh: bool = False,
-  query_gen: Callable = None,
+  query: ParsedQuery = None,
   index: str = None
 ):
+  """
+  Adds everything (that matches query) to or removes it from the export selection
+  Returns the number of selected or unselected documents in 'updated'
+  """
+  overlay = get_overlay(owner, index)
+  selected = selection_filter(owner)
   q = Search().filter('term', owner=owner)
-  if marked:
-    q = q.exclude('term', marked=True)
-  else:
-    q = q.filter('term', marked=True)
-
-  if query_gen:
-    q = query_gen(q)
-
-  return await es.update_by_query(
-    index=index,
-    body=q.to_dict() | {
-      'script': {
-        'source': 'ctx._source.marked = params.marked',
-        'params': { 'marked': marked }
-      }
-    },
-    refresh=refresh
-  )
-
-
+  q = q.exclude(selected) if marked else q.filter(selected)
+  if query:
+    q = gen_search_query(owner, query, initial_q=q)
+  q = without_overlay(q, overlay).source(['id'])
+
+  r = await es.search(index=index, size=MAX_MEDIA_PER_USER, **q.to_dict())
+  ids = [hit['_source']['id'] for hit in r['hits']['hits']]
+  if overlay:
+    selection = await get_selection(owner)
+    if query:
+      recent = await match_overlay(owner, query, overlay)
+    else:
+      recent = [doc for doc in overlay.values() if doc]
+    ids += [doc.id for doc in recent if (doc.id in selection) != marked]
+  if not marked and not query:
+    # also forgets media that was deleted while it was selected
+    await es.index(index=INDEX.selection, id=str(owner), document={'ids': []})
+    selections[owner] = set()
+  elif ids:
+    await update_selection(owner, ids, marked)
+  return {'updated': len(ids)}
+
+
+@slowlog.timed
 @resolve_index
 async def mark_all_media_from_query(
   owner: int,
@@ -195,25 +576,209 @@ async def mark_all_media_from_query(
   marked: bool,
   index: str = None
 ):
-  return await mark_all_media(
-    owner=owner,
-    marked=marked,
-    refresh=True,
-    query_gen=lambda q: gen_search_query(
-      owner, query, initial_q=q
-    ),
-    index=index
+  return await mark_all_media(owner=owner, marked=marked, query=query, index=index)
+
+
+async def wait_for_task(task_id: str, on_progress: Callable = None):
+  """
+  Polls a task started with wait_for_completion=False until it completes,
+  on_progress is awaited with the status of the task in between
+  Returns the response of the task
+  """
+  while True:
+    r = await es.tasks.get(task_id=task_id)
+    if r['completed']:
+      if 'error' in r:
+        raise RequestError(500, r['error'].get('type'), r)
+      return r['response']
+    if on_progress:
+      await on_progress(r['task']['status'])
+    await asyncio.sleep(TASK_POLL_INTERVAL)
+
+
+@slowlog.timed
+@with_priority(Priority.background)
+@resolve_index
+async def retag_media(
+  owner: int,
+  old: str,
+  new: str,
+  dry_run=False,
+  on_progress: Callable = None,
+  index: str = None
+):
+  """
+  Renames the tag old to new with a single update_by_query
+  Returns the number of documents that were changed, or would be with dry_run
+  """
+  # documents in the overlay aren't searchable yet, they're updated one by one
+  overlay = get_overlay(owner, index)
+  recent = [doc for doc in overlay.values() if doc and old in doc.tags]
+  q = Search().filter('term', owner=owner).filter('term', **{'tags.keyword': old})
+  q = without_overlay(q, overlay)
+  if dry_run:
+    r = await es.count(index=index, body=q.to_dict())
+    return r['count'] + len(recent)
+
+  script = {'source': painless.RETAG_SOURCE, 'params': {'old': old, 'new': new}}
+  # the changed documents go to the overlay, so they are needed before the update
+  r = await es.search(index=index, size=MAX_MEDIA_PER_USER, **q.to_dict())
+  docs = [TaggedDocument(**o['_source']) for o in r['hits']['hits']]
+  r = await es.update_by_query(
+    index=index,
+    body=q.to_dict() | {'script': script},
+    slices='auto',
+    conflicts='proceed',
+    wait_for_completion=False
   )
+  r = await wait_for_task(r['task'], on_progress)
+  for doc in recent:
+    await es.update(
+      index=index, id=DocumentID.pack(owner, doc.id), script=script, retry_on_conflict=3
+    )
+  for doc in docs + recent:
+    src = {'tags': list(doc.tags)}
+    painless.retag(src, script['params'])
+    record_write(MediaWrite(owner, doc.id, index, doc.merge(tags=src['tags'])))
+  # the new tags are different for each document
+  notify_write(MediaWrite(owner, None, index, changes={'tags': None}))
+  return r['updated'] + len(recent)
 
 
+@slowlog.timed
+@with_priority(Priority.background)
+@resolve_index
+async def purge_media(
+  owner: int,
+  query: ParsedQuery,
+  dry_run=False,
+  on_progress: Callable = None,
+  index: str = None
+):
+  """
+  Deletes everything that matches query with a single delete_by_query
+  Returns the number of documents that were deleted, or would be with dry_run
+  """
+  # documents in the overlay aren't searchable yet, they're deleted one by one
+  overlay = get_overlay(owner, index)
+  recent = await match_overlay(owner, query, overlay)
+  q = without_overlay(gen_search_query(owner, query, sort=False), overlay)
+  body = {'query': q.to_dict()['query']}
+  if dry_run:
+    r = await es.count(index=index, body=body)
+    return r['count'] + len(recent)
+
+  # the deleted documents go to the overlay, so they are needed before the delete
+  r = await es.search(index=index, size=MAX_MEDIA_PER_USER, _source=['id'], body=body)
+  ids = [o['_source']['id'] for o in r['hits']['hits']]
+  # before the delete, so that a fresh count isn't corrected again
+  counter = await count_media(owner, index=index)
+  r = await es.delete_by_query(
+    index=index,
+    body=body,
+    slices='auto',
+    conflicts='proceed',
+    wait_for_completion=False
+  )
+  r = await wait_for_task(r['task'], on_progress)
+  counter.offset -= r['deleted']
+  for doc in recent:
+    await delete_media(owner, doc.id, index=index)
+  for id in ids:
+    record_write(MediaWrite(owner, id, index))
+  notify_write(MediaWrite(owner, None, index))
+  return r['deleted'] + len(recent)
+
+
+@slowlog.timed
+@with_priority(Priority.background)
 @resolve_index
 async def get_marked_media(
   owner: int,
   excludes=['owner', 'last_used', 'created', 'marked'],
   index: str = None
 ):
-  q = Search().filter('term', owner=owner).filter('term', marked=True)
+  overlay = get_overlay(owner, index)
+  q = Search().filter('term', owner=owner).filter(selection_filter(owner))
+  q = without_overlay(q, overlay)
   if excludes:
     q = q.source(excludes=excludes)
   r = await es.search(index=index, **q.to_dict(), size=10000)
-  return [o['_source'] for o in r['hits']['hits']]
+  docs = [o['_source'] for o in r['hits']['hits']]
+
+  recent = [doc for doc in overlay.values() if doc]
+  if recent:
+    selection = await get_selection(owner)
+    docs += [
+      {k: v for k, v in doc.to_dict().items() if k not in (excludes or [])}
+      for doc in recent if doc.id in selection
+    ]
+  return docs
+
+
+@slowlog.timed
+@resolve_index
+async def get_tag_frequencies(owner: int, index: str = None):
+  """Returns the number of documents that use each tag"""
+  overlay = get_overlay(owner, index)
+  q = without_overlay(Search().filter('term', owner=owner), overlay)
+  q.aggs.bucket(
+    'tags', 'terms', field='tags.keyword', size=MAX_MEDIA_PER_USER * MAX_TAGS_PER_FILE
+  )
+  r = await es.search(index=index, size=0, **q.to_dict())
+  counts = Counter({b['key']: b['doc_count'] for b in r['aggregations']['tags']['buckets']})
+  for doc in overlay.values():
+    if doc:
+      counts.update(set(doc.tags))
+  return dict(counts)
+
+
+def summarize_profile(node):
+  return {
+    'type': node['type'],
+    'description': node['description'],
+    'time_ms': node['time_in_nanos'] / 1e6,
+    'breakdown': {k: v for k, v in node.get('breakdown', {}).items() if v},
+    'children': [summarize_profile(child) for child in node.get('children', [])],
+  }
+
+
+@slowlog.on_slow
+@with_priority(Priority.background)
+async def describe_collection(call: slowlog.SlowCall):
+  if call.owner is None:
+    return
+  r = await count_media_by_type(call.owner)
+  call.collection = {
+    'total': r['doc_count'],
+    'types': {b['key']: b['doc_count'] for b in r['types']['buckets']},
+  }
+
+
+@slowlog.on_slow
+@with_priority(Priority.background)
+async def profile_search(call: slowlog.SlowCall):
+  """Runs the searches of a sampled call again with profiling"""
+  if not call.sampled:
+    return
+  call.profile = []
+  for request in call.requests:
+    r = await es.search(
+      index=request['index'], size=MAX_RESULTS_PER_PAGE, profile=True, **request['body']
+    )
+    call.profile.append([
+      {
+        'shard': shard['id'],
+        'query': [
+          summarize_profile(node) for search in shard['searches'] for node in search['query']
+        ],
+      }
+      for shard in r.get('profile', {}).get('shards', [])
+    ])
+
+
+if DB_BACKEND == 'sqlite':
+  # replaces the elasticsearch implementations above
+  from db_sqlite import *
+
+import replica
@@ -5,11 +5,21 @@ import hashlib
 from elasticsearch import NotFoundError
 
 from elasticsearch import AsyncElasticsearch
-from secrets import HTTP_PASS, ADMIN_HTTP_PASS
-from constants import ELASTIC_USERNAME, INDEX
+from constants import ELASTIC_USERNAME, INDEX, DB_BACKEND, FAKE_ES_LATENCY
+from painless import UPDATE_TAGS_SCRIPT, UPDATE_TAGS_SOURCE
 
 SETTINGS_HASH_FILE = 'settings.hash'
-es_main = AsyncElasticsearch("http://localhost:9200", http_auth=(ELASTIC_USERNAME, HTTP_PASS))
+if DB_BACKEND != 'sqlite':
+  from secrets import HTTP_PASS, ADMIN_HTTP_PASS
+if DB_BACKEND == 'fake':
+  from fake_es import FakeElasticsearch
+  es_main = es_admin = FakeElasticsearch(latency=FAKE_ES_LATENCY)
+elif DB_BACKEND == 'sqlite':
+  # db_sqlite replaces everything that uses them, including init
+  es_main = es_admin = None
+else:
+  es_main = AsyncElasticsearch("http://localhost:9200", http_auth=(ELASTIC_USERNAME, HTTP_PASS))
+  es_admin = AsyncElasticsearch("http://localhost:9200", http_auth=('elastic', ADMIN_HTTP_PASS))
 logger = logging.getLogger('db_init')
 
 # Load settings and calculate hash of minified data
@@ -31,7 +41,6 @@ except FileNotFoundError:
 
 async def init_user():
   # TODO: skip creating user if already exists with the correct roles
-  es_admin = AsyncElasticsearch("http://localhost:9200", http_auth=('elastic', ADMIN_HTTP_PASS))
   logger.info('Updating user role...')
   await es_admin.security.put_role(
     name='tagbot',
@@ -39,7 +48,7 @@ async def init_user():
       'cluster': ['monitor'],
       'indices': [
         {
-          'names': [INDEX.main, INDEX.backup, INDEX.transfer],
+          'names': [INDEX.main, INDEX.backup, INDEX.transfer, INDEX.selection],
           'privileges': ['all']
         }
       ]
@@ -109,6 +118,9 @@ async def init_main_index():
     logger.info('Deleting backup...')
     await es_main.indices.delete(index=INDEX.backup)
 
+  if DB_BACKEND == 'fake':
+    # the hash belongs to the real cluster
+    return
   logger.info('Writing new settings hash...')
   with open(SETTINGS_HASH_FILE, 'w') as f:
     f.write(settings_hash)
@@ -129,7 +141,34 @@ async def init_transfer_index():
   )
 
 
+async def init_selection_index():
+  if await es_main.indices.exists(index=INDEX.selection):
+    return
+  logger.info('Creating selection index...')
+  # only read by id and with terms lookups, which use the source
+  await es_main.indices.create(
+    index=INDEX.selection,
+    settings={'number_of_shards': 1},
+    mappings={'dynamic': False, 'properties': {}}
+  )
+
+
+async def init_scripts():
+  logger.info('Storing scripts...')
+  await es_admin.put_script(
+    id=UPDATE_TAGS_SCRIPT,
+    body={
+      'script': {
+        'lang': 'painless',
+        'source': UPDATE_TAGS_SOURCE
+      }
+    }
+  )
+
+
 async def init():
   await init_user()
+  await init_scripts()
   await init_transfer_index()
+  await init_selection_index()
   await init_main_index()
@@ -0,0 +1,504 @@
+# SQLite storage backend for small deployments, used with DB_BACKEND = 'sqlite'
+# implements the same functions as db, which replaces its elasticsearch versions
+# Text is searched with an FTS5 table using the trigram tokenizer, so tokens
+# match anywhere inside words, but there is no fuzzy (edit distance) matching
+# Queries are synchronous, they take a few ms on a local file
+
+import json
+import time
+import sqlite3
+from typing import Callable
+
+import painless
+import slowlog
+from db import resolve_index, CachedCounter, MediaWrite, notify_write, check_limits
+from query_parser import ParsedQuery
+from analysis import fold, analyze
+from data_model import TaggedDocument, SearchHit
+from constants import MAX_MEDIA_PER_USER, MAX_RESULTS_PER_PAGE, INDEX, SQLITE_PATH
+
+__all__ = [
+  'init', 'count_media_by_type', 'count_media', 'search_media', 'get_all_media',
+  'get_media', 'update_media', 'update_media_tags', 'update_last_used',
+  'delete_media', 'mark_media', 'mark_all_media', 'mark_all_media_from_query',
+  'get_marked_media', 'get_tag_frequencies', 'retag_media', 'purge_media',
+]
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+  slot INTEGER PRIMARY KEY,
+  idx TEXT NOT NULL,
+  owner INTEGER NOT NULL,
+  next_seq INTEGER NOT NULL DEFAULT 0,
+  UNIQUE (idx, owner)
+);
+CREATE TABLE IF NOT EXISTS media (
+  idx TEXT NOT NULL,
+  owner INTEGER NOT NULL,
+  id INTEGER NOT NULL,
+  type TEXT NOT NULL,
+  ext TEXT NOT NULL,
+  is_animated INTEGER NOT NULL,
+  marked INTEGER NOT NULL,
+  last_used INTEGER NOT NULL,
+  -- words of the text fields, for tokens that are too short for trigrams
+  words TEXT NOT NULL,
+  doc TEXT NOT NULL,
+  UNIQUE (idx, owner, id)
+);
+CREATE INDEX IF NOT EXISTS media_owner ON media (idx, owner, type, last_used);
+CREATE VIRTUAL TABLE IF NOT EXISTS media_fts USING fts5(
+  tags, title, filename, pack_name, tokenize='trigram'
+);
+'''
+
+TEXT_FIELDS = ['tags', 'title', 'filename', 'pack_name']
+# bm25 weights of TEXT_FIELDS
+TEXT_WEIGHTS = '3.0, 3.0, 1.0, 1.0'
+# columns searched for each query field, like field_queries in gen_search_query
+QUERY_COLUMNS = {
+  'tags': TEXT_FIELDS,
+  'filename': ['filename', 'title'],
+  'pack_name': ['pack_name'],
+}
+MIN_TRIGRAM_LENGTH = 3
+# the rowids of a user's documents are (slot << ROWID_BITS) | seq, so each user
+# has a range of rowids, which lets the full text search skip other users' documents
+ROWID_BITS = 24
+
+conn: sqlite3.Connection = None
+
+
+def connect(path=SQLITE_PATH):
+  global conn
+  conn = sqlite3.connect(path)
+  conn.executescript(SCHEMA)
+
+
+def field_text(doc: dict, field):
+  value = doc.get(field) or ''
+  return ' '.join(value) if isinstance(value, list) else value
+
+
+def allocate_rowid(owner: int, index: str):
+  slot, seq = conn.execute(
+    '''
+    INSERT INTO users (idx, owner) VALUES (?, ?)
+    ON CONFLICT (idx, owner) DO UPDATE SET next_seq = next_seq + 1
+    RETURNING slot, next_seq
+    ''',
+    (index, owner)
+  ).fetchone()
+  if seq >> ROWID_BITS:
+    raise RuntimeError(f'User #{owner} has used up their rowids')
+  return (slot << ROWID_BITS) | seq
+
+
+def rowid_range(owner: int, index: str):
+  """Returns the first and last possible rowid of the user's documents"""
+  row = conn.execute(
+    'SELECT slot FROM users WHERE idx = ? AND owner = ?', (index, owner)
+  ).fetchone()
+  if not row:
+    return 0, -1
+  return row[0] << ROWID_BITS, ((row[0] + 1) << ROWID_BITS) - 1
+
+
+def write_doc(doc: dict, index: str):
+  """Inserts or replaces a document, must be called inside a transaction"""
+  row = conn.execute(
+    'SELECT rowid FROM media WHERE idx = ? AND owner = ? AND id = ?',
+    (index, doc['owner'], doc['id'])
+  ).fetchone()
+  rowid = row[0] if row else allocate_rowid(doc['owner'], index)
+
+  text = [fold(field_text(doc, field)) for field in TEXT_FIELDS]
+  conn.execute(
+    '''
+    INSERT OR REPLACE INTO media
+      (rowid, idx, owner, id, type, ext, is_animated, marked, last_used, words, doc)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''',
+    (
+      rowid, index, doc['owner'], doc['id'], doc['type'], doc['ext'].lower(),
+      doc['is_animated'], doc['marked'], doc['last_used'],
+      f' {" ".join(w for t in text for w in analyze(t))} ', json.dumps(doc)
+    )
+  )
+  conn.execute('DELETE FROM media_fts WHERE rowid = ?', (rowid,))
+  conn.execute(
+    'INSERT INTO media_fts (rowid, tags, title, filename, pack_name) VALUES (?, ?, ?, ?, ?)',
+    (rowid, *text)
+  )
+
+
+def read_doc(owner: int, id: int, index: str):
+  row = conn.execute(
+    'SELECT doc FROM media WHERE idx = ? AND owner = ? AND id = ?', (index, owner, id)
+  ).fetchone()
+  return json.loads(row[0]) if row else None
+
+
+def fts_phrase(token):
+  return '"' + token.replace('"', '""') + '"'
+
+
+def build_search(owner: int, query: ParsedQuery, index: str):
+  """
+  Translates a query like gen_search_query does
+  Returns the FROM and WHERE clauses, their parameters and the score expression
+  """
+  rowids = rowid_range(owner, index)
+  where, params = ['media.rowid BETWEEN ? AND ?'], list(rowids)
+  match_exprs = []
+
+  search_type = query.get_first('type')
+  if search_type == 'document':
+    where.append("media.type != 'photo'")
+  else:
+    where.append('media.type = ?')
+    params.append(search_type)
+
+  for (field, is_neg), values in query.fields.items():
+    clauses, clause_params = [], []
+    if field in QUERY_COLUMNS:
+      tokens = [w for value in values for w in analyze(value)]
+      long_tokens = [t for t in tokens if len(t) >= MIN_TRIGRAM_LENGTH]
+      for token in tokens:
+        if len(token) < MIN_TRIGRAM_LENGTH:
+          clauses.append('media.words LIKE ?')
+          clause_params.append(f'% {token} %')
+      if long_tokens:
+        expr = (
+          f'{{{" ".join(QUERY_COLUMNS[field])}}} : '
+          f'({" AND ".join(fts_phrase(t) for t in long_tokens)})'
+        )
+        if not is_neg:
+          match_exprs.append(expr)
+        else:
+          clauses.append(
+            'media.rowid IN (SELECT rowid FROM media_fts '
+            'WHERE media_fts MATCH ? AND rowid BETWEEN ? AND ?)'
+          )
+          clause_params.extend([expr, *rowids])
+    elif field == 'ext':
+      clauses.extend('media.ext = ?' for _ in values)
+      clause_params.extend(v.lower() for v in values)
+    elif field in {'is_animated', 'marked'}:
+      clauses.append(f'media.{field} = ?')
+      clause_params.append(values[0] == 'yes')
+    elif field == 'emoji':
+      clauses.append(
+        "EXISTS (SELECT 1 FROM json_each(media.doc, '$.emoji') "
+        f"WHERE value IN ({', '.join('?' * len(values))}))"
+      )
+      clause_params.extend(values)
+    else:
+      continue
+
+    if not clauses:
+      continue
+    clause = ' AND '.join(clauses)
+    where.append(f'NOT ({clause})' if is_neg else f'({clause})')
+    params.extend(clause_params)
+
+  if not match_exprs:
+    return f'FROM media WHERE {" AND ".join(where)}', params, '0'
+  return (
+    'FROM media JOIN media_fts ON media_fts.rowid = media.rowid '
+    f'WHERE media_fts MATCH ? AND media_fts.rowid BETWEEN ? AND ? AND {" AND ".join(where)}',
+    [' AND '.join(match_exprs), *rowids] + params,
+    f'bm25(media_fts, {TEXT_WEIGHTS})'
+  )
+
+
+async def init():
+  connect()
+  with conn:
+    conn.execute(
+      'DELETE FROM media_fts WHERE rowid IN (SELECT rowid FROM media WHERE idx = ?)',
+      (INDEX.transfer,)
+    )
+    conn.execute('DELETE FROM media WHERE idx = ?', (INDEX.transfer,))
+    conn.execute('DELETE FROM users WHERE idx = ?', (INDEX.transfer,))
+
+
+@slowlog.timed
+@resolve_index
+async def count_media_by_type(owner: int, only_marked=False, index: str = None):
+  rows = conn.execute(
+    '''
+    SELECT type, count(*), sum(marked) FROM media WHERE idx = ? AND owner = ?
+    GROUP BY type ORDER BY count(*) DESC
+    ''',
+    (index, owner)
+  ).fetchall()
+  r = {
+    'doc_count': sum(count for _, count, _ in rows),
+    'types': {'buckets': [{'key': t, 'doc_count': count} for t, count, _ in rows]}
+  }
+  if only_marked:
+    marked_rows = sorted(
+      ((t, marked) for t, _, marked in rows if marked), key=lambda row: -row[1]
+    )
+    r['marked'] = {
+      'doc_count': sum(marked for _, marked in marked_rows),
+      'types': {'buckets': [{'key': t, 'doc_count': marked} for t, marked in marked_rows]}
+    }
+  return r
+
+
+@slowlog.timed
+@resolve_index
+async def count_media(owner: int, index: str):
+  count, = conn.execute(
+    'SELECT count(*) FROM media WHERE idx = ? AND owner = ?', (index, owner)
+  ).fetchone()
+  return CachedCounter(count)
+
+
+@slowlog.timed
+async def search_media(
+  owner: int, query: ParsedQuery, page: int = 0, lean=False
+):
+  index = INDEX.transfer if query.has('show_transfer') else INDEX.main
+  from_where, params, score = build_search(owner, query, index)
+  # bm25 (lower is better) can't be used in the same query as the window function
+  rows = conn.execute(
+    f'''
+    SELECT doc, count(*) OVER () FROM (
+      SELECT media.doc AS doc, {score} AS score, media.last_used AS last_used {from_where}
+    ) ORDER BY score, last_used DESC LIMIT ? OFFSET ?
+    ''',
+    params + [MAX_RESULTS_PER_PAGE, page * MAX_RESULTS_PER_PAGE]
+  ).fetchall()
+  total = rows[0][1] if rows else 0
+  docs = [json.loads(doc) for doc, _ in rows]
+  if lean:
+    return total, [
+      SearchHit(d['id'], d['access_hash'], d['type'], d['tags'], d['emoji'], d['title'])
+      for d in docs
+    ]
+  return total, [TaggedDocument(**d) for d in docs]
+
+
+@slowlog.timed
+@resolve_index
+async def get_all_media(owner: int, index: str = None):
+  rows = conn.execute(
+    'SELECT doc FROM media WHERE idx = ? AND owner = ?', (index, owner)
+  ).fetchall()
+  return [TaggedDocument(**json.loads(doc)) for doc, in rows]
+
+
+@slowlog.timed
+@resolve_index
+async def get_media(owner: int, id: int, index: str):
+  doc = read_doc(owner, id, index)
+  if not doc:
+    return None
+  doc['last_used'] = round(time.time())
+  return TaggedDocument(**doc)
+
+
+@slowlog.timed
+@resolve_index
+async def update_media(doc: TaggedDocument, index: str):
+  check_limits(doc)
+  with conn:
+    created = not read_doc(doc.owner, doc.id, index)
+    if created and (await count_media(doc.owner, index=index)).count >= MAX_MEDIA_PER_USER:
+      raise ValueError(f'Only {MAX_MEDIA_PER_USER} media allowed per user')
+    write_doc(doc.to_dict(), index)
+  notify_write(MediaWrite(doc.owner, doc.id, index, doc, created))
+  return {'result': 'created' if created else 'updated'}
+
+
+@slowlog.timed
+@resolve_index
+async def update_media_tags(
+  doc: TaggedDocument,
+  query: ParsedQuery,
+  gen_attrs: dict,
+  replace=False,
+  skip_untagged=False,
+  index: str = None
+):
+  with conn:
+    src = read_doc(doc.owner, doc.id, index)
+    created = not src
+    if created:
+      if (await count_media(doc.owner, index=index)).count >= MAX_MEDIA_PER_USER:
+        raise ValueError(f'Only {MAX_MEDIA_PER_USER} media allowed per user')
+      src = doc.to_dict()
+    params = painless.update_tags_params(query, gen_attrs, replace, skip_untagged)
+    if not painless.update_tags(src, params):
+      return None
+    write_doc(src, index)
+
+  new_doc = TaggedDocument(**src)
+  notify_write(MediaWrite(doc.owner, doc.id, index, new_doc, created))
+  return new_doc
+
+
+def update_fields(owner: int, id: int, changes: dict, index: str):
+  """Updates some fields of a document, returns the number of updated rows"""
+  doc = read_doc(owner, id, index)
+  if not doc:
+    return 0
+  doc |= changes
+  write_doc(doc, index)
+  return 1
+
+
+@slowlog.timed
+@resolve_index
+async def update_last_used(owner: int, id: int, index: str):
+  changes = {'last_used': round(time.time())}
+  with conn:
+    updated = update_fields(owner, id, changes, index)
+  if updated:
+    notify_write(MediaWrite(owner, id, index, changes=changes))
+  return {'updated': updated}
+
+
+@slowlog.timed
+@resolve_index
+async def delete_media(owner: int, id: int, index: str):
+  with conn:
+    row = conn.execute(
+      'DELETE FROM media WHERE idx = ? AND owner = ? AND id = ? RETURNING rowid',
+      (index, owner, id)
+    ).fetchone()
+    if not row:
+      return None
+    conn.execute('DELETE FROM media_fts WHERE rowid = ?', row)
+  notify_write(MediaWrite(owner, id, index))
+  return {'result': 'deleted'}
+
+
+@slowlog.timed
+@resolve_index
+async def mark_media(owner: int, id: int, marked=True, index: str = None):
+  changes = {
+    'marked': marked,
+    'last_used': round(time.time())
+  }
+  with conn:
+    if not update_fields(owner, id, changes, index):
+      raise ValueError('You have not saved this media')
+  notify_write(MediaWrite(owner, id, index, changes=changes))
+  return {'result': 'updated'}
+
+
+@slowlog.timed
+@resolve_index
+async def mark_all_media(
+  owner: int,
+  marked: bool,
+  query: ParsedQuery = None,
+  index: str = None
+):
+  if query:
+    from_where, params, _ = build_search(owner, query, index)
+  else:
+    from_where, params = 'FROM media WHERE media.idx = ? AND media.owner = ?', [index, owner]
+  with conn:
+    cursor = conn.execute(
+      f'''
+      UPDATE media SET marked = ?, doc = json_set(doc, '$.marked', json(?))
+      WHERE marked != ? AND rowid IN (SELECT media.rowid {from_where})
+      ''',
+      [marked, json.dumps(marked), marked] + params
+    )
+  notify_write(MediaWrite(owner, None, index, changes={'marked': marked}))
+  return {'updated': cursor.rowcount}
+
+
+@slowlog.timed
+@resolve_index
+async def mark_all_media_from_query(
+  owner: int,
+  query: ParsedQuery,
+  marked: bool,
+  index: str = None
+):
+  return await mark_all_media(owner=owner, marked=marked, query=query, index=index)
+
+
+@slowlog.timed
+@resolve_index
+async def retag_media(
+  owner: int,
+  old: str,
+  new: str,
+  dry_run=False,
+  on_progress: Callable = None,
+  index: str = None
+):
+  rows = conn.execute(
+    '''
+    SELECT media.doc FROM media, json_each(media.doc, '$.tags') AS tag
+    WHERE media.idx = ? AND media.owner = ? AND tag.value = ?
+    ''',
+    (index, owner, old)
+  ).fetchall()
+  if dry_run:
+    return len(rows)
+  with conn:
+    for doc, in rows:
+      doc = json.loads(doc)
+      painless.retag(doc, {'old': old, 'new': new})
+      write_doc(doc, index)
+  notify_write(MediaWrite(owner, None, index, changes={'tags': None}))
+  return len(rows)
+
+
+@slowlog.timed
+@resolve_index
+async def purge_media(
+  owner: int,
+  query: ParsedQuery,
+  dry_run=False,
+  on_progress: Callable = None,
+  index: str = None
+):
+  from_where, params, _ = build_search(owner, query, index)
+  rowids = conn.execute(f'SELECT media.rowid {from_where}', params).fetchall()
+  if dry_run:
+    return len(rowids)
+  with conn:
+    conn.executemany('DELETE FROM media WHERE rowid = ?', rowids)
+    conn.executemany('DELETE FROM media_fts WHERE rowid = ?', rowids)
+  notify_write(MediaWrite(owner, None, index))
+  return len(rowids)
+
+
+@slowlog.timed
+@resolve_index
+async def get_marked_media(
+  owner: int,
+  excludes=['owner', 'last_used', 'created', 'marked'],
+  index: str = None
+):
+  rows = conn.execute(
+    'SELECT doc FROM media WHERE idx = ? AND owner = ? AND marked', (index, owner)
+  ).fetchall()
+  docs = [json.loads(doc) for doc, in rows]
+  for doc in docs:
+    for key in excludes or []:
+      doc.pop(key, None)
+  return docs
+
+
+@slowlog.timed
+@resolve_index
+async def get_tag_frequencies(owner: int, index: str = None):
+  rows = conn.execute(
+    '''
+    SELECT tag.value, count(*) FROM media, json_each(media.doc, '$.tags') AS tag
+    WHERE media.idx = ? AND media.owner = ? GROUP BY tag.value
+    ''',
+    (index, owner)
+  ).fetchall()
+  return dict(rows)
@@ -0,0 +1,108 @@
+# Routes every incoming message through a single NewMessage handler
+# Commands are looked up by name in a dict, so only the handlers for that
+# command run their pattern, and the whitelist is checked once per update
+
+import re
+import logging
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Callable, Awaitable
+
+from telethon import events
+
+from proxy_globals import client
+from p_conv_grab import HANDLED_BY_CONV_ATTR
+from utils import WHITELISTED_IDS
+
+
+logger = logging.getLogger('dispatcher')
+
+COMMAND_RE = re.compile(r'/([a-zA-Z\d_]+)')
+
+Handler = Callable[[Any], Awaitable[None]]
+
+
+@dataclass
+class CommandRoute:
+  handler: Handler
+  pattern: re.Pattern = None
+  whitelisted: bool = True
+
+
+command_routes: dict[str, list[CommandRoute]] = defaultdict(list)
+media_handlers: list[Handler] = []
+reply_handlers: list[Handler] = []
+
+
+def command(*names, pattern=None, whitelisted=True):
+  """
+  Registers a handler for /name (and aliases)
+  If pattern is given, it's matched against the message text and stored in
+  event.pattern_match, the handler is skipped if it doesn't match
+  """
+  def wrapper(handler):
+    route = CommandRoute(handler, re.compile(pattern) if pattern else None, whitelisted)
+    for name in names:
+      command_routes[name.lower()].append(route)
+    return handler
+  return wrapper
+
+
+def on_media(handler):
+  """Registers a handler for (whitelisted) messages that contain media"""
+  media_handlers.append(handler)
+  return handler
+
+
+def on_reply(handler):
+  """Registers a handler for (whitelisted) non-command messages that are replies"""
+  reply_handlers.append(handler)
+  return handler
+
+
+async def run_handler(handler, event):
+  """Runs a handler, returns True if the update should not propagate further"""
+  try:
+    await handler(event)
+  except events.StopPropagation:
+    return True
+  except Exception:
+    logger.exception(f'Unhandled exception in {handler.__name__}')
+  return False
+
+
+async def dispatch_command(event, is_whitelisted):
+  m = COMMAND_RE.match(event.raw_text)
+  if not m:
+    return
+  for route in command_routes.get(m[1].lower(), ()):
+    if route.whitelisted and not is_whitelisted:
+      continue
+    if route.pattern:
+      match = route.pattern.match(event.raw_text)
+      if not match:
+        continue
+      event.pattern_match = match
+    if await run_handler(route.handler, event):
+      return
+
+
+@client.on(events.NewMessage())
+async def dispatch(event):
+  if getattr(event.original_update, HANDLED_BY_CONV_ATTR, False):
+    return
+  is_whitelisted = event.sender_id in WHITELISTED_IDS
+
+  if event.raw_text.startswith('/'):
+    return await dispatch_command(event, is_whitelisted)
+  if not is_whitelisted:
+    return
+
+  handlers = []
+  if event.file:
+    handlers.extend(media_handlers)
+  if event.is_reply:
+    handlers.extend(reply_handlers)
+  for handler in handlers:
+    if await run_handler(handler, event):
+      return
@@ -0,0 +1,1041 @@
+# In-process stand-in for AsyncElasticsearch (DB_BACKEND = 'fake')
+# implements the subset of the API the bot uses on plain dicts, so the bot,
+# benchmarks and scripts can run without an elasticsearch node
+# Writes are visible immediately (as if every request used refresh=True),
+# text is analyzed with the approximations in analysis.py and every matching
+# term scores its boost, so the order of results differs from BM25
+
+import re
+import copy
+import json
+import time
+import uuid
+import asyncio
+import functools
+from fnmatch import fnmatch
+from types import SimpleNamespace
+from collections import Counter, defaultdict
+
+from elasticsearch import (
+  TransportError, NotFoundError, RequestError, ConflictError, AuthorizationException
+)
+from elasticsearch.serializer import JSONSerializer
+
+import painless
+from analysis import ANALYZERS, edit_distance
+
+
+# python versions of the scripts the bot runs, by source
+# a script returns False to skip the update (ctx.op = 'noop')
+SCRIPTS = {
+  painless.UPDATE_TAGS_SOURCE: painless.update_tags,
+  painless.RETAG_SOURCE: painless.retag,
+  painless.SELECT_SOURCE: painless.select,
+  'ctx._source.marked = params.marked':
+    lambda src, params: src.update(marked=params['marked']),
+}
+DEFAULT_MAPPING = {
+  'type': 'text',
+  'fields': {'keyword': {'type': 'keyword', 'ignore_above': 256}}
+}
+# elasticsearch only counts hits exactly up to this by default
+DEFAULT_TRACK_TOTAL_HITS = 10000
+SHARDS = {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0}
+
+
+def error(cls, status, type, reason, **info):
+  return cls(status, type, {'error': {'type': type, 'reason': reason}, 'status': status, **info})
+
+
+def is_lookup(terms):
+  return isinstance(terms, dict) and {'index', 'id', 'path'} <= terms.keys()
+
+
+def as_list(value):
+  if value is None:
+    return []
+  return value if isinstance(value, list) else [value]
+
+
+def to_json(value):
+  "Round trips value through json, like sending it to elasticsearch"
+  if isinstance(value, (dict, list, tuple)):
+    return json.loads(json.dumps(value))
+  return value
+
+
+def flatten(settings, prefix=''):
+  out = {}
+  for key, value in settings.items():
+    if isinstance(value, dict):
+      out |= flatten(value, f'{prefix}{key}.')
+    else:
+      out[f'{prefix}{key}'] = value
+  return out
+
+
+def filter_response(value, paths):
+  "Keeps the parts of value that match one of the paths, like filter_path"
+  if any(not path for path in paths):
+    return value
+  if isinstance(value, list):
+    items = [filter_response(v, paths) for v in value]
+    return [v for v in items if v is not None] or None
+  if not isinstance(value, dict):
+    return None
+  out = {}
+  for key, v in value.items():
+    sub_paths = [path[1:] for path in paths if fnmatch(key, path[0])]
+    if sub_paths:
+      v = filter_response(v, sub_paths)
+      if v is not None:
+        out[key] = v
+  return out or None
+
+
+def filter_source(src, spec, includes=None, excludes=None):
+  "Applies _source filtering to src"
+  if spec is False or spec == 'false':
+    return None
+  if isinstance(spec, dict):
+    includes, excludes = spec.get('includes', includes), spec.get('excludes', excludes)
+  elif spec not in (None, True, 'true'):
+    includes = spec
+  includes, excludes = as_list(includes), as_list(excludes)
+  return {
+    key: value for key, value in src.items()
+    if (not includes or any(fnmatch(key, p) for p in includes))
+    and not any(fnmatch(key, p) for p in excludes)
+  }
+
+
+def max_edits(fuzziness, token):
+  if not fuzziness or fuzziness == '0':
+    return 0
+  if str(fuzziness).upper().startswith('AUTO'):
+    low, high = map(int, fuzziness[5:].split(',')) if ':' in fuzziness else (3, 6)
+    return 0 if len(token) < low else 1 if len(token) < high else 2
+  return int(fuzziness)
+
+
+def parse_field(field):
+  "Splits a field with a boost, like 'tags^3'"
+  name, _, boost = field.partition('^')
+  return name, float(boost or 1)
+
+
+def api(func):
+  """
+  Runs func like a request: after the simulated latency,
+  on a copy of the arguments and with filter_path and ignore applied
+  """
+  @functools.wraps(func)
+  async def wrapper(self, *args, filter_path=None, ignore=(), params=None, **kwargs):
+    await asyncio.sleep(self.client.latency)
+    for key in ('headers', 'request_timeout', 'doc_type'):
+      kwargs.pop(key, None)
+    kwargs |= params or {}
+    try:
+      r = func(
+        self, *map(to_json, args), **{key: to_json(value) for key, value in kwargs.items()}
+      )
+    except TransportError as e:
+      if e.status_code in as_list(ignore):
+        return e.info
+      raise
+    r = to_json(r)
+    if filter_path and isinstance(r, dict):
+      paths = [path.split('.') for p in as_list(filter_path) for path in p.split(',')]
+      r = filter_response(r, paths) or {}
+    return r
+  return wrapper
+
+
+class FakeIndex:
+  def __init__(self, name, settings=None, mappings=None):
+    self.name = name
+    self.settings = flatten(settings or {})
+    self.mappings = mappings or {}
+    self.docs: dict[str, dict] = {}
+    self.versions: dict[str, int] = {}
+    self.seq_no = 0
+    # indexed terms of each document by field, and the inverted index by field
+    # both are built when a field is first queried and kept up to date on writes
+    self.doc_terms: dict[str, dict[str, list]] = defaultdict(dict)
+    self.postings: dict[str, dict] = {}
+
+  def check_writable(self):
+    if self.settings.get('index.blocks.write') in (True, 'true'):
+      raise error(
+        AuthorizationException, 403, 'cluster_block_exception',
+        f'index [{self.name}] blocked by: [FORBIDDEN/8/index write (api)];'
+      )
+
+  def field_mapping(self, path):
+    name, _, sub = path.partition('.')
+    mapping = self.mappings.get('properties', {}).get(name)
+    if mapping is None:
+      for template in self.mappings.get('dynamic_templates', []):
+        (_, t), = template.items()
+        pattern = t.get('match', '*')
+        if t.get('match_pattern') == 'regex':
+          is_match = re.fullmatch(pattern, name)
+        else:
+          is_match = fnmatch(name, pattern)
+        if is_match:
+          mapping = t['mapping']
+          break
+      else:
+        mapping = DEFAULT_MAPPING
+    if sub:
+      return mapping.get('fields', {}).get(sub)
+    return mapping
+
+  def analyzer(self, mapping, search=False):
+    if mapping.get('type') != 'text':
+      return lambda value: [value]
+    name = mapping.get('analyzer', 'standard')
+    if search:
+      name = mapping.get('search_analyzer', name)
+    return ANALYZERS[name]
+
+  def normalize(self, mapping, value):
+    "Converts a value to the type of the field"
+    t = mapping.get('type')
+    if t == 'boolean':
+      return value in (True, 'true')
+    if t in ('long', 'integer', 'short', 'byte', 'float', 'double'):
+      return value if isinstance(value, (int, float)) else float(value)
+    return str(value)
+
+  def field_values(self, doc, name):
+    "Values of a field, including the ones copied into it with copy_to"
+    values = as_list(doc.get(name))
+    for key, value in doc.items():
+      mapping = self.field_mapping(key)
+      if mapping and name in as_list(mapping.get('copy_to')):
+        values = values + as_list(value)
+    return values
+
+  def terms(self, id, path):
+    "The indexed terms of a document's field"
+    cached = self.doc_terms[id]
+    if path in cached:
+      return cached[path]
+    mapping = self.field_mapping(path)
+    terms = []
+    if mapping is not None:
+      values = self.field_values(self.docs[id], path.partition('.')[0])
+      if not values and 'null_value' in mapping:
+        values = [mapping['null_value']]
+      if mapping.get('type') == 'text':
+        analyzer = self.analyzer(mapping)
+        terms = [term for value in values for term in analyzer(str(value))]
+      else:
+        ignore_above = mapping.get('ignore_above', float('inf'))
+        terms = [
+          self.normalize(mapping, value) for value in values
+          if value is not None and len(str(value)) <= ignore_above
+        ]
+    cached[path] = terms
+    return terms
+
+  def field_postings(self, path):
+    if path not in self.postings:
+      postings = defaultdict(set)
+      for id in self.docs:
+        for term in self.terms(id, path):
+          postings[term].add(id)
+      self.postings[path] = postings
+    return self.postings[path]
+
+  def put(self, id, doc):
+    "Stores a document, or deletes it if doc is None"
+    if id in self.docs:
+      for path, postings in self.postings.items():
+        for term in self.terms(id, path):
+          postings[term].discard(id)
+          if not postings[term]:
+            del postings[term]
+      self.doc_terms.pop(id, None)
+      del self.docs[id]
+    self.seq_no += 1
+    if doc is None:
+      self.versions[id] = self.versions.get(id, 0) + 1
+      return
+    self.docs[id] = doc
+    self.versions[id] = self.versions.get(id, 0) + 1
+    for path, postings in self.postings.items():
+      for term in self.terms(id, path):
+        postings[term].add(id)
+
+  def meta(self, id):
+    return {
+      '_index': self.name,
+      '_type': '_doc',
+      '_id': id,
+      '_version': self.versions.get(id, 1),
+      '_seq_no': self.seq_no,
+      '_primary_term': 1,
+    }
+
+  # queries return the score of each document in ids that matches
+
+  def run_query(self, query, ids):
+    if not query:
+      return dict.fromkeys(ids, 1.0)
+    (kind, body), = query.items()
+    func = getattr(self, f'query_{kind}', None)
+    if not func:
+      raise error(RequestError, 400, 'parsing_exception', f'unknown query [{kind}]')
+    return func(body, ids)
+
+  def query_match_all(self, body, ids):
+    return dict.fromkeys(ids, float(body.get('boost', 1)))
+
+  def query_match_none(self, body, ids):
+    return {}
+
+  def query_ids(self, body, ids):
+    return dict.fromkeys((id for id in body['values'] if id in ids), 1.0)
+
+  def query_bool(self, body, ids):
+    clauses = lambda key: as_list(body.get(key))
+    scores = dict.fromkeys(ids, 0.0)
+    # term filters are cheap and usually narrow down the most
+    for key in ('filter', 'must'):
+      for clause in sorted(clauses(key), key=lambda c: next(iter(c)) not in ('term', 'terms')):
+        matched = self.run_query(clause, scores.keys())
+        scores = {
+          id: scores[id] + (score if key == 'must' else 0) for id, score in matched.items()
+        }
+    for clause in clauses('must_not'):
+      matched = self.run_query(clause, scores.keys())
+      scores = {id: score for id, score in scores.items() if id not in matched}
+
+    should = clauses('should')
+    if should:
+      default_min = 0 if clauses('filter') or clauses('must') else 1
+      min_should = int(body.get('minimum_should_match', default_min))
+      counts = Counter()
+      for clause in should:
+        for id, score in self.run_query(clause, scores.keys()).items():
+          scores[id] += score
+          counts[id] += 1
+      scores = {id: score for id, score in scores.items() if counts[id] >= min_should}
+
+    boost = float(body.get('boost', 1))
+    return {id: score * boost for id, score in scores.items()}
+
+  def query_term(self, body, ids):
+    (path, value), = body.items()
+    boost = 1.0
+    if isinstance(value, dict):
+      boost, value = float(value.get('boost', 1)), value['value']
+    return self.query_terms({path: [value], 'boost': boost}, ids)
+
+  def query_terms(self, body, ids):
+    boost = float(body.get('boost', 1))
+    (path, values), = ((k, v) for k, v in body.items() if k != 'boost')
+    mapping = self.field_mapping(path)
+    if mapping is None:
+      return {}
+    postings = self.field_postings(path)
+    matched = set()
+    for value in values:
+      value = value if mapping.get('type') == 'text' else self.normalize(mapping, value)
+      matched |= postings.get(value, set())
+    return dict.fromkeys((id for id in ids if id in matched), boost)
+
+  def query_exists(self, body, ids):
+    return dict.fromkeys((id for id in ids if self.terms(id, body['field'])), 1.0)
+
+  def query_range(self, body, ids):
+    (path, bounds), = body.items()
+    checks = {
+      'gt': lambda v, b: v > b, 'gte': lambda v, b: v >= b,
+      'lt': lambda v, b: v < b, 'lte': lambda v, b: v <= b,
+    }
+    return dict.fromkeys(
+      (
+        id for id in ids
+        if any(
+          all(check(v, bounds[op]) for op, check in checks.items() if op in bounds)
+          for v in self.terms(id, path)
+        )
+      ),
+      float(bounds.get('boost', 1))
+    )
+
+  def query_match(self, body, ids):
+    (path, options), = body.items()
+    if not isinstance(options, dict):
+      options = {'query': options}
+    return self.query_multi_match(options | {'fields': [path]}, ids)
+
+  def query_multi_match(self, body, ids):
+    most_fields = body.get('type') == 'most_fields'
+    scores = {}
+    for field in body['fields']:
+      path, boost = parse_field(field)
+      field_scores = self.match_text(
+        path, str(body['query']), body.get('operator', 'or').lower() == 'and',
+        body.get('fuzziness'), body.get('prefix_length', 0), ids
+      )
+      for id, score in field_scores.items():
+        score *= boost
+        if most_fields:
+          scores[id] = scores.get(id, 0) + score
+        else:
+          scores[id] = max(scores.get(id, 0), score)
+    return scores
+
+  def match_text(self, path, text, require_all, fuzziness, prefix_length, ids):
+    "Each query term that a document contains (within fuzziness) scores 1"
+    mapping = self.field_mapping(path)
+    if mapping is None:
+      return {}
+    tokens = list(dict.fromkeys(self.analyzer(mapping, search=True)(text)))
+    if not tokens:
+      return {}
+    postings = self.field_postings(path)
+    counts = Counter()
+    for token in tokens:
+      limit = max_edits(fuzziness, token) if isinstance(token, str) else 0
+      matched = set(postings.get(token, ()))
+      if limit:
+        for term, term_ids in postings.items():
+          if (
+            term[:prefix_length] == token[:prefix_length]
+            and edit_distance(token, term, limit) <= limit
+          ):
+            matched |= term_ids
+      counts.update(matched)
+    min_count = len(tokens) if require_all else 1
+    return {
+      id: float(counts[id]) for id in ids if counts[id] >= min_count
+    }
+
+  def sort_values(self, id, path, descending):
+    values = self.terms(id, path)
+    if not values:
+      return None
+    return max(values) if descending else min(values)
+
+  def sort(self, scored, sort):
+    """Sorts (id, score) pairs, returns them with the sort values of each"""
+    specs = []
+    for spec in as_list(sort):
+      if isinstance(spec, str):
+        path, order = spec, 'desc' if spec == '_score' else 'asc'
+      else:
+        (path, order), = spec.items()
+        if isinstance(order, dict):
+          order = order.get('order', 'desc' if path == '_score' else 'asc')
+      specs.append((path, order == 'desc'))
+    if not specs:
+      specs = [('_score', True)]
+
+    positions = {id: i for i, id in enumerate(self.docs)}
+    rows = []
+    for id, score in scored.items():
+      values = []
+      for path, descending in specs:
+        if path == '_score':
+          values.append(score)
+        elif path == '_doc':
+          values.append(positions[id])
+        else:
+          values.append(self.sort_values(id, path, descending))
+      rows.append((id, score, values))
+
+    # stable sorts from the last key to the first, missing values go last
+    rows.sort(key=lambda row: positions[row[0]])
+    for i, (path, descending) in reversed(list(enumerate(specs))):
+      present = [row for row in rows if row[2][i] is not None]
+      missing = [row for row in rows if row[2][i] is None]
+      present.sort(key=lambda row: row[2][i], reverse=descending)
+      rows = present + missing
+    return rows, [path for path, _ in specs]
+
+  def run_aggs(self, aggs, ids):
+    out = {}
+    for name, spec in aggs.items():
+      sub_aggs = spec.get('aggs') or spec.get('aggregations') or {}
+      (kind, body), = ((k, v) for k, v in spec.items() if k not in ('aggs', 'aggregations', 'meta'))
+      if kind == 'filter':
+        matched = list(self.run_query(body, ids))
+        out[name] = {'doc_count': len(matched)} | self.run_aggs(sub_aggs, matched)
+      elif kind == 'terms':
+        out[name] = self.terms_agg(body, sub_aggs, ids)
+      elif kind == 'value_count':
+        out[name] = {'value': sum(len(self.terms(id, body['field'])) for id in ids)}
+      else:
+        raise error(RequestError, 400, 'parsing_exception', f'unknown aggregation [{kind}]')
+    return out
+
+  def terms_agg(self, body, sub_aggs, ids):
+    mapping = self.field_mapping(body['field']) or {}
+    if mapping.get('type') == 'text':
+      raise error(
+        RequestError, 400, 'illegal_argument_exception',
+        f'Text fields are not optimised for operations that require per-document field data '
+        f'like aggregations and sorting, so these operations are disabled by default. '
+        f'Please use a keyword field instead.'
+      )
+    bucket_ids = defaultdict(list)
+    for id in ids:
+      for term in set(self.terms(id, body['field'])):
+        bucket_ids[term].append(id)
+    keys = sorted(bucket_ids, key=lambda key: (-len(bucket_ids[key]), key))
+    size = body.get('size', 10)
+    buckets = []
+    for key in keys[:size]:
+      bucket = {'key': key, 'doc_count': len(bucket_ids[key])}
+      if mapping.get('type') == 'boolean':
+        bucket = {'key': int(key), 'key_as_string': str(key).lower(), 'doc_count': bucket['doc_count']}
+      buckets.append(bucket | self.run_aggs(sub_aggs, bucket_ids[key]))
+    return {
+      'doc_count_error_upper_bound': 0,
+      'sum_other_doc_count': sum(len(bucket_ids[key]) for key in keys[size:]),
+      'buckets': buckets,
+    }
+
+  def docvalues(self, id, fields):
+    out = {}
+    for field in fields:
+      path = field['field'] if isinstance(field, dict) else field
+      mapping = self.field_mapping(path) or {}
+      if mapping.get('type') == 'text':
+        raise error(
+          RequestError, 400, 'illegal_argument_exception',
+          f'Can\'t load fielddata on [{path}] because fielddata is unsupported on fields of type [text].'
+        )
+      values = self.terms(id, path)
+      if values:
+        out[path] = sorted(values)
+    return out
+
+
+class FakeNamespace:
+  def __init__(self, client):
+    self.client = client
+
+
+class FakeIndicesClient(FakeNamespace):
+  @api
+  def create(self, index, body=None, settings=None, mappings=None, **params):
+    body = body or {}
+    if index in self.client.indices_:
+      raise error(
+        RequestError, 400, 'resource_already_exists_exception',
+        f'index [{index}] already exists', index=index
+      )
+    self.client.indices_[index] = FakeIndex(
+      index, settings or body.get('settings'), mappings or body.get('mappings')
+    )
+    return {'acknowledged': True, 'shards_acknowledged': True, 'index': index}
+
+  @api
+  def delete(self, index, **params):
+    for name in index.split(','):
+      self.client.get_index(name)
+      del self.client.indices_[name]
+    return {'acknowledged': True}
+
+  @api
+  def exists(self, index, **params):
+    return all(name in self.client.indices_ for name in index.split(','))
+
+  @api
+  def refresh(self, index=None, **params):
+    return {'_shards': SHARDS}
+
+  @api
+  def put_settings(self, body=None, index=None, settings=None, **params):
+    body = settings or body or {}
+    idx = self.client.get_index(index)
+    idx.settings |= flatten(body.get('settings', body))
+    return {'acknowledged': True}
+
+  @api
+  def get_settings(self, index, **params):
+    idx = self.client.get_index(index)
+    return {index: {'settings': idx.settings}}
+
+  @api
+  def get_mapping(self, index, **params):
+    idx = self.client.get_index(index)
+    return {index: {'mappings': idx.mappings}}
+
+  @api
+  def forcemerge(self, index=None, **params):
+    return {'_shards': SHARDS}
+
+  @api
+  def stats(self, index=None, metric=None, **params):
+    """Document counts, the store size is the size of the sources as json"""
+    names = index.split(',') if index else list(self.client.indices_)
+    indices = {}
+    for name in names:
+      idx = self.client.get_index(name)
+      stats = {
+        'docs': {'count': len(idx.docs), 'deleted': 0},
+        'store': {'size_in_bytes': sum(len(json.dumps(doc)) for doc in idx.docs.values())},
+      }
+      indices[name] = {'primaries': stats, 'total': stats}
+    total = {
+      'docs': {
+        'count': sum(i['primaries']['docs']['count'] for i in indices.values()),
+        'deleted': 0
+      },
+      'store': {
+        'size_in_bytes': sum(i['primaries']['store']['size_in_bytes'] for i in indices.values())
+      },
+    }
+    return {'_shards': SHARDS, '_all': {'primaries': total, 'total': total}, 'indices': indices}
+
+  @api
+  def clone(self, index, target, body=None, **params):
+    source = self.client.get_index(index)
+    if source.settings.get('index.blocks.write') not in (True, 'true'):
+      raise error(
+        RequestError, 400, 'illegal_state_exception',
+        f'index {index} must be read-only to resize index. use "index.blocks.write=true"'
+      )
+    clone = FakeIndex(target, mappings=copy.deepcopy(source.mappings))
+    clone.settings = {
+      key: value for key, value in source.settings.items() if key != 'index.blocks.write'
+    }
+    for id, doc in source.docs.items():
+      clone.put(id, copy.deepcopy(doc))
+    self.client.indices_[target] = clone
+    return {'acknowledged': True, 'shards_acknowledged': True, 'index': target}
+
+
+class FakeClusterClient(FakeNamespace):
+  @api
+  def health(self, index=None, **params):
+    return {
+      'cluster_name': 'fake',
+      'status': 'green',
+      'timed_out': False,
+      'number_of_nodes': 1,
+      'active_shards': len(self.client.indices_),
+    }
+
+
+class FakeNodesClient(FakeNamespace):
+  @api
+  def stats(self, node_id=None, metric=None, **params):
+    return {'_nodes': {'total': 0, 'successful': 0, 'failed': 0}, 'nodes': {}}
+
+
+class FakeSecurityClient(FakeNamespace):
+  @api
+  def put_role(self, name, body=None, **params):
+    created = name not in self.client.roles
+    self.client.roles[name] = body
+    return {'role': {'created': created}}
+
+  @api
+  def put_user(self, username, body=None, **params):
+    created = username not in self.client.users
+    self.client.users[username] = body
+    return {'created': created}
+
+
+class FakeTasksClient(FakeNamespace):
+  @api
+  def get(self, task_id, **params):
+    if task_id not in self.client.tasks_:
+      raise error(
+        NotFoundError, 404, 'resource_not_found_exception',
+        f'task [{task_id}] isn\'t running and hasn\'t stored its results'
+      )
+    return self.client.tasks_[task_id]
+
+
+class FakeElasticsearch:
+  """
+  Drop-in replacement for AsyncElasticsearch that keeps everything in memory
+  latency is awaited before each request to simulate the round trip
+  """
+  def __init__(self, latency: float = 0):
+    self.latency = latency
+    self.client = self
+    # used by elasticsearch.helpers
+    self.transport = SimpleNamespace(serializer=JSONSerializer())
+    self.indices_: dict[str, FakeIndex] = {}
+    self.scripts: dict[str, dict] = {}
+    self.roles, self.users = {}, {}
+    self.indices = FakeIndicesClient(self)
+    self.cluster = FakeClusterClient(self)
+    self.nodes = FakeNodesClient(self)
+    self.security = FakeSecurityClient(self)
+    self.tasks = FakeTasksClient(self)
+    # results of the *_by_query requests made with wait_for_completion=false
+    self.tasks_: dict[str, dict] = {}
+
+  def get_index(self, index) -> FakeIndex:
+    if index not in self.indices_:
+      raise error(
+        NotFoundError, 404, 'index_not_found_exception',
+        f'no such index [{index}]', index=index
+      )
+    return self.indices_[index]
+
+  def get_write_index(self, index) -> FakeIndex:
+    "Like get_index, but creates missing indices like elasticsearch does"
+    if index not in self.indices_:
+      self.indices_[index] = FakeIndex(index)
+    idx = self.indices_[index]
+    idx.check_writable()
+    return idx
+
+  def run_script(self, script, src):
+    """Runs a script on src in place, returns False if it set ctx.op = 'noop'"""
+    if 'id' in script:
+      if script['id'] not in self.scripts:
+        raise error(
+          NotFoundError, 404, 'resource_not_found_exception',
+          f'unable to find script [{script["id"]}] in cluster state'
+        )
+      source = self.scripts[script['id']]['source']
+    else:
+      source = script['source']
+    func = SCRIPTS.get(source)
+    if not func:
+      raise error(RequestError, 400, 'script_exception', 'script is not supported by fake_es')
+    try:
+      return func(src, script.get('params', {})) is not False
+    except ValueError as e:
+      raise RequestError(400, 'illegal_argument_exception', {
+        'error': {
+          'type': 'illegal_argument_exception',
+          'reason': 'failed to execute script',
+          'caused_by': {
+            'type': 'script_exception',
+            'reason': 'runtime error',
+            'caused_by': {'type': 'illegal_argument_exception', 'reason': str(e)}
+          }
+        },
+        'status': 400
+      })
+
+  async def close(self):
+    pass
+
+  @api
+  def ping(self, **params):
+    return True
+
+  @api
+  def info(self, **params):
+    return {'name': 'fake', 'version': {'number': '7.17.0'}, 'tagline': 'You Know, for Search'}
+
+  @api
+  def put_script(self, id, body=None, script=None, **params):
+    self.scripts[id] = script or body['script']
+    return {'acknowledged': True}
+
+  @api
+  def get(self, index, id, _source=None, _source_includes=None, _source_excludes=None, **params):
+    idx = self.get_index(index)
+    if id not in idx.docs:
+      raise NotFoundError(404, 'not_found', {'_index': index, '_type': '_doc', '_id': id, 'found': False})
+    r = idx.meta(id) | {'found': True}
+    src = filter_source(idx.docs[id], _source, _source_includes, _source_excludes)
+    if src is not None:
+      r['_source'] = src
+    return r
+
+  @api
+  def exists(self, index, id, **params):
+    return index in self.indices_ and id in self.indices_[index].docs
+
+  def write(self, index, id, doc, op_type='index'):
+    idx = self.get_write_index(index)
+    if id is None:
+      id = uuid.uuid4().hex
+    created = id not in idx.docs
+    if op_type == 'create' and not created:
+      raise error(
+        ConflictError, 409, 'version_conflict_engine_exception',
+        f'[{id}]: version conflict, document already exists'
+      )
+    idx.put(id, doc)
+    return idx.meta(id) | {
+      'result': 'created' if created else 'updated', '_shards': SHARDS
+    }
+
+  @api
+  def index(self, index, body=None, id=None, document=None, op_type='index', **params):
+    return self.write(index, id, document or body, op_type)
+
+  @api
+  def create(self, index, id, body=None, document=None, **params):
+    return self.write(index, id, document or body, 'create')
+
+  def run_update(self, index, id, body):
+    idx = self.get_write_index(index)
+    old = idx.docs.get(id)
+    script = body.get('script')
+    if old is None:
+      if body.get('doc_as_upsert') and 'doc' in body:
+        new = body['doc']
+      elif 'upsert' in body:
+        new = body['upsert']
+        if script and body.get('scripted_upsert'):
+          if not self.run_script(script, new):
+            return idx.meta(id) | {'result': 'noop', '_shards': SHARDS}, None
+      else:
+        raise error(
+          NotFoundError, 404, 'document_missing_exception',
+          f'[_doc][{id}]: document missing', index=index
+        )
+      result = 'created'
+    else:
+      new = copy.deepcopy(old)
+      if script:
+        is_noop = not self.run_script(script, new)
+      else:
+        new |= body.get('doc', {})
+        is_noop = body.get('detect_noop', True) and new == old
+      if is_noop:
+        return idx.meta(id) | {'result': 'noop', '_shards': SHARDS}, old
+      result = 'updated'
+    idx.put(id, new)
+    return idx.meta(id) | {'result': result, '_shards': SHARDS}, new
+
+  @api
+  def update(self, index, id, body=None, _source=None, **params):
+    body = (body or {}) | {
+      key: params.pop(key) for key in list(params)
+      if key in ('doc', 'upsert', 'script', 'doc_as_upsert', 'scripted_upsert', 'detect_noop')
+    }
+    r, doc = self.run_update(index, id, body)
+    if _source not in (None, False, 'false') and doc is not None:
+      r['get'] = {'found': True, '_source': filter_source(doc, _source)}
+    return r
+
+  @api
+  def delete(self, index, id, **params):
+    idx = self.get_index(index)
+    if id not in idx.docs:
+      raise NotFoundError(404, 'not_found', idx.meta(id) | {'result': 'not_found'})
+    idx.check_writable()
+    idx.put(id, None)
+    return idx.meta(id) | {'result': 'deleted', '_shards': SHARDS}
+
+  def lookup_terms(self, lookup):
+    "Values of a terms lookup, from the source of the looked up document"
+    if lookup['index'] not in self.indices_:
+      raise error(
+        NotFoundError, 404, 'index_not_found_exception',
+        f'no such index [{lookup["index"]}]', index=lookup['index']
+      )
+    value = self.indices_[lookup['index']].docs.get(lookup['id'], {})
+    for key in lookup['path'].split('.'):
+      value = value.get(key) if isinstance(value, dict) else None
+    return as_list(value)
+
+  def resolve_lookups(self, body):
+    "Replaces the terms lookups in a query or aggregations with their values"
+    if isinstance(body, list):
+      return [self.resolve_lookups(item) for item in body]
+    if not isinstance(body, dict):
+      return body
+    out = {}
+    for key, value in body.items():
+      if key == 'terms' and isinstance(value, dict):
+        value = {
+          path: self.lookup_terms(terms) if is_lookup(terms) else terms
+          for path, terms in value.items()
+        }
+      out[key] = self.resolve_lookups(value)
+    return out
+
+  def matching(self, index, body):
+    "Returns the index and the score of each matching document"
+    idx = self.get_index(index)
+    return idx, idx.run_query(self.resolve_lookups(body.get('query')), idx.docs.keys())
+
+  @api
+  def search(self, body=None, index=None, **params):
+    start = time.perf_counter()
+    body = (body or {}) | params
+    if 'from_' in body:
+      body['from'] = body.pop('from_')
+    idx, scores = self.matching(index, body)
+
+    rows, sort_paths = idx.sort(scores, body.get('sort'))
+    offset, size = int(body.get('from', 0)), int(body.get('size', 10))
+    sorted_by_score = '_score' in sort_paths
+    hits = []
+    for id, score, values in rows[offset:offset + size]:
+      hit = {
+        '_index': index,
+        '_type': '_doc',
+        '_id': id,
+        '_score': score if sorted_by_score else None,
+      }
+      src = filter_source(
+        idx.docs[id], body.get('_source'),
+        body.get('_source_includes'), body.get('_source_excludes')
+      )
+      if src is not None:
+        hit['_source'] = src
+      if body.get('docvalue_fields'):
+        hit['fields'] = idx.docvalues(id, body['docvalue_fields'])
+      if body.get('sort'):
+        hit['sort'] = values
+      hits.append(hit)
+
+    total = len(scores)
+    track_total_hits = body.get('track_total_hits', DEFAULT_TRACK_TOTAL_HITS)
+    if track_total_hits is True or track_total_hits == 'true':
+      track_total_hits = total
+    r = {
+      'took': round((time.perf_counter() - start) * 1000),
+      'timed_out': False,
+      '_shards': SHARDS,
+      'hits': {
+        'total': {
+          'value': min(total, int(track_total_hits)),
+          'relation': 'eq' if total <= int(track_total_hits) else 'gte',
+        },
+        'max_score': max(scores.values(), default=None) if sorted_by_score else None,
+        'hits': hits,
+      }
+    }
+    aggs = body.get('aggs') or body.get('aggregations')
+    if aggs:
+      r['aggregations'] = idx.run_aggs(self.resolve_lookups(aggs), list(scores))
+    return r
+
+  @api
+  def count(self, body=None, index=None, **params):
+    _, scores = self.matching(index, (body or {}) | params)
+    return {'count': len(scores), '_shards': SHARDS}
+
+  def by_query_response(self, start, total, **counts):
+    return {
+      'took': round((time.perf_counter() - start) * 1000),
+      'timed_out': False,
+      'total': total,
+      'updated': 0,
+      'deleted': 0,
+      'batches': 1 if total else 0,
+      'version_conflicts': 0,
+      'noops': 0,
+      'retries': {'bulk': 0, 'search': 0},
+      'throttled_millis': 0,
+      'requests_per_second': -1.0,
+      'throttled_until_millis': 0,
+      'failures': [],
+    } | counts
+
+  def as_task(self, action, body, response):
+    """
+    Returns response, or the id of a completed task with it like elasticsearch
+    does for requests made with wait_for_completion=false
+    """
+    if str(body.get('wait_for_completion', True)).lower() != 'false':
+      return response
+    task_id = f'fake:{len(self.tasks_) + 1}'
+    status = {
+      key: response[key] for key in
+      ('total', 'updated', 'created', 'deleted', 'batches', 'version_conflicts', 'noops')
+      if key in response
+    }
+    self.tasks_[task_id] = {
+      'completed': True,
+      'task': {'node': 'fake', 'id': len(self.tasks_) + 1, 'action': action, 'status': status},
+      'response': response,
+    }
+    return {'task': task_id}
+
+  @api
+  def update_by_query(self, index, body=None, **params):
+    start = time.perf_counter()
+    body = (body or {}) | params
+    idx, scores = self.matching(index, body)
+    idx.check_writable()
+    updated = noops = 0
+    for id in list(scores):
+      doc = copy.deepcopy(idx.docs[id])
+      if body.get('script') and not self.run_script(body['script'], doc):
+        noops += 1
+        continue
+      idx.put(id, doc)
+      updated += 1
+    return self.as_task(
+      'indices:data/write/update/byquery', body,
+      self.by_query_response(start, len(scores), updated=updated, noops=noops)
+    )
+
+  @api
+  def delete_by_query(self, index, body=None, **params):
+    start = time.perf_counter()
+    body = (body or {}) | params
+    idx, scores = self.matching(index, body)
+    idx.check_writable()
+    for id in list(scores):
+      idx.put(id, None)
+    return self.as_task(
+      'indices:data/write/delete/byquery', body,
+      self.by_query_response(start, len(scores), deleted=len(scores))
+    )
+
+  @api
+  def reindex(self, body=None, **params):
+    start = time.perf_counter()
+    body = (body or {}) | params
+    source, dest = body['source'], body['dest']
+    idx, scores = self.matching(source['index'], source)
+    created = updated = 0
+    for id in list(scores):
+      r = self.write(dest['index'], id, copy.deepcopy(idx.docs[id]))
+      created += r['result'] == 'created'
+      updated += r['result'] == 'updated'
+    return self.by_query_response(start, len(scores), created=created, updated=updated)
+
+  @api
+  def bulk(self, body, index=None, **params):
+    start = time.perf_counter()
+    if isinstance(body, (str, bytes)):
+      body = body.decode() if isinstance(body, bytes) else body
+      lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+    else:
+      lines = [json.loads(line) if isinstance(line, (str, bytes)) else line for line in body]
+
+    items = []
+    lines = iter(lines)
+    for action in lines:
+      (op, meta), = action.items()
+      target, id = meta.get('_index', index), meta.get('_id')
+      try:
+        if op == 'delete':
+          idx = self.get_index(target)
+          if id in idx.docs:
+            idx.check_writable()
+            idx.put(id, None)
+            r = idx.meta(id) | {'result': 'deleted', 'status': 200}
+          else:
+            r = idx.meta(id) | {'result': 'not_found', 'status': 404}
+        elif op == 'update':
+          r, _ = self.run_update(target, id, next(lines))
+          r['status'] = 201 if r['result'] == 'created' else 200
+        else:
+          r = self.write(target, id, next(lines), op)
+          r['status'] = 201 if r['result'] == 'created' else 200
+      except TransportError as e:
+        r = {'_index': target, '_type': '_doc', '_id': id, 'status': e.status_code}
+        r['error'] = e.info.get('error') if isinstance(e.info, dict) else e.error
+      items.append({op: r})
+    return {
+      'took': round((time.perf_counter() - start) * 1000),
+      'errors': any('error' in r for item in items for r in item.values()),
+      'items': items,
+    }
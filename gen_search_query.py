@@ -2,45 +2,122 @@ from elasticsearch_dsl import Search
 from elasticsearch_dsl.query import MultiMatch, Terms, Bool, Term
 
 from query_parser import ParsedQuery
+from constants import INDEX
+from analysis import analyze, MIN_GRAM
 
-fuzzy_match = lambda fields, values: MultiMatch(
+fuzzy_match = lambda fields, values, fuzziness='AUTO:4,6': MultiMatch(
   query=' '.join(values),
   type='most_fields',
   fields=fields,
   operator='and',
-  fuzziness='AUTO:4,6',  # disable fuzzy for trigrams
+  fuzziness=fuzziness,  # AUTO:4,6 disables fuzzy for trigrams
   prefix_length=1
 )
 
-fuzzy_ngram = lambda fields, values: fuzzy_match(
-  [
-    f for field in fields for f in
-    [f'{field}^3', f'{field}.prefix_ngram^2', f'{field}.trigram']
-  ],
-  values
+NGRAM_SUBFIELDS = ['^3', '.prefix_ngram^2', '.trigram']
+fuzzy_ngram = lambda fields, values, subfields=NGRAM_SUBFIELDS, **kwargs: fuzzy_match(
+  [f'{field}{subfield}' for field in fields for subfield in subfields],
+  values,
+  **kwargs
 )
 
-field_queries = {
-  'tags': lambda f, v: fuzzy_ngram([f, 'title'], v),
-  'filename': lambda f, v: fuzzy_ngram([f, 'title'], v),
-  'pack_name': lambda f, v: fuzzy_ngram([f], v),
-  'ext': lambda f, v: fuzzy_match([f], v),
-  'is_animated': lambda f, v: Bool(filter=[Term(is_animated=v[0] == 'yes')]),
-  'marked': lambda f, v: Bool(filter=[Term(marked=v[0] == 'yes')]),
-  'emoji': lambda f, v: Terms(emoji=v)
+# tags, title, filename and pack_name are copied into it
+SEARCH_TEXT_FIELDS = ['search_text']
+# query fields that are matched against text and scored
+TEXT_QUERY_FIELDS = {'tags', 'filename', 'pack_name'}
+
+def make_field_queries(text_query, tags_fields=SEARCH_TEXT_FIELDS):
+  """
+  Query generators for each field, text_query is used for the text fields
+  and plain tags search tags_fields
+  """
+  return {
+    'tags': lambda f, v: text_query(tags_fields, v),
+    'filename': lambda f, v: text_query([f, 'title'], v),
+    'pack_name': lambda f, v: text_query([f], v),
+    'ext': lambda f, v: fuzzy_match([f], v),
+    'is_animated': lambda f, v: Bool(filter=[Term(is_animated=v[0] == 'yes')]),
+    'emoji': lambda f, v: Terms(emoji=v)
+  }
+
+field_queries = make_field_queries(fuzzy_ngram)
+
+# alternatives to field_queries, compared by scripts/bench_mapping.py
+QUERY_SHAPES = {
+  'default': field_queries,
+  # tags and title fields instead of search_text, the shape before it was added
+  'legacy': make_field_queries(fuzzy_ngram, ['tags', 'title']),
+  'no_trigram': make_field_queries(
+    lambda fields, values: fuzzy_ngram(fields, values, ['^3', '.prefix_ngram^2'])
+  ),
+  'no_fuzzy': make_field_queries(
+    lambda fields, values: fuzzy_ngram(fields, values, fuzziness=0)
+  ),
+  # the cheaper shapes picked by plan_query
+  'exact': make_field_queries(
+    lambda fields, values: fuzzy_ngram(fields, values, ['^3'], fuzziness=0)
+  ),
+  'prefix': make_field_queries(
+    lambda fields, values: fuzzy_ngram(fields, values, ['^3', '.prefix_ngram^2'], fuzziness=0)
+  ),
 }
 
+# shape used by each plan, the name of the plan is added to the search stats groups
+PLAN_SHAPES = {
+  # nothing to score, sorted by last_used
+  'recent': 'default',
+  # the tokens are too short for fuzziness and the ngram subfields
+  'exact': 'exact',
+  'prefix': 'prefix',
+  'fuzzy': 'default',
+}
+# tried when a plan doesn't fill the first page, the fallback matches a superset
+FALLBACK_PLANS = {'prefix': 'fuzzy'}
+
+
+def get_text_values(query: ParsedQuery):
+  return [
+    value
+    for (field, is_neg), values in query.fields.items()
+    if field in TEXT_QUERY_FIELDS and not is_neg
+    for value in values
+  ]
+
+
+def plan_query(query: ParsedQuery):
+  """Returns the cheapest plan worth trying first for query"""
+  tokens = analyze(' '.join(get_text_values(query)))
+  if not tokens:
+    return 'recent'
+  if all(len(token) < MIN_GRAM for token in tokens):
+    return 'exact'
+  return 'prefix'
+
+
+def selection_filter(owner: int):
+  """Matches the documents in the export selection of owner, with a terms lookup"""
+  return Terms(id={'index': INDEX.selection, 'id': str(owner), 'path': 'ids'})
+
+
 def gen_search_query(
   owner,
   query: ParsedQuery,
   initial_q=None,
   sort=True,
   includes=[],
+  shape='default',
+  plan=None,
 ):
   q = initial_q if initial_q else Search().filter('term', owner=owner)
 
-  if sort:
+  if plan:
+    shape = PLAN_SHAPES[plan]
+    q = q.extra(stats=[plan])
+  if sort and get_text_values(query):
     q = q.sort('_score', '-last_used')
+  elif sort:
+    # every score would be about the same, sort on doc values only
+    q = q.sort('-last_used')
   if includes:
     q = q.source(includes=includes)
 
@@ -51,7 +128,16 @@ def gen_search_query(
     q = q.filter('term', type=search_type)
 
   for (field, is_neg), values in query.fields.items():
-    func = field_queries.get(field)
+    if field == 'marked':
+      sub_q = Bool(filter=[selection_filter(owner)])
+      q = q.query(sub_q if (values[0] == 'yes') != is_neg else ~sub_q)
+      continue
+    # the planned shapes exclude with the full shape,
+    # so that the cheaper plans match a subset of the fallback
+    if is_neg and shape in PLAN_SHAPES.values():
+      func = field_queries.get(field)
+    else:
+      func = QUERY_SHAPES[shape].get(field)
     if not func:
       continue
     sub_q = func(field, values)
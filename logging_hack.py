@@ -14,6 +14,8 @@ from urllib.parse import unquote
 from elasticsearch import AsyncElasticsearch as es, AsyncTransport, AIOHttpConnection
 
 from data_model import DocumentID
+from constants import OFFLOAD_MIN_BYTES
+import offload
 
 
 logger = logging.getLogger('es_req')
@@ -33,7 +35,18 @@ def extract_user_id(path, body):
   return
 
 
+def in_background_if_large(log):
+  """Large bodies are searched for the user id in a thread, the request doesn't wait for it"""
+  def wrapper(self, method, full_url, path, body, *args, **kwargs):
+    if body is not None and len(body) >= OFFLOAD_MIN_BYTES:
+      offload.thread_pool.submit(log, self, method, full_url, path, body, *args, **kwargs)
+    else:
+      log(self, method, full_url, path, body, *args, **kwargs)
+  return wrapper
+
+
 class AIOHttpConnectionLogUID(AIOHttpConnection):
+  @in_background_if_large
   def log_request_success(
     self, method, full_url, path, body, status_code, response, duration
   ):
@@ -48,6 +61,7 @@ class AIOHttpConnectionLogUID(AIOHttpConnection):
       f'{method} {path} [u:{user_id or "NA"} s:{status_code} t:{duration:.3f}s]'
     )
 
+  @in_background_if_large
   def log_request_fail(
     self, method, full_url, path, body, duration,
     status_code=None, response=None, exception=None,
@@ -64,7 +78,7 @@ class AIOHttpConnectionLogUID(AIOHttpConnection):
     user_id = extract_user_id(path, body)
     logger.warning(
       f'{method} {path} [u:{user_id or "NA"} s:{status_code or "NA"} t:{duration:.3f}s]',
-      exc_info=exception is not None,
+      exc_info=exception,
     )
 
 
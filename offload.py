@@ -0,0 +1,52 @@
+# Runs cpu-bound work outside of the event loop, so that a large export or
+# sticker set doesn't delay everyone else's inline queries
+# small inputs run right away, handing them over costs more than the work itself
+# threads suit python code, which lets the loop run between its bytecodes,
+# single calls into C that hold the GIL the whole time (like json) need a process
+
+import json
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from constants import OFFLOAD_THREADS, OFFLOAD_PROCESSES, OFFLOAD_MIN_ITEMS
+
+
+thread_pool = ThreadPoolExecutor(OFFLOAD_THREADS, thread_name_prefix='offload')
+process_pool: ProcessPoolExecutor = None
+
+
+def get_process_pool():
+  global process_pool
+  if not process_pool:
+    # forking the bot would copy its threads and open connections into the workers,
+    # they start from a clean process instead, which imports the modules of
+    # the functions they run (and bot.py, without running it)
+    process_pool = ProcessPoolExecutor(
+      OFFLOAD_PROCESSES, mp_context=multiprocessing.get_context('forkserver')
+    )
+  return process_pool
+
+
+async def run(func, *args, size: int, min_size: int, process=False, **kwargs):
+  """
+  Returns func(*args, **kwargs), which runs in an executor if size reaches min_size
+  With process, func and its arguments have to be picklable, and func's
+  module importable without side effects
+  """
+  if size < min_size:
+    return func(*args, **kwargs)
+  executor = get_process_pool() if process else thread_pool
+  return await asyncio.get_running_loop().run_in_executor(
+    executor, functools.partial(func, *args, **kwargs)
+  )
+
+
+def encode_json(obj) -> bytes:
+  return json.dumps(obj, sort_keys=True).encode('utf-8')
+
+
+async def dumps(obj: list) -> bytes:
+  """Encodes a list of documents as json, like an export"""
+  return await run(encode_json, obj, size=len(obj), min_size=OFFLOAD_MIN_ITEMS, process=True)
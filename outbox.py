@@ -0,0 +1,198 @@
+# Outbound messages, sent through a queue for each chat so that bulk operations
+# don't run into flood waits: token buckets limit the rate for each chat and
+# for the whole bot, and a flood wait pauses the chat until the message can be retried
+# messages with the same key that follow each other are merged into one message
+# that is edited in place, see send
+
+import time
+import asyncio
+import logging
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Any
+
+from telethon import utils as tl_utils
+from telethon.errors import FloodWaitError, MessageNotModifiedError
+
+import proxy_globals
+from constants import (
+  MAX_MESSAGE_LENGTH, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, OUTBOX_GLOBAL_RATE,
+  OUTBOX_GLOBAL_BURST, OUTBOX_COALESCE_TIME, OUTBOX_MAX_CHATS
+)
+
+
+class TokenBucket:
+  def __init__(self, rate: float, burst: int):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.updated = time.monotonic()
+    self.paused_until = 0
+
+  def wait_time(self):
+    now = time.monotonic()
+    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+    if now < self.paused_until:
+      return self.paused_until - now
+    return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+  async def take(self):
+    while (delay := self.wait_time()) > 0:
+      await asyncio.sleep(delay)
+    self.tokens -= 1
+
+  def pause(self, seconds: float):
+    self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+@dataclass
+class Outgoing:
+  text: str
+  kwargs: dict
+  key: str = None
+  # add the text to the previous message with the same key instead of replacing it
+  append: bool = False
+  futures: list[asyncio.Future] = field(default_factory=list)
+
+  def merged_text(self, text: str):
+    """The text of this message after text that was sent before, None if it's too long"""
+    if not self.append:
+      return self.text
+    text = f'{text}\n\n{self.text}'
+    return text if len(text) <= MAX_MESSAGE_LENGTH else None
+
+  def merge(self, other: 'Outgoing'):
+    """Merges a message that was queued after this one, returns False if it can't be"""
+    text = other.merged_text(self.text)
+    if text is None:
+      return False
+    self.text = text
+    if not other.append:
+      # still a reply to what the first message replied to
+      reply_to = self.kwargs.get('reply_to')
+      self.kwargs = other.kwargs if reply_to is None else {**other.kwargs, 'reply_to': reply_to}
+    self.futures += other.futures
+    return True
+
+  def resolve(self, message=None, exception=None):
+    for future in self.futures:
+      if future.done():
+        continue
+      if exception:
+        future.set_exception(exception)
+      else:
+        future.set_result(message)
+
+
+@dataclass
+class Sent:
+  "The last message sent to a chat, the next one with the same key edits it"
+  key: str
+  message: Any
+  text: str
+  buttons: Any = None
+  time: float = field(default_factory=time.monotonic)
+
+
+logger = logging.getLogger('outbox')
+global_bucket = TokenBucket(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_BURST)
+# "sent", "edited", "merged", "flood_waits" and "errors"
+stats = Counter()
+
+
+class ChatOutbox:
+  def __init__(self, chat):
+    self.chat = chat
+    self.bucket = TokenBucket(OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST)
+    self.queue: deque[Outgoing] = deque()
+    self.worker: asyncio.Task = None
+    self.last: Sent = None
+
+  @property
+  def is_idle(self):
+    return not self.worker and (
+      not self.last or time.monotonic() - self.last.time > OUTBOX_COALESCE_TIME
+    )
+
+  def add(self, item: Outgoing):
+    pending = self.queue[-1] if self.queue else None
+    if item.key and pending and pending.key == item.key and pending.merge(item):
+      stats['merged'] += 1
+    else:
+      self.queue.append(item)
+    if not self.worker:
+      self.worker = asyncio.create_task(self.run())
+
+  async def run(self):
+    try:
+      while self.queue:
+        # later messages with the same key are merged into it while it waits
+        await self.bucket.take()
+        await global_bucket.take()
+        item = self.queue.popleft()
+        try:
+          message = await self.deliver(item)
+        except FloodWaitError as e:
+          stats['flood_waits'] += 1
+          logger.warning(f'Waiting {e.seconds}s for a flood wait in chat {self.chat}')
+          self.bucket.pause(e.seconds)
+          self.queue.appendleft(item)
+          continue
+        except Exception as e:
+          stats['errors'] += 1
+          item.resolve(exception=e)
+          continue
+        item.resolve(message)
+    finally:
+      self.worker = None
+
+  async def deliver(self, item: Outgoing):
+    client = proxy_globals.client
+    last = self.last
+    if (
+      item.key and last and last.key == item.key
+      and time.monotonic() - last.time <= OUTBOX_COALESCE_TIME
+    ):
+      text = item.merged_text(last.text)
+      if text is not None:
+        # the message stays a reply to what it replied to, and an edit
+        # without buttons would remove the ones it has
+        kwargs = {k: v for k, v in item.kwargs.items() if k != 'reply_to'}
+        kwargs.setdefault('buttons', last.buttons)
+        try:
+          message = await client.edit_message(last.message, text, **kwargs)
+        except MessageNotModifiedError:
+          message = last.message
+        stats['edited'] += 1
+        self.last = Sent(item.key, message, text, kwargs['buttons'])
+        return message
+
+    message = await client.send_message(self.chat, item.text, **item.kwargs)
+    stats['sent'] += 1
+    self.last = Sent(item.key, message, item.text, item.kwargs.get('buttons')) if item.key else None
+    return message
+
+
+chats: dict[int, ChatOutbox] = {}
+
+
+def send(chat, text: str, key: str = None, append=False, **kwargs) -> asyncio.Future:
+  """
+  Queues a message to chat, kwargs are passed to send_message
+  The future resolves to the message once it was sent (or edited)
+  A message with the same key as the last one sent to the chat within
+  OUTBOX_COALESCE_TIME edits it, with append its text is added instead of replacing it,
+  an edited message keeps its reply_to and its buttons unless others are passed
+  """
+  peer_id = tl_utils.get_peer_id(chat)
+  box = chats.get(peer_id)
+  if not box:
+    if len(chats) >= OUTBOX_MAX_CHATS:
+      for id in [id for id, box in chats.items() if box.is_idle]:
+        del chats[id]
+    box = chats[peer_id] = ChatOutbox(chat)
+
+  future = asyncio.get_running_loop().create_future()
+  box.add(Outgoing(text, kwargs, key, append, [future]))
+  return future
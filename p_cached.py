@@ -9,6 +9,8 @@ from cachetools import LRUCache, TTLCache
 from proxy_globals import client, logger
 from utils import acached
 from emoji_extractor import strip_emojis
+from constants import OFFLOAD_MIN_ITEMS
+import offload
 
 
 # StickerSet without unused data
@@ -21,13 +23,13 @@ class CachedStickerSet:
   def __init__(self, sticker_set: StickerSet):
     self.sticker_emojis = defaultdict(list)
     for pack in sticker_set.packs:
+      if not pack.emoticon:
+        # idk how this happens, thanks durov
+        continue
+      _, extracted = strip_emojis(pack.emoticon)
+      if not extracted:
+        logger.warning(f'No emoji extracted from "{pack.emoticon.encode("unicode-escape")}"')
       for doc_id in pack.documents:
-        if not pack.emoticon:
-          # idk how this happens, thanks durov
-          continue
-        _, extracted = strip_emojis(pack.emoticon)
-        if not extracted:
-          logger.warning(f'No emoji extracted from "{pack.emoticon.encode("unicode-escape")}"')
         self.sticker_emojis[doc_id].extend(extracted)
 
     self.title = sticker_set.set.title
@@ -40,6 +42,9 @@ async def get_sticker_pack(sticker_set):
     return
   try:
     #TODO: fix on new layer
-    return CachedStickerSet(await client(GetStickerSetRequest(sticker_set)))
+    r = await client(GetStickerSetRequest(sticker_set))
+    return await offload.run(
+      CachedStickerSet, r, size=len(r.documents), min_size=OFFLOAD_MIN_ITEMS
+    )
   except errors.StickersetInvalidError:
     return
@@ -2,11 +2,11 @@ import functools
 from dataclasses import dataclass
 import textwrap
 
-from telethon.events import NewMessage
 from telethon.tl.types import BotCommand, BotCommandScopeUsers
 from telethon.tl.functions.bots import SetBotCommandsRequest
 
 from proxy_globals import client
+import dispatcher
 
 
 @dataclass
@@ -52,7 +52,7 @@ def add_to_help(name, *aliases):
   return wrapper
 
 
-@client.on(NewMessage(pattern='/(help|start)$'))
+@dispatcher.command('help', 'start', pattern='/(help|start)$', whitelisted=False)
 @add_to_help('help')
 async def global_help(event, show_help):
   """
@@ -69,7 +69,7 @@ async def global_help(event, show_help):
   )
 
 
-@client.on(NewMessage(pattern='(?i)/help ([a-z\d_]+)$'))
+@dispatcher.command('help', pattern='(?i)/help ([a-z\d_]+)$', whitelisted=False)
 async def cmd_help(event):
   cmd = HELP_TEXTS.get(event.pattern_match[1], None)
   if not cmd:
@@ -6,10 +6,10 @@ from typing import Any, Callable, Awaitable
 
 from telethon import events
 
-from proxy_globals import client, logger, me
+from proxy_globals import logger, me
 from p_help import add_to_help
 from data_model import MediaTypes
-import utils
+import dispatcher
 
 
 # Expiry after the last interaction
@@ -151,11 +151,8 @@ def set_delete_next(user_id, is_delete=True):
     user_next_is_delete.discard(user_id)
 
 
-@client.on(events.NewMessage())
-@utils.whitelist
+@dispatcher.on_media
 async def on_taggable_media(event):
-  if not event.file:
-    return
   m_type = MediaTypes.from_media(event.file.media)
   if not m_type:
     return
@@ -170,8 +167,7 @@ async def on_taggable_media(event):
     user_media_handlers.pop(event.sender_id, None)
 
 
-@client.on(events.NewMessage(pattern=r'/done$'))
-@utils.whitelist
+@dispatcher.command('done', pattern=r'/done$')
 @add_to_help('done')
 async def on_done(event: events.NewMessage.Event, show_help):
   """Finalizes the current operation, if possible"""
@@ -180,8 +176,7 @@ async def on_done(event: events.NewMessage.Event, show_help):
     await handler.done()
 
 
-@client.on(events.NewMessage(pattern=r'/cancel$'))
-@utils.whitelist
+@dispatcher.command('cancel', pattern=r'/cancel$')
 @add_to_help('cancel')
 async def on_cancel(event: events.NewMessage.Event, show_help):
   "Cancels the current operation, if possible"
@@ -190,8 +185,7 @@ async def on_cancel(event: events.NewMessage.Event, show_help):
     await handler.cancel()
 
 
-@client.on(events.NewMessage(pattern=r'/start inline$'))
-@utils.whitelist
+@dispatcher.command('start', pattern=r'/start inline$')
 async def on_start_inline(event: events.NewMessage.Event):
   handler = user_media_handlers[event.sender_id]
   await handler.inline_start(event)
@@ -210,10 +204,8 @@ async def expiry_loop():
     logger.info(f'Handler {handler.name} for #{user_id} has expired')
     user_media_handlers.pop(user_id, None)
     try:
+      # cancellation messages go through the outbox, which avoids flood waits
       await handler.cancel()
-      # try to avoid flood waits when sending a lot of cancellation messages
-      if handler.name != 'default':
-        await asyncio.sleep(0.5)
     except Exception as e:
       logger.exception(f'Unhandled exception on expired handler ({handler.name}) for #{user_id}', e)
 
@@ -1,18 +1,16 @@
 from telethon import events
 
-from proxy_globals import client
 from query_parser import format_tagged_doc, parse_tags
-import db, utils
+import utils, dispatcher, outbox
 from p_help import add_to_help
 import p_media_mode
-from p_tagging import get_doc_from_file, calculate_new_tags
+from p_tagging import save_file_tags
 
 
 add_handler = p_media_mode.create_handler('add')
 
 
-@client.on(events.NewMessage(pattern=r'/add(.+)?$'))
-@utils.whitelist
+@dispatcher.command('add', pattern=r'/add(.+)?$')
 @add_to_help('add')
 async def on_add(event: events.NewMessage.Event, show_help):
   """
@@ -34,7 +32,7 @@ async def on_add(event: events.NewMessage.Event, show_help):
   await p_media_mode.set_user_handler(
     user_id=event.sender_id,
     name='add',
-    chat=await event.get_input_chat(),
+    chat=await utils.update_context(event).get_input_chat(),
     q=q
   )
   await event.respond(out_text, parse_mode='HTML')
@@ -44,27 +42,31 @@ async def on_add(event: events.NewMessage.Event, show_help):
 async def on_add_media(event, m_type, is_delete, q, chat):
   if is_delete:
     return await p_media_mode.default_handler.on_media(event, m_type, is_delete)
-  doc = await get_doc_from_file(event.sender_id, m_type, event.file)
-  calculate_new_tags(doc, q)
-  # Skip adding if no tags were provided and the document has no tags
-  if not q.fields and not doc.tags and not doc.emoji:
-    return
-
   try:
-    await db.update_media(doc)
+    # Skip adding if no tags were provided and the document has no tags
+    doc = await save_file_tags(
+      event.sender_id, m_type, event.file, q, skip_untagged=not q.fields
+    )
   except ValueError as e:
-    await event.reply(f'Error: {e}')
+    await outbox.send(chat, f'Error: {e}', reply_to=event.id)
     return p_media_mode.Cancel
+  if not doc:
+    return
 
-  await event.reply(
+  # one message lists everything that was added in a burst
+  await outbox.send(
+    chat,
     format_tagged_doc(doc),
+    key='add',
+    append=True,
+    reply_to=event.id,
     parse_mode='HTML'
   )
 
 
 @add_handler.register('on_done')
 async def on_add_done(chat, q):
-  await client.send_message(
+  await outbox.send(
     chat,
     'Done adding media? Now use me inline to search your media!',
     buttons=[[utils.inline_pm_button('Search', '')]]
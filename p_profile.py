@@ -0,0 +1,64 @@
+import html
+
+from telethon import events
+
+from p_help import add_to_help
+import dispatcher, profiler
+from constants import PROFILE_DEFAULT_TIME, PROFILE_MAX_TIME, PROFILE_TOP_N, MAX_MESSAGE_LENGTH
+
+
+def format_rows(rows):
+  return [
+    f'{cumulative:.3f}s {own_time:.3f}s {calls} <code>{html.escape(name)}</code>'
+    for calls, own_time, cumulative, name in rows
+  ]
+
+
+def format_summary(profile: profiler.Profile):
+  lines = [
+    f'Profiled for {profile.duration:.1f}s with {profile.backend}, saved to {profile.path}',
+    '\nMost own time (cumulative, own, calls):',
+    *format_rows(profiler.top_functions(profile.path, PROFILE_TOP_N, 'tottime')),
+    '\nMost cumulative time:',
+    *format_rows(profiler.top_functions(profile.path, PROFILE_TOP_N, 'cumtime')),
+  ]
+  text = ''
+  for line in lines:
+    if len(text) + len(line) + 1 > MAX_MESSAGE_LENGTH:
+      break
+    text += f'{line}\n'
+  return text
+
+
+@dispatcher.command('profile', pattern=r'/profile(?: (\d+))?$')
+@add_to_help('profile')
+async def profile(event: events.NewMessage.Event, show_help):
+  """
+  Profiles the bot for a while
+  The slowest functions are sent when it's done, /profile_stop stops it early.
+  Coroutines are timed across awaits, unless yappi is missing and cProfile is used instead.
+  Usage: <code>/profile [seconds]</code>
+  """
+  seconds = min(int(event.pattern_match[1] or PROFILE_DEFAULT_TIME), PROFILE_MAX_TIME)
+  if not seconds:
+    return await show_help()
+  try:
+    running = profiler.start(seconds)
+  except profiler.ProfileRunning:
+    await event.respond('A profile is already running, use /profile_stop to stop it.')
+    return
+
+  await event.respond(f'Profiling for {seconds}s with {running.backend}')
+  done = await running.done
+  await event.respond(format_summary(done), parse_mode='HTML')
+
+
+@dispatcher.command('profile_stop', pattern=r'/profile_stop$')
+@add_to_help('profile_stop')
+async def profile_stop(event: events.NewMessage.Event, show_help):
+  """
+  Stops the running profile
+  The summary is sent in reply to /profile.
+  """
+  if not profiler.stop():
+    await event.respond('No profile is running.')
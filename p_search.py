@@ -1,11 +1,21 @@
+import asyncio
+from collections import Counter
+from dataclasses import dataclass
+
+from cachetools import LRUCache, TTLCache
 from telethon import events
 
-from data_model import MediaTypes, InlineResultID
+from data_model import MediaTypes, InlineResultID, SearchHit
 from p_help import add_to_help
 import p_media_mode
-from proxy_globals import client
-import db, utils, query_parser
-from constants import MAX_RESULTS_PER_PAGE
+from proxy_globals import client, logger
+import db, utils, query_parser, dispatcher, vocabulary, recents
+from query_parser import ParsedQuery
+from scheduler import Priority, Overloaded, priority
+from constants import (
+  MAX_RESULTS_PER_PAGE, INLINE_SEARCH_DEADLINE, INLINE_RESULTS_CACHE_SIZE,
+  RENDERED_RESULTS_CACHE_SIZE, INLINE_PREFETCH_TTL, INLINE_PREFETCH_MAX_USERS
+)
 from telethon.tl.types import InlineQueryPeerTypeSameBotPM, InputDocument, InputPhoto, UpdateBotInlineSend
 
 
@@ -17,28 +27,252 @@ async def on_inline_selected(event):
   await db.update_last_used(event.user_id, id.id)
 
 
+# the corrected query of the first page of each (user id, query text), for the next pages
+corrected_queries = LRUCache(INLINE_RESULTS_CACHE_SIZE)
+
+
+async def search_with_correction(user_id, text, q, offset):
+  """
+  Searches for q, if nothing was found the tags are replaced with similar ones
+  from the user's vocabulary (once it's cached) and the search is retried
+  The next pages of text search the query that the first page was corrected to
+  Returns the total, the results and the corrected query if it was used
+  """
+  if recents.is_recents_query(q):
+    return (*await recents.search_media(user_id, q, offset), None)
+
+  if offset:
+    corrected_q = corrected_queries.get((user_id, text))
+    total, docs = await db.search_media(
+      owner=user_id, query=corrected_q or q, page=offset, lean=True
+    )
+    return total, docs, corrected_q
+
+  total, docs = await db.search_media(
+    owner=user_id, query=q, page=offset, lean=True
+  )
+  corrected_queries.pop((user_id, text), None)
+  if total or not q.get('tags') or q.has('show_transfer'):
+    return total, docs, None
+
+  # waiting for the vocabulary to load would miss the deadline, later queries use it
+  vocab = vocabulary.get_cached_vocabulary(user_id)
+  corrected_q = vocab and vocab.correct_query(q)
+  if not corrected_q:
+    return total, docs, None
+  corrected_total, corrected_docs = await db.search_media(
+    owner=user_id, query=corrected_q, page=offset, lean=True
+  )
+  if not corrected_total:
+    return total, docs, None
+  corrected_queries[user_id, text] = corrected_q
+  return corrected_total, corrected_docs, corrected_q
+
+
+@dataclass
+class InlineResults:
+  type: str
+  total: int
+  docs: list
+  corrected_q: ParsedQuery = None
+
+
+# last good results by (user id, query text, offset)
+good_results = LRUCache(INLINE_RESULTS_CACHE_SIZE)
+# "deadline" for each missed deadline, then how it was answered:
+# "same" or "prefix" query results, "recent" results of the empty query or "waited"
+fallback_stats = Counter()
+# searches that missed the deadline and finish in the background
+late_searches: set[asyncio.Task] = set()
+
+
+@dataclass
+class Prefetch:
+  text: str
+  offset: int
+  task: asyncio.Task
+
+
+# the next page of the last query of each user, fetched while they look at the current one
+prefetches = TTLCache(INLINE_PREFETCH_MAX_USERS, ttl=INLINE_PREFETCH_TTL)
+# "started", then "hit" if it was done when the page was requested, "waited" if
+# it was still running, or "cancelled" if the query changed
+prefetch_stats = Counter()
+
+
+def find_fallback(user_id, text, q, offset):
+  """
+  Returns the last good results of the same query, or for the first page
+  the ones of the longest query that text starts with
+  """
+  search_type = q.get_first('type')
+  shortest = 0 if offset == 0 else len(text)
+  for end in range(len(text), shortest - 1, -1):
+    results = good_results.get((user_id, text[:end], offset))
+    if not results or results.type != search_type:
+      continue
+    if end == len(text):
+      fallback_stats['same'] += 1
+    elif text[:end].strip():
+      fallback_stats['prefix'] += 1
+    else:
+      fallback_stats['recent'] += 1
+    return results
+
+
+async def search_results(user_id, text, q, offset):
+  results = InlineResults(q.get_first('type'), *await search_with_correction(user_id, text, q, offset))
+  good_results[user_id, text, offset] = results
+  return results
+
+
+@db.on_write
+def drop_prefetch(write: db.MediaWrite):
+  prefetch = prefetches.pop(write.owner, None)
+  if prefetch:
+    prefetch.task.cancel()
+
+
+def start_prefetch(user_id, text, q, offset):
+  """Searches the page at offset in the background, see get_prefetched"""
+  # below inline searches, the page might never be requested
+  with priority(Priority.interactive):
+    task = asyncio.create_task(search_results(user_id, text, q, offset))
+  task.add_done_callback(finish_background_search)
+  prefetches[user_id] = Prefetch(text, offset, task)
+  prefetch_stats['started'] += 1
+
+
+def get_prefetched(user_id, text, offset) -> asyncio.Task:
+  """
+  Returns the prefetch task for this page, if any, which might still be running
+  A prefetch of a different query is cancelled
+  """
+  prefetch = prefetches.pop(user_id, None)
+  if not prefetch:
+    return None
+  if prefetch.text != text:
+    if not prefetch.task.done():
+      prefetch_stats['cancelled'] += 1
+      prefetch.task.cancel()
+    return None
+  if prefetch.offset != offset:
+    prefetches[user_id] = prefetch
+    return None
+  if not prefetch.task.done():
+    prefetch_stats['waited'] += 1
+  elif prefetch.task.cancelled() or prefetch.task.exception():
+    return None
+  else:
+    prefetch_stats['hit'] += 1
+  return prefetch.task
+
+
+async def search_before_deadline(user_id, text, q, offset):
+  """
+  Searches like search_with_correction, if it takes longer than
+  INLINE_SEARCH_DEADLINE earlier results are returned while it finishes
+  in the background and refreshes them
+  A prefetch of the page that is still running is waited for the same way
+  Returns the results and whether they're a fallback
+  """
+  task = get_prefetched(user_id, text, offset)
+  is_prefetch = bool(task)
+  if not is_prefetch:
+    with priority(Priority.inline):
+      task = asyncio.create_task(search_results(user_id, text, q, offset))
+  done, _ = await asyncio.wait({task}, timeout=INLINE_SEARCH_DEADLINE)
+  if not done:
+    fallback_stats['deadline'] += 1
+    fallback = find_fallback(user_id, text, q, offset)
+    if fallback:
+      late_searches.add(task)
+      task.add_done_callback(late_searches.discard)
+      if not is_prefetch:
+        task.add_done_callback(finish_background_search)
+      return fallback, True
+    fallback_stats['waited'] += 1
+  try:
+    return await task, False
+  except Overloaded:
+    return InlineResults(q.get_first('type'), 0, []), False
+
+
+def finish_background_search(task: asyncio.Task):
+  if task.cancelled():
+    return
+  e = task.exception()
+  # stale searches are the first to be dropped by the scheduler
+  if e and not isinstance(e, Overloaded):
+    logger.error('Unhandled exception in a background search', exc_info=e)
+
+
+async def get_completion_text(user_id, text, q):
+  """Returns tags that complete the tag that is being typed"""
+  tags = q.get('tags')
+  if not tags or not text.endswith(tags[-1]) or q.has('show_transfer'):
+    return None
+  vocab = vocabulary.get_cached_vocabulary(user_id)
+  if not vocab:
+    return None
+  completions = vocab.complete(tags[-1])
+  if completions:
+    return f'Tags: {" ".join(completions)}'
+
+
+def get_doc_title(d: SearchHit, show_types: bool):
+  if d.title and not show_types:
+    return d.title
+  out_title = ' '.join(d.tags)
+  if d.title:
+    out_title = f'{d.title}; {out_title}'
+  if len(out_title) >= 128:
+    out_title = out_title[:128].rsplit(' ', 1)[0] + '…'
+  if show_types:
+    return f'[{d.type}] {out_title}'
+  return out_title or f'[{d.type}]'
+
+
+# rendered InputBotInlineResults, keyed by everything they're built from,
+# so an edited document is rendered again instead of invalidating its entry
+rendered_results = LRUCache(RENDERED_RESULTS_CACHE_SIZE)
+
+
+async def render_result(builder, d: SearchHit, res_type: MediaTypes, show_types, skip_update):
+  key = (
+    d.id, d.access_hash, d.type, tuple(d.tags), tuple(d.emoji), d.title,
+    res_type, show_types, skip_update
+  )
+  result = rendered_results.get(key)
+  if result:
+    return result
+
+  if res_type == MediaTypes.photo:
+    result = await builder.photo(
+      id=InlineResultID(d.id, skip_update).pack(),
+      file=InputPhoto(d.id, d.access_hash, b'')
+    )
+  else:
+    result = await builder.document(
+      id=InlineResultID(d.id, skip_update).pack(),
+      file=InputDocument(d.id, d.access_hash, b''),
+      type=res_type.value,
+      title=get_doc_title(d, show_types),
+      description=''.join(d.emoji) or None
+    )
+  rendered_results[key] = result
+  return result
+
+
 # TODO: refactor blocks into subfunctions
 @client.on(events.InlineQuery())
 @utils.whitelist
 async def on_inline(event: events.InlineQuery.Event):
-  def get_doc_title(d):
-    if d.title and not show_types:
-      return d.title
-    out_title = ' '.join(d.tags)
-    if d.title:
-      out_title = f'{d.title}; {out_title}'
-    if len(out_title) >= 128:
-      out_title = out_title[:128].rsplit(' ', 1)[0] + '…'
-    if show_types:
-      return f'[{d.type.value}] {out_title}'
-    return out_title or f'[{d.type.value}]'
-
   user_id = event.query.user_id
   q = query_parser.parse_query(event.text)
   offset = int(event.offset or 0)
-  total, docs = await db.search_media(
-    owner=user_id, query=q, page=offset
-  )
+  results, is_fallback = await search_before_deadline(user_id, event.text, q, offset)
+  total, docs, corrected_q = results.total, results.docs, results.corrected_q
 
   res_type = MediaTypes(q.get_first('type'))
   # 'audio' only works for audio/mpeg, thanks durov
@@ -60,36 +294,33 @@ async def on_inline(event: events.InlineQuery.Event):
   switch_pm_text, switch_pm_param = media_mode_handler.get_inline_switch_pm(
     is_pm=is_in_pm, query_str=event.text, parsed_query=q
   )
+  if not switch_pm_text:
+    if is_fallback:
+      switch_pm_text = 'Search is slow, showing earlier results'
+    elif corrected_q:
+      switch_pm_text = f'Showing results for: {" ".join(corrected_q.get("tags"))}'
+    else:
+      switch_pm_text = await get_completion_text(user_id, event.text, q)
+    if switch_pm_text:
+      # show the parsed query when the button is pressed
+      media_mode_handler.last_query = event.text
+      switch_pm_param = 'inline'
 
-  builder = event.builder
-  if res_type == MediaTypes.photo:
-    get_result = lambda d: builder.photo(
-      id=InlineResultID(d.id, skip_update).pack(),
-      file=InputPhoto(d.id, d.access_hash, b'')
-    )
-  else:
-    get_result = (
-      lambda d: builder.document(
-        id=InlineResultID(d.id, skip_update).pack(),
-        file=InputDocument(d.id, d.access_hash, b''),
-        type=res_type.value,
-        title=get_doc_title(d),
-        description=''.join(d.emoji) or None
-      )
-    )
+  has_next_page = total > (offset + 1) * MAX_RESULTS_PER_PAGE
   await event.answer(
-    [get_result(d) for d in docs],
-    cache_time=0 if switch_pm_text else 5,
+    [await render_result(event.builder, d, res_type, show_types, skip_update) for d in docs],
+    cache_time=0 if switch_pm_text or is_fallback else 5,
     private=True,
-    next_offset=f'{offset + 1}' if total > MAX_RESULTS_PER_PAGE else None,
+    next_offset=f'{offset + 1}' if has_next_page else None,
     switch_pm=switch_pm_text,
     switch_pm_param=switch_pm_param,
     gallery=(res_type in gallery_types)
   )
+  if has_next_page and not is_fallback:
+    start_prefetch(user_id, event.text, q, offset + 1)
 
 
-@client.on(events.NewMessage(pattern=r'/parse( .+)?'))
-@utils.whitelist
+@dispatcher.command('parse', pattern=r'/parse( .+)?')
 @p_media_mode.default_handler.register('on_start')
 @add_to_help('parse')
 async def parse(event: events.NewMessage.Event, show_help, query=None):
@@ -0,0 +1,47 @@
+import html
+
+from telethon import events
+
+from p_help import add_to_help
+import dispatcher, slowlog
+from constants import SLOW_QUERY_TIME, SLOWLOG_PATH
+
+
+def format_query(query):
+  return ' '.join(
+    f'{field}:{"!" if is_neg else ""}{value}'
+    for field, is_neg, values in query or ()
+    for value in values
+  )
+
+
+def format_call(call: slowlog.SlowCall):
+  line = f'{call.duration:.3f}s {call.name} u:{call.owner or "NA"}'
+  if call.requests:
+    line += f' ({len(call.requests)} requests)'
+  query = format_query(call.query)
+  if query:
+    line += f' <code>{html.escape(query)}</code>'
+  return line
+
+
+@dispatcher.command('slowlog', pattern=r'/slowlog$')
+@add_to_help('slowlog')
+async def slowlog_summary(event: events.NewMessage.Event, show_help):
+  """
+  Shows the slowest database calls
+  Lists the slowest recent calls and the users that spent the most time in slow calls.
+  """
+  if not slowlog.recent:
+    await event.respond(f'No calls took longer than {SLOW_QUERY_TIME}s since the bot started.')
+    return
+
+  lines = [f'Slowest of the last {len(slowlog.recent)} calls over {SLOW_QUERY_TIME}s:']
+  lines.extend(format_call(call) for call in slowlog.worst_calls())
+  lines.append('\nUsers with the most time in slow calls:')
+  lines.extend(
+    f'u:{owner or "NA"}: {count} calls, {duration:.1f}s'
+    for owner, count, duration in slowlog.slowest_users()
+  )
+  lines.append(f'\nQuery bodies, collection shapes and profiles are in {SLOWLOG_PATH}')
+  await event.respond('\n'.join(lines), parse_mode='HTML')
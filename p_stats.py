@@ -2,9 +2,8 @@ from dataclasses import dataclass, field
 
 from telethon import events
 
-from proxy_globals import client
 from p_help import add_to_help
-import db, utils
+import db, dispatcher
 
 
 @dataclass
@@ -38,8 +37,7 @@ async def get_stats(user_id: int, only_marked=False, use_transfer=False):
   return Stats(total, counts, sub_total)
 
 
-@client.on(events.NewMessage(pattern=r'/stats$'))
-@utils.whitelist
+@dispatcher.command('stats', pattern=r'/stats$')
 @add_to_help('stats')
 async def stats(event: events.NewMessage.Event, show_help):
   """
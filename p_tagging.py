@@ -1,25 +1,19 @@
 import os
+import html
 import mimetypes
-import time
 
 from telethon import events
 
-from proxy_globals import client
 from emoji_extractor import strip_emojis
 from data_model import TaggedDocument
-from query_parser import ParsedQuery, format_tagged_doc, parse_tags
-import db, utils
+from query_parser import ParsedQuery, format_tagged_doc, parse_tags, parse_query
+from constants import MAX_TAG_LENGTH
+import db, utils, dispatcher, outbox
 import p_cached
 from p_help import add_to_help
 import p_media_mode
 
 
-# TODO: make this a method of TaggedDocument
-def calculate_new_tags(doc: TaggedDocument, q: ParsedQuery):
-  doc.tags = (doc.tags | q.get('tags')) - q.get('tags', is_neg=True)
-  doc.emoji = (doc.emoji | q.get('emoji')) - q.get('emoji', is_neg=True)
-
-
 async def get_media_generated_attrs(file):
   ext = mimetypes.guess_extension(file.mime_type)
   if file.name:
@@ -50,27 +44,19 @@ async def get_media_generated_attrs(file):
   return attrs
 
 
-async def get_doc_from_file(owner, m_type, file):
-  file_id, access_hash = file.media.id, file.media.access_hash
-  doc = (
-    await db.get_media(owner, file_id)
-    or TaggedDocument(
-      owner=owner, id=file_id, access_hash=access_hash, type=m_type
-    )
+async def save_file_tags(owner, m_type, file, q: ParsedQuery, **kwargs):
+  """
+  Saves the tags from q for file, the merge happens in elasticsearch
+  kwargs are passed to db.update_media_tags
+  """
+  doc = TaggedDocument(
+    owner=owner, id=file.media.id, access_hash=file.media.access_hash, type=m_type
   )
-
   gen_attrs = await get_media_generated_attrs(file)
-  # don't replace user emoji with ones from pack
-  if doc.emoji:
-    gen_attrs.pop('emoji', None)
-  doc = doc.merge(**gen_attrs)
-  doc.last_used = round(time.time())
-
-  return doc
+  return await db.update_media_tags(doc, q, gen_attrs, **kwargs)
 
 
-@client.on(events.NewMessage())
-@utils.whitelist
+@dispatcher.on_reply
 @utils.extract_taggable_media
 async def on_tag(event, reply, m_type):
   m = event.message
@@ -85,11 +71,8 @@ async def on_tag(event, reply, m_type):
   if not q.fields:
     return
 
-  doc = await get_doc_from_file(event.sender_id, m_type, reply.file)
-  calculate_new_tags(doc, q)
-
   try:
-    await db.update_media(doc)
+    doc = await save_file_tags(event.sender_id, m_type, reply.file, q)
   except ValueError as e:
     return f'Error: {e}'
 
@@ -99,8 +82,7 @@ async def on_tag(event, reply, m_type):
   )
 
 
-@client.on(events.NewMessage(pattern=r'/set(.+)?$'))
-@utils.whitelist
+@dispatcher.command('set', pattern=r'/set(.+)?$')
 @utils.extract_taggable_media
 @add_to_help('set')
 async def set_tags(event: events.NewMessage.Event, reply, m_type, show_help):
@@ -116,16 +98,8 @@ async def set_tags(event: events.NewMessage.Event, reply, m_type, show_help):
   if not q.fields:
     return
 
-  doc = await get_doc_from_file(event.sender_id, m_type, reply.file)
-
-  new_tags, new_emoji = q.get('tags'), q.get('emoji')
-  if new_tags:
-    doc.tags = new_tags
-  if new_emoji:
-    doc.emoji = new_emoji
-
   try:
-    await db.update_media(doc)
+    doc = await save_file_tags(event.sender_id, m_type, reply.file, q, replace=True)
   except ValueError as e:
     return f'Error: {e}'
 
@@ -135,8 +109,7 @@ async def set_tags(event: events.NewMessage.Event, reply, m_type, show_help):
   )
 
 
-@client.on(events.NewMessage(pattern=r'/tags$'))
-@utils.whitelist
+@dispatcher.command('tags', pattern=r'/tags$')
 @utils.extract_taggable_media
 @add_to_help('tags')
 async def show_tags(event: events.NewMessage.Event, reply, m_type, show_help):
@@ -160,8 +133,7 @@ async def show_tags(event: events.NewMessage.Event, reply, m_type, show_help):
   )
 
 
-@client.on(events.NewMessage(pattern=r'/(delete|remove)$'))
-@utils.whitelist
+@dispatcher.command('delete', 'remove', pattern=r'/(delete|remove)$')
 @utils.extract_taggable_media
 @add_to_help('delete', 'remove')
 async def delete(event: events.NewMessage.Event, reply, m_type, show_help):
@@ -186,3 +158,89 @@ async def on_taggable_delete(event, m_type, is_delete):
     return
   deleted = await db.delete_media(event.sender_id, event.file.media.id)
   await event.respond('Media deleted.' if deleted else 'Media not found.')
+
+
+def progress_reporter(chat, key, verb):
+  """Returns an on_progress callback for db tasks that edits the message with key"""
+  last_text = None
+  async def on_progress(status):
+    nonlocal last_text
+    done = status.get('updated', 0) + status.get('deleted', 0) + status.get('noops', 0)
+    text = f'{verb} {done} of {status["total"]} item(s)...'
+    if text != last_text:
+      await outbox.send(chat, text, key=key)
+      last_text = text
+  return on_progress
+
+
+@dispatcher.command('retag', pattern=r'/retag(!)?(.*)$')
+@add_to_help('retag')
+async def retag(event: events.NewMessage.Event, show_help):
+  """
+  Renames a tag in your whole collection
+  Shows how many items have the tag, use <code>/retag!</code> to rename it.
+  If an item already has the new tag, the old one is removed.
+  Usage: <code>/retag[!] [old tag] [new tag]</code>
+  """
+  q = parse_tags(event.pattern_match[2])
+  tags = q.get('tags')
+  if len(tags) != 2 or len(q.fields) != 1:
+    return await show_help()
+  old, new = tags
+  if len(new) > MAX_TAG_LENGTH:
+    await event.respond(f'Tags are limited to a length of {MAX_TAG_LENGTH}!')
+    return
+
+  tags_text = f'{utils.html_format_tags(old)} to {utils.html_format_tags(new)}'
+  if not event.pattern_match[1]:
+    count = await db.retag_media(event.sender_id, old, new, dry_run=True)
+    await event.respond(
+      f'This would rename {tags_text} in {count} item(s).'
+      f'\nSend <code>/retag! {html.escape(old)} {html.escape(new)}</code> to do it.',
+      parse_mode='HTML'
+    )
+    return
+
+  chat, key = await utils.update_context(event).get_input_chat(), f'retag:{event.id}'
+  await outbox.send(chat, 'Renaming...', key=key)
+  updated = await db.retag_media(
+    event.sender_id, old, new, on_progress=progress_reporter(chat, key, 'Renamed')
+  )
+  await outbox.send(
+    chat, f'Renamed {tags_text} in {updated} item(s).', key=key, parse_mode='HTML'
+  )
+
+
+@dispatcher.command('purge', pattern=r'/purge(!)?(.*)$')
+@add_to_help('purge')
+async def purge(event: events.NewMessage.Event, show_help):
+  """
+  Deletes everything that matches a search
+  Shows how many items match the search, use <code>/purge!</code> to delete them.
+  The search works like inline searches.
+  Usage: <code>/purge[!] [search]</code>
+  """
+  query = event.pattern_match[2].strip()
+  q = parse_query(query)
+  # type always has a value, the whole collection can only be purged on purpose
+  if not any(field not in {'type', 'delete', 'show_transfer'} for field, _ in q.fields):
+    return await show_help()
+  if q.warnings:
+    await event.respond('Errors:\n' + '\n'.join(q.warnings), parse_mode=None)
+    return
+
+  if not event.pattern_match[1]:
+    count = await db.purge_media(event.sender_id, q, dry_run=True)
+    await event.respond(
+      f'This would delete {count} item(s).'
+      f'\nSend <code>/purge! {html.escape(query)}</code> to do it.',
+      parse_mode='HTML'
+    )
+    return
+
+  chat, key = await utils.update_context(event).get_input_chat(), f'purge:{event.id}'
+  await outbox.send(chat, 'Deleting...', key=key)
+  deleted = await db.purge_media(
+    event.sender_id, q, on_progress=progress_reporter(chat, key, 'Deleted')
+  )
+  await outbox.send(chat, f'Deleted {deleted} item(s).', key=key)
@@ -2,8 +2,7 @@ import functools
 
 from telethon import events
 
-from proxy_globals import client
-import utils
+import utils, dispatcher, outbox
 import p_media_mode
 import p_stats
 
@@ -18,15 +17,14 @@ import_handler = p_media_mode.create_handler('import')
 def check_transferring(callback):
   @functools.wraps(callback)
   async def wrapper(event, *args, **kwargs):
-    handler = p_media_mode.get_user_handler(event.sender.id).base
+    handler = p_media_mode.get_user_handler(event.sender_id).base
     if handler not in {export_handler, import_handler}:
       return
     return await callback(event, *args, **kwargs, transfer_type=handler.base.name)
   return wrapper
 
 
-@client.on(events.NewMessage(pattern=r'/(delete|remove)$'))
-@utils.whitelist
+@dispatcher.command('delete', 'remove', pattern=r'/(delete|remove)$')
 @check_transferring
 async def delete(event: events.NewMessage.Event, transfer_type):
   await event.respond(
@@ -48,7 +46,7 @@ async def send_transfer_stats(
   if initial_msg:
     msg.append(initial_msg)
 
-  handler = p_media_mode.get_user_handler(event.sender.id)
+  handler = p_media_mode.get_user_handler(event.sender_id)
   name = handler.base.name
   stats = await p_stats.get_stats(event.sender_id, only_marked, use_transfer)
 
@@ -66,8 +64,11 @@ async def send_transfer_stats(
     buttons = empty_buttons
 
   buttons = [utils.inline_pm_button(text, query) for text, query in buttons]
-  await event.respond(
+  # the summary of a burst of selections is edited in place
+  await outbox.send(
+    await utils.update_context(event).get_input_chat(),
     '\n'.join(msg),
+    key='transfer_stats',
     parse_mode='HTML',
     buttons=[buttons] if buttons else None
   )
@@ -1,5 +1,4 @@
 import asyncio
-import json
 from io import BytesIO
 from functools import partial
 
@@ -7,7 +6,7 @@ from telethon import events
 
 from proxy_globals import client, me
 from p_transfer import DATA_VERSION, export_handler, send_transfer_stats
-import db, utils
+import db, utils, dispatcher, outbox, offload
 from query_parser import parse_query
 from p_help import add_to_help
 import p_media_mode
@@ -20,8 +19,7 @@ send_transfer_stats = partial(
 )
 
 
-@client.on(events.NewMessage(pattern=r'/export$'))
-@utils.whitelist
+@dispatcher.command('export', pattern=r'/export$')
 @add_to_help('export')
 async def on_export(event: events.NewMessage.Event, show_help):
   """
@@ -29,11 +27,11 @@ async def on_export(event: events.NewMessage.Event, show_help):
   """
   if p_media_mode.get_user_handler(event.sender_id).base is export_handler:
     return
-  await db.mark_all_media(event.sender_id, False, True)
+  await db.mark_all_media(event.sender_id, False)
   await p_media_mode.set_user_handler(
     user_id=event.sender_id,
     name='export',
-    chat=await event.get_input_chat()
+    chat=await utils.update_context(event).get_input_chat()
   )
   await event.respond(
     (
@@ -72,7 +70,7 @@ async def on_export_media(event, m_type, is_delete, chat):
   try:
     await db.mark_media(event.sender_id, file_id, not is_delete)
   except ValueError as e:
-    await event.respond(f'Error: {e}')
+    await outbox.send(chat, f'Error: {e}')
     return
 
   await send_transfer_stats(
@@ -101,7 +99,7 @@ async def on_export_done(chat):
   except asyncio.exceptions.TimeoutError:
     pass
 
-  file = BytesIO(json.dumps(docs, sort_keys=True).encode('utf-8'))
+  file = BytesIO(await offload.dumps(docs))
   file.name = f'{title or "export"}.json' 
   await client.send_file(
     chat,
@@ -120,7 +118,7 @@ async def on_export_cancel(chat):
   r = await db.mark_all_media(chat.user_id, False)
   num_unmarked = r['updated']
 
-  await client.send_message(
+  await outbox.send(
     chat,
     f'The export of {num_unmarked} item(s) was cancelled.'
     if num_unmarked else
@@ -0,0 +1,179 @@
+# Painless scripts used by the bot, with python versions of them
+# for the backends that don't run painless
+
+import time
+
+from query_parser import ParsedQuery
+from constants import MAX_EMOJI_PER_FILE, MAX_TAGS_PER_FILE, MAX_TAG_LENGTH
+
+
+# Stored script that merges tags into a document (see db.update_media_tags)
+# it also applies the generated attributes and checks the limits server-side
+UPDATE_TAGS_SCRIPT = 'tagbot_update_tags'
+UPDATE_TAGS_SOURCE = """
+Map src = ctx._source;
+for (def entry : params.attrs.entrySet()) {
+  // don't replace user emoji with ones from pack
+  if (entry.getKey() == 'emoji' && src.emoji != null && !src.emoji.isEmpty()) {
+    continue;
+  }
+  src.put(entry.getKey(), entry.getValue());
+}
+
+List tags = src.tags == null ? new ArrayList() : new ArrayList(src.tags);
+List emoji = src.emoji == null ? new ArrayList() : new ArrayList(src.emoji);
+if (params.replace && !params.tags_add.isEmpty()) {
+  tags = new ArrayList();
+}
+if (params.replace && !params.emoji_add.isEmpty()) {
+  emoji = new ArrayList();
+}
+for (def tag : params.tags_add) {
+  if (!tags.contains(tag)) {
+    tags.add(tag);
+  }
+}
+for (def e : params.emoji_add) {
+  if (!emoji.contains(e)) {
+    emoji.add(e);
+  }
+}
+tags.removeAll(params.tags_remove);
+emoji.removeAll(params.emoji_remove);
+
+if (params.skip_untagged && tags.isEmpty() && emoji.isEmpty()) {
+  ctx.op = 'noop';
+  return;
+}
+for (def tag : tags) {
+  if (tag.length() > params.max_tag_length) {
+    throw new IllegalArgumentException('Tags are limited to a length of ' + params.max_tag_length + '!');
+  }
+}
+if (tags.size() > params.max_tags) {
+  throw new IllegalArgumentException('Only ' + params.max_tags + ' tags are allowed per file!');
+}
+if (emoji.size() > params.max_emoji) {
+  throw new IllegalArgumentException('Only ' + params.max_emoji + ' emoji are allowed per file!');
+}
+
+src.tags = tags;
+src.emoji = emoji;
+src.last_used = params.now;
+"""
+
+
+def update_tags_params(
+  query: ParsedQuery, gen_attrs: dict, replace=False, skip_untagged=False
+):
+  return {
+    'attrs': gen_attrs,
+    'replace': replace,
+    'skip_untagged': skip_untagged,
+    'tags_add': query.get('tags'),
+    'tags_remove': query.get('tags', is_neg=True),
+    'emoji_add': query.get('emoji'),
+    'emoji_remove': query.get('emoji', is_neg=True),
+    'now': round(time.time()),
+    'max_tags': MAX_TAGS_PER_FILE,
+    'max_emoji': MAX_EMOJI_PER_FILE,
+    'max_tag_length': MAX_TAG_LENGTH,
+  }
+
+
+def update_tags(src: dict, params: dict):
+  """
+  Python version of UPDATE_TAGS_SOURCE, modifies src in place
+  Returns False if the update should be skipped (noop),
+  raises ValueError where the script throws
+  """
+  for key, value in params['attrs'].items():
+    # don't replace user emoji with ones from pack
+    if key == 'emoji' and src.get('emoji'):
+      continue
+    src[key] = value
+
+  tags = list(src.get('tags') or [])
+  emoji = list(src.get('emoji') or [])
+  if params['replace'] and params['tags_add']:
+    tags = []
+  if params['replace'] and params['emoji_add']:
+    emoji = []
+  tags += [tag for tag in dict.fromkeys(params['tags_add']) if tag not in tags]
+  emoji += [e for e in dict.fromkeys(params['emoji_add']) if e not in emoji]
+  tags = [tag for tag in tags if tag not in params['tags_remove']]
+  emoji = [e for e in emoji if e not in params['emoji_remove']]
+
+  if params['skip_untagged'] and not tags and not emoji:
+    return False
+  if any(len(tag) > params['max_tag_length'] for tag in tags):
+    raise ValueError(f'Tags are limited to a length of {params["max_tag_length"]}!')
+  if len(tags) > params['max_tags']:
+    raise ValueError(f'Only {params["max_tags"]} tags are allowed per file!')
+  if len(emoji) > params['max_emoji']:
+    raise ValueError(f'Only {params["max_emoji"]} emoji are allowed per file!')
+
+  src['tags'] = tags
+  src['emoji'] = emoji
+  src['last_used'] = params['now']
+  return True
+
+
+# Inline script for db.retag_media, renames a tag without changing its position
+RETAG_SOURCE = """
+List tags = ctx._source.tags;
+int i = tags == null ? -1 : tags.indexOf(params.old);
+if (i < 0) {
+  ctx.op = 'noop';
+  return;
+}
+if (tags.contains(params.new)) {
+  tags.remove(i);
+} else {
+  tags.set(i, params.new);
+}
+"""
+
+
+def retag(src: dict, params: dict):
+  """Python version of RETAG_SOURCE"""
+  tags = src.get('tags') or []
+  if params['old'] not in tags:
+    return False
+  i = tags.index(params['old'])
+  if params['new'] in tags:
+    del tags[i]
+  else:
+    tags[i] = params['new']
+  src['tags'] = tags
+  return True
+
+
+# Inline script for db.update_selection, adds ids to or removes them from
+# the export selection of a user
+SELECT_SOURCE = """
+List ids = ctx._source.ids == null ? new ArrayList() : ctx._source.ids;
+if (params.marked) {
+  Set known = new HashSet(ids);
+  for (def id : params.ids) {
+    if (known.add(id)) {
+      ids.add(id);
+    }
+  }
+} else {
+  Set removed = new HashSet(params.ids);
+  ids.removeIf(id -> removed.contains(id));
+}
+ctx._source.ids = ids;
+"""
+
+
+def select(src: dict, params: dict):
+  """Python version of SELECT_SOURCE"""
+  ids = src.get('ids') or []
+  if params['marked']:
+    ids += [id for id in dict.fromkeys(params['ids']) if id not in ids]
+  else:
+    removed = set(params['ids'])
+    ids = [id for id in ids if id not in removed]
+  src['ids'] = ids
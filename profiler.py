@@ -0,0 +1,102 @@
+# Profiles the whole bot for a while, controlled with /profile (see p_profile)
+# uses yappi (see shell.nix) in wall clock mode, which follows coroutines across
+# awaits and also covers the executor threads, in environments without it cProfile,
+# which only sees the event loop thread and counts each resumption of a coroutine as a call
+# nothing is hooked while no profile is running
+# profiles are written in the pstats format (python -m pstats, snakeviz, gprof2dot)
+
+import os
+import time
+import pstats
+import asyncio
+import cProfile
+from dataclasses import dataclass, field
+
+try:
+  import yappi
+except ImportError:
+  yappi = None
+
+from constants import PROFILE_DIR
+
+
+class ProfileRunning(Exception):
+  "Raised when a profile is started while another one is running"
+
+
+@dataclass
+class Profile:
+  seconds: float
+  backend: str
+  path: str
+  # cProfile only, yappi is global
+  profiler: cProfile.Profile = None
+  started: float = field(default_factory=time.monotonic)
+  duration: float = None
+  timer: asyncio.TimerHandle = None
+  # resolves to the profile once it's written
+  done: asyncio.Future = field(default_factory=lambda: asyncio.get_running_loop().create_future())
+
+
+current: Profile = None
+
+
+def start(seconds: float) -> Profile:
+  """Starts profiling, which stops by itself after seconds, see stop"""
+  global current
+  if current:
+    raise ProfileRunning()
+  os.makedirs(PROFILE_DIR, exist_ok=True)
+  path = os.path.join(PROFILE_DIR, f'{time.strftime("%Y%m%d-%H%M%S")}.pstats')
+  if yappi:
+    profile = Profile(seconds, 'yappi', path)
+    yappi.clear_stats()
+    yappi.set_clock_type('wall')
+    yappi.start(builtins=False, profile_threads=True)
+  else:
+    profile = Profile(seconds, 'cProfile', path, cProfile.Profile())
+    profile.profiler.enable()
+  profile.timer = asyncio.get_running_loop().call_later(seconds, stop)
+  current = profile
+  return profile
+
+
+def stop():
+  """Stops the running profile and writes it to its path, returns it or None if none is running"""
+  global current
+  profile, current = current, None
+  if not profile:
+    return None
+  profile.timer.cancel()
+  try:
+    if profile.profiler:
+      profile.profiler.disable()
+      profile.profiler.dump_stats(profile.path)
+    else:
+      yappi.stop()
+      yappi.get_func_stats().save(profile.path, type='pstat')
+      yappi.clear_stats()
+  except Exception as e:
+    profile.done.set_exception(e)
+    raise
+  profile.duration = time.monotonic() - profile.started
+  profile.done.set_result(profile)
+  return profile
+
+
+def func_name(func):
+  file, line, name = func
+  if file == '~':
+    return name
+  return f'{os.path.basename(file)}:{line}({name})'
+
+
+def top_functions(path: str, n=10, sort='tottime'):
+  """Returns (calls, own time, cumulative time, name) of the n functions with the largest sort"""
+  stats = pstats.Stats(path).stats
+  rows = [
+    (calls, own_time, cumulative, func_name(func))
+    for func, (_, calls, own_time, cumulative, _) in stats.items()
+  ]
+  key = 1 if sort == 'tottime' else 2
+  return sorted(rows, key=lambda row: row[key], reverse=True)[:n]
@@ -0,0 +1,97 @@
+# Recently used media of active users, for the empty inline query (and queries
+# with only a type), which are answered without elasticsearch
+# seeded with the whole collection on first use and kept up to date by writes,
+# which includes update_last_used when an inline result is sent
+
+import asyncio
+
+from cachetools import LRUCache
+
+import db
+from query_parser import ParsedQuery
+from replica import doc_to_hit
+from data_model import TaggedDocument, SearchHit
+from constants import INDEX, MAX_RESULTS_PER_PAGE, RECENTS_MAX_USERS
+
+
+class UserRecents:
+  def __init__(self, docs: list[TaggedDocument]):
+    self.hits: dict[int, SearchHit] = {doc.id: doc_to_hit(doc) for doc in docs}
+    self.last_used: dict[int, int] = {doc.id: doc.last_used for doc in docs}
+    self.sorted: list[SearchHit] = None
+
+  def apply_write(self, write: db.MediaWrite):
+    if write.is_delete:
+      self.hits.pop(write.id, None)
+      self.last_used.pop(write.id, None)
+    elif write.doc:
+      self.hits[write.id] = doc_to_hit(write.doc)
+      self.last_used[write.id] = write.doc.last_used
+    elif write.id in self.hits and 'last_used' in write.changes:
+      self.last_used[write.id] = write.changes['last_used']
+    else:
+      return
+    self.sorted = None
+
+  def search(self, search_type: str):
+    """Returns the hits of search_type, most recently used first, like gen_search_query"""
+    if self.sorted is None:
+      self.sorted = sorted(self.hits.values(), key=lambda hit: -self.last_used[hit.id])
+    if search_type == 'document':
+      return [hit for hit in self.sorted if hit.type != 'photo']
+    return [hit for hit in self.sorted if hit.type == search_type]
+
+
+recents = LRUCache(RECENTS_MAX_USERS)
+loading: dict[int, asyncio.Task] = {}
+# writes that happened while the recents of a user were loading
+pending_writes: dict[int, list[db.MediaWrite]] = {}
+
+
+def is_recents_query(q: ParsedQuery):
+  return set(q.fields) == {('type', False)}
+
+
+async def load_recents(owner):
+  pending_writes[owner] = []
+  try:
+    user_recents = UserRecents(await db.get_all_media(owner))
+    for write in pending_writes[owner]:
+      user_recents.apply_write(write)
+    recents[owner] = user_recents
+    return user_recents
+  finally:
+    pending_writes.pop(owner, None)
+    loading.pop(owner, None)
+
+
+async def get_recents(owner):
+  user_recents = recents.get(owner)
+  if user_recents:
+    return user_recents
+  if owner not in loading:
+    loading[owner] = asyncio.create_task(load_recents(owner))
+  return await asyncio.shield(loading[owner])
+
+
+async def search_media(owner: int, q: ParsedQuery, page: int = 0):
+  "Same as db.search_media with lean results, for queries where is_recents_query is true"
+  hits = (await get_recents(owner)).search(q.get_first('type'))
+  return len(hits), hits[page * MAX_RESULTS_PER_PAGE:(page + 1) * MAX_RESULTS_PER_PAGE]
+
+
+@db.on_write
+def update_recents(write: db.MediaWrite):
+  if write.index != INDEX.main:
+    return
+  if write.owner in pending_writes:
+    pending_writes[write.owner].append(write)
+    return
+  user_recents = recents.get(write.owner)
+  if not user_recents:
+    return
+  if write.id is None:
+    # unknown documents were changed, reload on next use
+    recents.pop(write.owner, None)
+    return
+  user_recents.apply_write(write)
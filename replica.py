@@ -0,0 +1,350 @@
+# Optional in-memory copy of the collections of active users (see USE_REPLICA)
+# searches are answered locally with an inverted index that approximates
+# the query generated by gen_search_query, elasticsearch stays the source of truth
+
+import asyncio
+from bisect import bisect_left
+from collections import defaultdict
+
+from cachetools import TTLCache
+
+import db
+from query_parser import ParsedQuery
+from analysis import analyze, text_trigrams, fuzziness, edit_distance, MIN_GRAM
+from data_model import TaggedDocument, SearchHit
+from constants import (
+  INDEX, MAX_RESULTS_PER_PAGE, REPLICA_MAX_USERS, REPLICA_IDLE_TIME
+)
+
+
+TEXT_FIELDS = ['tags', 'title', 'filename', 'pack_name']
+# fields in the inverted index, the others are read from the documents
+INDEXED_FIELDS = {*TEXT_FIELDS, 'ext'}
+# fields searched for each query field, like field_queries in gen_search_query
+QUERY_FIELDS = {
+  'tags': ['search_text'],
+  'filename': ['filename', 'title'],
+  'pack_name': ['pack_name'],
+}
+# boosts of the field, .prefix_ngram and .trigram
+EXACT_BOOST, PREFIX_BOOST, TRIGRAM_BOOST = 3, 2, 1
+
+
+def doc_to_hit(doc: TaggedDocument):
+  return SearchHit(
+    doc.id, doc.access_hash, doc.type.value, list(doc.tags), list(doc.emoji), doc.title
+  )
+
+
+def intersect_all(sets):
+  out = None
+  for s in sets:
+    out = set(s) if out is None else out & s
+    if not out:
+      return set()
+  return out or set()
+
+
+class FieldIndex:
+  "Inverted index over one text field of a user's documents"
+  def __init__(self):
+    self.tokens: dict[str, set[int]] = defaultdict(set)
+    self.trigrams: dict[str, set[int]] = defaultdict(set)
+    self.sorted_tokens: list[str] = []
+
+  def add(self, id, value):
+    if isinstance(value, str):
+      value = [value]
+    for text in value:
+      for token in analyze(text):
+        self.tokens[token].add(id)
+      for trigram in text_trigrams(text):
+        self.trigrams[trigram].add(id)
+
+  def finish(self):
+    self.sorted_tokens = sorted(self.tokens)
+
+  def match_exact(self, token):
+    "Ids of documents that contain token, or a token within its fuzziness"
+    ids = set(self.tokens.get(token, ()))
+    limit = fuzziness(token)
+    if not limit:
+      return ids
+    for other in self.sorted_tokens:
+      # prefix_length=1
+      if other[0] != token[0] or other == token:
+        continue
+      if edit_distance(token, other, limit) <= limit:
+        ids |= self.tokens[other]
+    return ids
+
+  def match_prefix(self, token):
+    "Ids of documents with a token that starts with token"
+    ids = set()
+    i = bisect_left(self.sorted_tokens, token)
+    while i < len(self.sorted_tokens) and self.sorted_tokens[i].startswith(token):
+      ids |= self.tokens[self.sorted_tokens[i]]
+      i += 1
+    return ids
+
+  def match_trigrams(self, trigrams):
+    "Ids of documents that contain all trigrams"
+    return intersect_all(self.trigrams.get(t, set()) for t in trigrams)
+
+
+class UserReplica:
+  def __init__(self, docs: list[TaggedDocument]):
+    self.docs = {doc.id: doc for doc in docs}
+    self.fields: dict[str, FieldIndex] = {}
+    self.is_stale = True
+
+  def apply_write(self, write: db.MediaWrite):
+    if write.is_delete:
+      self.docs.pop(write.id, None)
+    elif write.doc:
+      self.docs[write.id] = write.doc
+    elif write.id in self.docs:
+      self.docs[write.id] = self.docs[write.id].merge(**write.changes)
+      # like update_last_used, which happens for every inline result that is sent
+      if not INDEXED_FIELDS & write.changes.keys():
+        return
+    else:
+      return
+    self.is_stale = True
+
+  def build_index(self):
+    self.fields = {field: FieldIndex() for field in TEXT_FIELDS + ['ext', 'search_text']}
+    search_text = self.fields.pop('search_text')
+    for doc in self.docs.values():
+      for field, index in self.fields.items():
+        index.add(doc.id, getattr(doc, field))
+        if field in TEXT_FIELDS:
+          # copy_to search_text in settings.json
+          search_text.add(doc.id, getattr(doc, field))
+    self.fields['search_text'] = search_text
+    for index in self.fields.values():
+      index.finish()
+    self.is_stale = False
+
+  def match_text(self, fields, values, scores):
+    """
+    Adds the score of each matching document to scores,
+    like a most_fields multi_match with operator=and
+    """
+    tokens = [token for value in values for token in analyze(value)]
+    if not tokens:
+      return
+    gram_tokens = [token[:32] for token in tokens if len(token) >= MIN_GRAM]
+    trigrams = text_trigrams(' '.join(values))
+
+    for field in fields:
+      index = self.fields[field]
+      clauses = [
+        (EXACT_BOOST * len(tokens), [index.match_exact(t) for t in tokens]),
+      ]
+      if gram_tokens:
+        clauses.append((
+          PREFIX_BOOST * sum(len(t) - MIN_GRAM + 1 for t in gram_tokens),
+          [index.match_prefix(t) for t in gram_tokens]
+        ))
+      if trigrams:
+        clauses.append((TRIGRAM_BOOST * len(trigrams), [index.match_trigrams(trigrams)]))
+      for score, id_sets in clauses:
+        for id in intersect_all(id_sets):
+          scores[id] += score
+
+  def match_field(self, field, values):
+    "Returns the score of each document that matches a query field"
+    scores = defaultdict(float)
+    if field in QUERY_FIELDS:
+      self.match_text(QUERY_FIELDS[field], values, scores)
+    elif field == 'ext':
+      self.match_text(['ext'], values, scores)
+    elif field == 'is_animated':
+      for doc in self.docs.values():
+        if getattr(doc, field) == (values[0] == 'yes'):
+          scores[doc.id] = 0
+    elif field == 'emoji':
+      for doc in self.docs.values():
+        if any(e in doc.emoji for e in values):
+          scores[doc.id] = 1
+    else:
+      return None
+    return scores
+
+  def search(self, query: ParsedQuery):
+    """Returns the matching documents, sorted like in gen_search_query"""
+    if self.is_stale:
+      self.build_index()
+
+    search_type = query.get_first('type')
+    if search_type == 'document':
+      candidates = {id for id, doc in self.docs.items() if doc.type != 'photo'}
+    else:
+      candidates = {id for id, doc in self.docs.items() if doc.type == search_type}
+
+    total_scores = defaultdict(float)
+    for (field, is_neg), values in query.fields.items():
+      scores = self.match_field(field, values)
+      if scores is None:
+        continue
+      if is_neg:
+        candidates -= scores.keys()
+        continue
+      candidates &= scores.keys()
+      for id in candidates:
+        total_scores[id] += scores[id]
+
+    docs = [self.docs[id] for id in candidates]
+    docs.sort(key=lambda d: (-total_scores[d.id], -d.last_used))
+    return docs
+
+
+def doc_texts(doc, field) -> list[str]:
+  "Values of a text field of a TaggedDocument or an elasticsearch _source"
+  if field == 'search_text':
+    return [text for field in TEXT_FIELDS for text in doc_texts(doc, field)]
+  value = doc.get(field) if isinstance(doc, dict) else getattr(doc, field)
+  if not value:
+    return []
+  return [value] if isinstance(value, str) else list(value)
+
+
+def match_token(token, doc_tokens):
+  "Whether doc_tokens contain token, or a token within its fuzziness, like FieldIndex.match_exact"
+  if token in doc_tokens:
+    return True
+  limit = fuzziness(token)
+  return bool(limit) and any(
+    other[0] == token[0] and edit_distance(token, other, limit) <= limit
+    for other in doc_tokens
+  )
+
+
+def score_texts(texts, values, shape='default'):
+  """
+  Score of one field of a single document, like UserReplica.match_text, None if it doesn't match
+  The 'exact' and 'prefix' shapes of gen_search_query leave out fuzziness and some clauses
+  """
+  tokens = [token for value in values for token in analyze(value)]
+  if not tokens:
+    return None
+  gram_tokens = [token[:32] for token in tokens if len(token) >= MIN_GRAM]
+  trigrams = text_trigrams(' '.join(values))
+  doc_tokens = {token for text in texts for token in analyze(text)}
+  doc_trigrams = {trigram for text in texts for trigram in text_trigrams(text)}
+
+  is_fuzzy = shape == 'default'
+  clauses = [(EXACT_BOOST * len(tokens), all(
+    match_token(t, doc_tokens) if is_fuzzy else t in doc_tokens for t in tokens
+  ))]
+  if gram_tokens and shape != 'exact':
+    clauses.append((
+      PREFIX_BOOST * sum(len(t) - MIN_GRAM + 1 for t in gram_tokens),
+      all(any(other.startswith(t) for other in doc_tokens) for t in gram_tokens)
+    ))
+  if trigrams and is_fuzzy:
+    clauses.append((TRIGRAM_BOOST * len(trigrams), trigrams <= doc_trigrams))
+  scores = [score for score, is_match in clauses if is_match]
+  return sum(scores) if scores else None
+
+
+def score_field(doc, field, values, shape='default'):
+  "Score of a single document for a query field, like UserReplica.match_field"
+  if field in QUERY_FIELDS or field == 'ext':
+    shape = shape if field in QUERY_FIELDS else 'default'
+    scores = [
+      score for text_field in QUERY_FIELDS.get(field, ['ext'])
+      if (score := score_texts(doc_texts(doc, text_field), values, shape)) is not None
+    ]
+    return sum(scores) if scores else None
+  if field == 'is_animated':
+    return 0 if doc.is_animated == (values[0] == 'yes') else None
+  if field == 'emoji':
+    return 1 if any(e in doc.emoji for e in values) else None
+  return None
+
+
+def match_doc(doc: TaggedDocument, query: ParsedQuery, shape='default'):
+  """
+  Whether a single document matches query, for the few documents that aren't in an index
+  Negated fields always use the default shape, like in gen_search_query
+  """
+  search_type = query.get_first('type')
+  if (doc.type == 'photo') if search_type == 'document' else (doc.type != search_type):
+    return False
+  for (field, is_neg), values in query.fields.items():
+    if field not in QUERY_FIELDS and field not in ('ext', 'is_animated', 'emoji'):
+      continue
+    if (score_field(doc, field, values, 'default' if is_neg else shape) is None) != is_neg:
+      return False
+  return True
+
+
+def score_doc(doc, query: ParsedQuery, shape='default'):
+  """
+  Score of a document (or an elasticsearch _source) that matches query,
+  from the fields that elasticsearch sorts by score for
+  """
+  return sum(
+    score_field(doc, field, values, shape) or 0
+    for (field, is_neg), values in query.fields.items()
+    if field in QUERY_FIELDS and not is_neg
+  )
+
+
+replicas = TTLCache(REPLICA_MAX_USERS, ttl=REPLICA_IDLE_TIME)
+loading: dict[int, asyncio.Task] = {}
+# writes that happened while a replica was loading
+pending_writes: dict[int, list[db.MediaWrite]] = {}
+
+
+async def load_replica(owner):
+  pending_writes[owner] = []
+  try:
+    replica = UserReplica(await db.get_all_media(owner))
+    for write in pending_writes[owner]:
+      replica.apply_write(write)
+    replicas[owner] = replica
+    return replica
+  finally:
+    pending_writes.pop(owner, None)
+    loading.pop(owner, None)
+
+
+async def get_replica(owner):
+  replica = replicas.get(owner)
+  if replica:
+    # reset the idle timer
+    replicas[owner] = replica
+    return replica
+  if owner not in loading:
+    loading[owner] = asyncio.create_task(load_replica(owner))
+  return await asyncio.shield(loading[owner])
+
+
+async def search_media(owner: int, query: ParsedQuery, page: int = 0, lean=False):
+  "Same as db.search_media, but answered from the replica"
+  replica = await get_replica(owner)
+  docs = replica.search(query)
+  docs_page = docs[page * MAX_RESULTS_PER_PAGE:(page + 1) * MAX_RESULTS_PER_PAGE]
+  if lean:
+    docs_page = [doc_to_hit(doc) for doc in docs_page]
+  return len(docs), docs_page
+
+
+@db.on_write
+def update_replica(write: db.MediaWrite):
+  if write.index != INDEX.main:
+    return
+  if write.owner in pending_writes:
+    pending_writes[write.owner].append(write)
+    return
+  replica = replicas.get(write.owner)
+  if not replica:
+    return
+  if write.id is None:
+    # unknown documents were changed, reload on next use
+    replicas.pop(write.owner, None)
+    return
+  replica.apply_write(write)
@@ -0,0 +1,153 @@
+# Admission control for elasticsearch requests
+# at most ES_MAX_CONCURRENCY requests are in flight, the others wait in a
+# priority queue so that inline searches don't queue behind background work
+# the priority comes from the context of the caller, see request_priority
+
+import time
+import heapq
+import asyncio
+import functools
+import itertools
+import contextvars
+from enum import IntEnum
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from contextlib import contextmanager
+
+
+class Priority(IntEnum):
+  inline = 0
+  interactive = 1
+  background = 2
+
+
+class Overloaded(Exception):
+  "Raised for requests that are dropped from a deep queue"
+
+
+request_priority = contextvars.ContextVar('request_priority', default=Priority.interactive)
+
+
+@contextmanager
+def priority(value: Priority):
+  """Requests made in the block (and tasks created in it) use this priority"""
+  token = request_priority.set(value)
+  try:
+    yield
+  finally:
+    request_priority.reset(token)
+
+
+def with_priority(value: Priority):
+  """Decorator for async functions whose requests use this priority"""
+  def decorator(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+      with priority(value):
+        return await func(*args, **kwargs)
+    return wrapper
+  return decorator
+
+
+@dataclass(order=True)
+class Waiter:
+  priority: Priority
+  seq: int
+  enqueued: float = field(compare=False)
+  future: asyncio.Future = field(compare=False)
+
+
+class RequestScheduler:
+  def __init__(self, max_concurrency: int, shed_queue_depth: int, shed_age: float):
+    self.max_concurrency = max_concurrency
+    # inline requests that waited longer than shed_age are dropped
+    # when more than shed_queue_depth requests are waiting
+    self.shed_queue_depth = shed_queue_depth
+    self.shed_age = shed_age
+    self.in_flight = 0
+    self.queue: list[Waiter] = []
+    self.seq = itertools.count()
+    # "<priority>.run", "<priority>.queued" and "<priority>.shed"
+    self.stats = Counter()
+    # seconds spent in the queue by the latest requests of each priority
+    self.queue_times = {p: deque(maxlen=1000) for p in Priority}
+
+  async def run(self, request):
+    """Awaits the coroutine returned by request() once a slot is free"""
+    await self.acquire(request_priority.get())
+    try:
+      return await request()
+    finally:
+      self.release()
+
+  async def acquire(self, priority: Priority):
+    self.stats[f'{priority.name}.run'] += 1
+    if self.in_flight < self.max_concurrency and not self.queue:
+      self.in_flight += 1
+      self.queue_times[priority].append(0)
+      return
+
+    self.stats[f'{priority.name}.queued'] += 1
+    waiter = Waiter(
+      priority, next(self.seq), time.perf_counter(), asyncio.get_running_loop().create_future()
+    )
+    heapq.heappush(self.queue, waiter)
+    self.shed()
+    self.dispatch()
+    try:
+      await waiter.future
+    except asyncio.CancelledError:
+      # the slot was handed over just before the cancellation
+      if waiter.future.done() and not waiter.future.cancelled():
+        self.release()
+      raise
+    finally:
+      self.queue_times[priority].append(time.perf_counter() - waiter.enqueued)
+
+  def release(self):
+    self.in_flight -= 1
+    self.dispatch()
+
+  def dispatch(self):
+    while self.queue and self.in_flight < self.max_concurrency:
+      waiter = heapq.heappop(self.queue)
+      # cancelled or shed
+      if waiter.future.done():
+        continue
+      self.in_flight += 1
+      waiter.future.set_result(None)
+
+  def shed(self):
+    if len(self.queue) <= self.shed_queue_depth:
+      return
+    now = time.perf_counter()
+    for waiter in self.queue:
+      if (
+        waiter.priority == Priority.inline and not waiter.future.done()
+        and now - waiter.enqueued > self.shed_age
+      ):
+        self.stats[f'{waiter.priority.name}.shed'] += 1
+        waiter.future.set_exception(Overloaded('Dropped a stale request from a deep queue'))
+    self.queue = [waiter for waiter in self.queue if not waiter.future.done()]
+    heapq.heapify(self.queue)
+
+
+class ScheduledClient:
+  """Wraps an AsyncElasticsearch client, every request goes through the scheduler"""
+  NAMESPACES = {'indices', 'cluster', 'nodes', 'security', 'tasks', 'ingest', 'snapshot'}
+
+  def __init__(self, client, scheduler: RequestScheduler):
+    self.client = client
+    self.scheduler = scheduler
+
+  def __getattr__(self, name):
+    attr = getattr(self.client, name)
+    if name in self.NAMESPACES:
+      return ScheduledClient(attr, self.scheduler)
+    if name.startswith('_') or not callable(attr):
+      return attr
+
+    @functools.wraps(attr)
+    def method(*args, **kwargs):
+      return self.scheduler.run(lambda: attr(*args, **kwargs))
+    return method
@@ -0,0 +1,90 @@
+# Measures the cost of routing an update to its handlers
+# compares the dispatcher with the previous approach, where every handler
+# ran its own regex and whitelist check
+# Usage: python -m scripts.bench_dispatch [iterations]
+
+import re
+import sys
+import time
+import asyncio
+from types import SimpleNamespace
+
+import proxy_globals
+
+
+class StubClient:
+  def on(self, *args, **kwargs):
+    return lambda func: func
+
+
+proxy_globals.client = StubClient()
+
+import dispatcher
+from utils import WHITELISTED_IDS
+
+
+# (name, pattern) of the commands registered by the bot
+COMMANDS = [
+  ('help', '/(help|start)$'), ('help', '(?i)/help ([a-z\\d_]+)$'),
+  ('set', r'/set(.+)?$'), ('tags', r'/tags$'), ('delete', r'/(delete|remove)$'),
+  ('parse', r'/parse( .+)?'), ('done', r'/done$'), ('cancel', r'/cancel$'),
+  ('start', r'/start inline$'), ('add', r'/add(.+)?$'), ('stats', r'/stats$'),
+  ('export', r'/export$'),
+]
+# handlers without a pattern that ran for every message
+CATCH_ALL = 2
+
+USER_ID = next(iter(WHITELISTED_IDS))
+
+
+async def noop(event):
+  pass
+
+
+def make_event(text, file=None, is_reply=False):
+  return SimpleNamespace(
+    raw_text=text, sender_id=USER_ID, file=file, is_reply=is_reply,
+    original_update=SimpleNamespace(), pattern_match=None
+  )
+
+
+UPDATES = [
+  make_event('/stats'),
+  make_event('/set cat dog'),
+  make_event('/help add'),
+  make_event('', file=object()),
+  make_event('cute cat', is_reply=True),
+  make_event('hello'),
+]
+
+
+async def fan_out(event):
+  for _, pattern in COMMANDS:
+    if re.match(pattern, event.raw_text) and event.sender_id in WHITELISTED_IDS:
+      event.pattern_match = True
+  for _ in range(CATCH_ALL):
+    if event.sender_id in WHITELISTED_IDS:
+      await noop(event)
+
+
+async def bench(func, iterations):
+  start = time.perf_counter()
+  for _ in range(iterations):
+    for event in UPDATES:
+      await func(event)
+  return (time.perf_counter() - start) / (iterations * len(UPDATES))
+
+
+async def main(iterations):
+  for name, pattern in COMMANDS:
+    dispatcher.command(name, pattern=pattern)(noop)
+  dispatcher.on_media(noop)
+  dispatcher.on_reply(noop)
+
+  for label, func in [('fan-out', fan_out), ('dispatcher', dispatcher.dispatch)]:
+    per_update = await bench(func, iterations)
+    print(f'{label}: {per_update * 1e6:.2f}µs per update')
+
+
+if __name__ == '__main__':
+  asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
@@ -0,0 +1,80 @@
+# Compares full and lean searches through db.search_media
+# reports the size of the search responses and the latency of both modes,
+# the size is the JSON of the decoded response, about what elasticsearch sends
+# searches the collection of an existing user in the running elasticsearch,
+# or a full synthetic one on the in-memory stand-in with --fake
+# Usage: python -m scripts.bench_lean_search [--fake | --owner id] [--iterations 20]
+
+import json
+import time
+import asyncio
+import argparse
+import statistics
+
+import constants
+from query_parser import parse_query
+from constants import MAX_MEDIA_PER_USER
+from scripts.corpus import make_docs, QUERIES
+
+
+class ResponseSizes:
+  "Wraps the client of db.es and records the size of each search response"
+
+  def __init__(self, client):
+    self.client = client
+    self.sizes = []
+
+  def __getattr__(self, name):
+    return getattr(self.client, name)
+
+  async def search(self, *args, **kwargs):
+    r = await self.client.search(*args, **kwargs)
+    self.sizes.append(len(json.dumps(r, ensure_ascii=False).encode('utf-8')))
+    return r
+
+
+async def bench(db, sizes, owner, query, lean, iterations):
+  times = []
+  sizes.sizes.clear()
+  for _ in range(iterations):
+    start = time.perf_counter()
+    await db.search_media(owner, query, 0, lean)
+    times.append(time.perf_counter() - start)
+  return statistics.mean(sizes.sizes), statistics.median(times) * 1e3
+
+
+async def main(args):
+  if args.fake:
+    constants.DB_BACKEND = 'fake'
+  import db
+  # always search elasticsearch, never the replica or the recent writes
+  db.USE_REPLICA = False
+  sizes = db.es.client = ResponseSizes(db.es.client)
+  await db.init()
+  if args.fake:
+    for doc in make_docs(MAX_MEDIA_PER_USER):
+      doc.owner = args.owner
+      await db.update_media(doc)
+    db.recent_writes.clear()
+
+  print(f'{"query":<14} {"full B":>8} {"lean B":>8} {"ratio":>6} {"full ms":>8} {"lean ms":>8}')
+  total_full = total_lean = 0
+  for text in QUERIES:
+    query = parse_query(text)
+    full_size, full_time = await bench(db, sizes, args.owner, query, False, args.iterations)
+    lean_size, lean_time = await bench(db, sizes, args.owner, query, True, args.iterations)
+    total_full += full_size
+    total_lean += lean_size
+    print(
+      f'{text!r:<14} {full_size:>8.0f} {lean_size:>8.0f} {lean_size / full_size:>6.2f}'
+      f' {full_time:>8.2f} {lean_time:>8.2f}'
+    )
+  print(f'lean responses are {total_lean / total_full:.2f} of the size of full ones')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--fake', action='store_true', help='use the in-memory stand-in')
+  parser.add_argument('--owner', type=int, default=0, help='user whose collection is searched')
+  parser.add_argument('--iterations', type=int, default=20)
+  asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,110 @@
+# Measures how exports delay inline searches of other users
+# exporters keep encoding full collections while a probe searches at a steady
+# rate on the in-memory stand-in, once with the encoding on the event loop
+# and once with offload.dumps, and reports the search latency and loop lag
+# Usage: python -m scripts.bench_loop_lag [seconds per run] [exporters]
+
+import sys
+import json
+import time
+import asyncio
+import statistics
+
+import constants
+constants.DB_BACKEND = 'fake'
+
+import db
+import offload
+from query_parser import parse_query
+from constants import MAX_MEDIA_PER_USER
+from scripts.corpus import make_docs, QUERIES
+
+
+SEARCH_INTERVAL = 0.02
+LAG_INTERVAL = 0.005
+
+
+def encode_inline(docs):
+  return json.dumps(docs, sort_keys=True).encode('utf-8')
+
+
+async def export_loop(docs, use_offload, stop, exported):
+  while not stop.is_set():
+    if use_offload:
+      await offload.dumps(docs)
+    else:
+      encode_inline(docs)
+    exported.append(len(docs))
+    await asyncio.sleep(0)
+
+
+async def search_loop(owner, stop, latencies):
+  i = 0
+  while not stop.is_set():
+    q = parse_query(QUERIES[i % len(QUERIES)])
+    start = time.perf_counter()
+    await db.search_media(owner, q, lean=True)
+    latencies.append(time.perf_counter() - start)
+    i += 1
+    await asyncio.sleep(SEARCH_INTERVAL)
+
+
+async def lag_loop(stop, lags):
+  while not stop.is_set():
+    start = time.perf_counter()
+    await asyncio.sleep(LAG_INTERVAL)
+    lags.append(time.perf_counter() - start - LAG_INTERVAL)
+
+
+def percentile(values, p):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+
+async def run(name, docs, seconds, exporters, use_offload):
+  stop = asyncio.Event()
+  latencies, lags, exported = [], [], []
+  tasks = [
+    asyncio.create_task(search_loop(0, stop, latencies)),
+    asyncio.create_task(lag_loop(stop, lags)),
+  ] + [
+    asyncio.create_task(export_loop(docs, use_offload, stop, exported))
+    for _ in range(exporters)
+  ]
+  await asyncio.sleep(seconds)
+  stop.set()
+  await asyncio.gather(*tasks)
+  print(
+    f'{name:<10} {len(exported) / seconds:>10.1f} {len(latencies):>8}'
+    f' {statistics.median(latencies) * 1e3:>8.2f} {percentile(latencies, 0.99) * 1e3:>8.2f}'
+    f' {max(latencies) * 1e3:>8.2f} {statistics.median(lags) * 1e3:>8.2f}'
+    f' {percentile(lags, 0.99) * 1e3:>8.2f} {max(lags) * 1e3:>8.2f}'
+  )
+
+
+async def main(seconds, exporters):
+  await db.init()
+  # user 0 searches, user 1 has the collection that is exported
+  for doc in make_docs(2 * MAX_MEDIA_PER_USER):
+    await db.update_media(doc)
+  db.recent_writes.clear()
+  docs = [doc.to_dict() for doc in await db.get_all_media(1)]
+  for query in QUERIES:
+    await db.search_media(0, parse_query(query), lean=True)
+
+  print(f'{exporters} exporter(s) of {len(docs)} documents, {seconds}s per run')
+  print(
+    f'{"encoding":<10} {"exports/s":>10} {"searches":>8} {"p50 ms":>8} {"p99 ms":>8}'
+    f' {"max ms":>8} {"lag p50":>8} {"lag p99":>8} {"lag max":>8}'
+  )
+  await run('none', docs, seconds, 0, False)
+  await run('loop', docs, seconds, exporters, False)
+  # start the workers before measuring
+  await offload.dumps(docs)
+  await run('offload', docs, seconds, exporters, True)
+
+
+if __name__ == '__main__':
+  seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+  exporters = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+  asyncio.run(main(seconds, exporters))
@@ -0,0 +1,140 @@
+# A/B benchmark of index mappings and query shapes
+# builds one index per mapping file, loads the same corpus into each and
+# replays a query corpus through each query shape of gen_search_query
+# (QUERY_SHAPES), then reports store size, indexing rate, p50/p99 latency
+# and the overlap of the first page of results with the first mapping and shape
+# uses the admin credentials from secrets.py, or the in-memory stand-in with --fake
+# Usage: python -m scripts.bench_mapping [--mapping name=file.json ...] [--shape name ...]
+#   [--docs 20000 | --corpus export.json] [--queries file] [--fake]
+
+import json
+import time
+import asyncio
+import argparse
+import statistics
+
+from elasticsearch.helpers import async_bulk
+
+import constants
+from data_model import TaggedDocument, DocumentID
+from query_parser import parse_query
+from gen_search_query import gen_search_query
+from constants import MAX_RESULTS_PER_PAGE
+from scripts.corpus import make_docs, QUERIES
+
+
+INDEX_PREFIX = 'tagbot_ab_'
+MAX_OWNERS = 10
+
+
+def load_corpus(path):
+  "Reads a collection exported with /export, owned by user 0"
+  with open(path) as f:
+    return [TaggedDocument(owner=0, **doc) for doc in json.load(f)]
+
+
+def percentile(values, p):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def build_index(es, name, settings, docs):
+  """Creates an index and loads docs, returns the indexing rate and store size"""
+  index = INDEX_PREFIX + name
+  if await es.indices.exists(index=index):
+    await es.indices.delete(index=index)
+  await es.indices.create(
+    index=index, settings=settings['settings'], mappings=settings['mappings']
+  )
+
+  start = time.perf_counter()
+  await async_bulk(es, (
+    {'_index': index, '_id': DocumentID.pack(d.owner, d.id), '_source': d.to_dict()}
+    for d in docs
+  ), chunk_size=1000)
+  await es.indices.refresh(index=index)
+  rate = len(docs) / (time.perf_counter() - start)
+
+  # compare sizes without the overhead of unmerged segments
+  await es.indices.forcemerge(index=index, max_num_segments=1)
+  stats = await es.indices.stats(index=index, metric='store')
+  return index, rate, stats['_all']['primaries']['store']['size_in_bytes']
+
+
+async def replay(es, index, shape, owners, queries, repeats):
+  """Returns the latencies and the ids of the first page of each query"""
+  latencies, pages = [], {}
+  for owner in owners:
+    for query in queries:
+      q = gen_search_query(owner, parse_query(query), includes=['id'], shape=shape)
+      for _ in range(repeats):
+        start = time.perf_counter()
+        r = await es.search(index=index, size=MAX_RESULTS_PER_PAGE, **q.to_dict())
+        latencies.append(time.perf_counter() - start)
+      pages[owner, query] = {hit['_source']['id'] for hit in r['hits']['hits']}
+  return latencies, pages
+
+
+def overlap(pages, baseline):
+  scores = []
+  for key, ids in pages.items():
+    union = ids | baseline[key]
+    scores.append(len(ids & baseline[key]) / len(union) if union else 1)
+  return statistics.mean(scores)
+
+
+async def main(args):
+  from db_init import es_admin as es
+
+  docs = load_corpus(args.corpus) if args.corpus else list(make_docs(args.docs))
+  owners = sorted({d.owner for d in docs})[:MAX_OWNERS]
+  queries = QUERIES
+  if args.queries:
+    with open(args.queries) as f:
+      queries = [line.rstrip('\n') for line in f]
+
+  mappings = {}
+  for spec in args.mapping or ['default=settings.json']:
+    name, _, path = spec.partition('=')
+    with open(path) as f:
+      mappings[name] = json.load(f)
+
+  print(f'{len(docs)} documents, {len(queries)} queries for {len(owners)} users')
+  print(f'{"mapping":<16} {"shape":<12} {"docs/s":>8} {"store MB":>9} {"p50 ms":>7} {"p99 ms":>7} {"overlap":>8}')
+  baseline = None
+  try:
+    for name, settings in mappings.items():
+      index, rate, size = await build_index(es, name, settings, docs)
+      for shape in args.shape or ['default']:
+        latencies, pages = await replay(es, index, shape, owners, queries, args.repeats)
+        baseline = baseline or pages
+        print(
+          f'{name:<16} {shape:<12} {rate:>8.0f} {size / 2**20:>9.2f} '
+          f'{percentile(latencies, 50) * 1e3:>7.2f} {percentile(latencies, 99) * 1e3:>7.2f} '
+          f'{overlap(pages, baseline):>8.0%}'
+        )
+  finally:
+    if not args.keep:
+      for name in mappings:
+        await es.indices.delete(index=INDEX_PREFIX + name, ignore=404)
+    await es.close()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='A/B benchmark of index mappings and query shapes')
+  parser.add_argument(
+    '--mapping', action='append',
+    help='name=file with settings and mappings like settings.json, can be repeated'
+  )
+  parser.add_argument('--shape', action='append', help='query shape from QUERY_SHAPES, can be repeated')
+  parser.add_argument('--docs', type=int, default=20000, help='size of the synthetic corpus')
+  parser.add_argument('--corpus', help='exported collection to use instead of the synthetic corpus')
+  parser.add_argument('--queries', help='file with one query per line')
+  parser.add_argument('--repeats', type=int, default=5)
+  parser.add_argument('--fake', action='store_true', help='use the in-memory stand-in')
+  parser.add_argument('--keep', action='store_true', help='don\'t delete the indexes afterwards')
+  args = parser.parse_args()
+
+  if args.fake:
+    constants.DB_BACKEND = 'fake'
+  asyncio.run(main(args))
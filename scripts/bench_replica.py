@@ -0,0 +1,57 @@
+# Compares searching the in-memory replica with searching elasticsearch
+# for one user's collection, reports the overlap of the first page of results
+# (relevance parity) and the latency of both
+# Usage: python -m scripts.bench_replica <owner id> [file with one query per line]
+
+import sys
+import time
+import asyncio
+import statistics
+
+import db
+import replica
+from query_parser import parse_query
+
+
+DEFAULT_QUERIES = ['', 'cat', 'happy', 'fn:png', 't:gif', 'a:yes', 'sad -cat', 'hapy', 'reac']
+ITERATIONS = 20
+
+
+async def timed(func, *args, **kwargs):
+  times = []
+  for _ in range(ITERATIONS):
+    start = time.perf_counter()
+    r = await func(*args, **kwargs)
+    times.append(time.perf_counter() - start)
+  return r, statistics.median(times)
+
+
+async def main(owner, queries):
+  # always search elasticsearch directly through db
+  db.USE_REPLICA = False
+  await replica.get_replica(owner)
+
+  overlaps = []
+  print(f'{"query":<20} {"es ms":>8} {"replica ms":>10} {"overlap":>8}')
+  for query in queries:
+    q = parse_query(query)
+    (_, es_docs), es_time = await timed(db.search_media, owner, q, lean=True)
+    (_, replica_docs), replica_time = await timed(replica.search_media, owner, q, lean=True)
+
+    es_ids = {d.id for d in es_docs}
+    replica_ids = {d.id for d in replica_docs}
+    union = es_ids | replica_ids
+    overlap = len(es_ids & replica_ids) / len(union) if union else 1
+    overlaps.append(overlap)
+    print(f'{query!r:<20} {es_time * 1e3:>8.2f} {replica_time * 1e3:>10.3f} {overlap:>8.0%}')
+
+  print(f'mean overlap: {statistics.mean(overlaps):.0%}')
+  await db.es.close()
+
+
+if __name__ == '__main__':
+  queries = DEFAULT_QUERIES
+  if len(sys.argv) > 2:
+    with open(sys.argv[2]) as f:
+      queries = [line.rstrip('\n') for line in f]
+  asyncio.run(main(int(sys.argv[1]), queries))
@@ -0,0 +1,99 @@
+# Compares the SQLite backend with elasticsearch on a synthetic corpus
+# reports load time, search latency and memory use of both
+# elasticsearch is only benchmarked with --es, it uses a separate index and
+# the admin credentials from secrets.py
+# Usage: python -m scripts.bench_sqlite [--es] [number of documents]
+
+import os
+import sys
+import time
+import asyncio
+import resource
+import tempfile
+import statistics
+
+import db_sqlite
+from data_model import DocumentID
+from query_parser import parse_query
+from constants import INDEX
+from scripts.corpus import make_docs, QUERIES
+
+
+BENCH_INDEX = 'tagbot_bench'
+ITERATIONS = 20
+
+
+def rss_mb():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def timed(func):
+  times = []
+  for _ in range(ITERATIONS):
+    start = time.perf_counter()
+    await func()
+    times.append(time.perf_counter() - start)
+  return statistics.median(times) * 1e3
+
+
+async def bench_sqlite(docs):
+  path = os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+  rss_before = rss_mb()
+  db_sqlite.connect(path)
+
+  start = time.perf_counter()
+  with db_sqlite.conn:
+    for doc in docs:
+      db_sqlite.write_doc(doc.to_dict(), INDEX.main)
+  print(f'sqlite: loaded in {time.perf_counter() - start:.1f}s, {os.path.getsize(path) / 2**20:.1f}MB on disk')
+
+  for query in QUERIES:
+    q = parse_query(query)
+    ms = await timed(lambda: db_sqlite.search_media(0, q, lean=True))
+    print(f'  {query!r:<16} {ms:.2f}ms')
+  print(f'  process rss grew by {rss_mb() - rss_before:.1f}MB')
+
+
+async def bench_es(docs):
+  from elasticsearch.helpers import async_bulk
+  from db_init import es_admin as es, settings
+  from gen_search_query import gen_search_query
+
+  if await es.indices.exists(index=BENCH_INDEX):
+    await es.indices.delete(index=BENCH_INDEX)
+  await es.indices.create(
+    index=BENCH_INDEX, settings=settings['settings'], mappings=settings['mappings']
+  )
+
+  start = time.perf_counter()
+  await async_bulk(es, (
+    {'_index': BENCH_INDEX, '_id': DocumentID.pack(d.owner, d.id), '_source': d.to_dict()}
+    for d in docs
+  ))
+  await es.indices.refresh(index=BENCH_INDEX)
+  print(f'elasticsearch: loaded in {time.perf_counter() - start:.1f}s')
+
+  for query in QUERIES:
+    q = gen_search_query(0, parse_query(query)).to_dict()
+    ms = await timed(lambda: es.search(index=BENCH_INDEX, size=50, **q))
+    print(f'  {query!r:<16} {ms:.2f}ms')
+
+  stats = await es.nodes.stats(metric='jvm')
+  for node in stats['nodes'].values():
+    mem = node['jvm']['mem']
+    committed = mem['heap_committed_in_bytes'] + mem['non_heap_committed_in_bytes']
+    print(f'  jvm committed memory: {committed / 2**20:.1f}MB')
+  await es.indices.delete(index=BENCH_INDEX)
+  await es.close()
+
+
+async def main(args):
+  n = int(next((a for a in args if a.isdigit()), 100_000))
+  docs = list(make_docs(n))
+  await bench_sqlite(docs)
+  if '--es' in args:
+    await bench_es(docs)
+
+
+if __name__ == '__main__':
+  asyncio.run(main(sys.argv[1:]))
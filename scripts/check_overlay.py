@@ -0,0 +1,73 @@
+# Checks that recently written documents land where elasticsearch puts them
+# searches pages of a collection on the in-memory stand-in while a few writes
+# are only in the overlay of recent writes (see db.record_write), then again
+# once the overlay is dropped as if the index was refreshed, and reports the
+# pages whose order differs
+# Usage: python -m scripts.check_overlay [documents]
+
+import sys
+import asyncio
+
+import constants
+constants.DB_BACKEND = 'fake'
+
+import db
+from data_model import TaggedDocument
+from query_parser import parse_query
+from constants import INDEX, MAX_RESULTS_PER_PAGE
+
+
+OWNER = 0
+QUERIES = ['', 'cat', 'cat -dog', 'animated:no', 'new', 'kat', 'happ', 'happi', 'dog happ', 'cat happy']
+
+
+def make_doc(i, tags, last_used, **kwargs):
+  return TaggedDocument(
+    owner=OWNER, id=i + 1, access_hash=i, type='sticker', tags=tags, last_used=last_used, **kwargs
+  )
+
+
+async def snapshot(pages):
+  results = {}
+  for query in QUERIES:
+    for page in range(pages):
+      for lean in (False, True):
+        total, hits = await db.search_media(OWNER, parse_query(query), page, lean)
+        results[query, page, lean] = total, [hit.id for hit in hits]
+  return results
+
+
+async def main(n):
+  await db.init()
+  # distinct last_used, ties are broken differently by elasticsearch and the overlay
+  for i in range(n):
+    # near misses are scored differently by elasticsearch and sort_key
+    tags = ['cat' if i % 2 else 'dog', f't{i}', ['happy', 'hapy', 'happiness', 'cats', 'kat'][i % 5]]
+    await db.update_media(make_doc(i, tags, 1000 + 2 * i))
+  db.recent_writes.clear()
+
+  # one moves to the top, one is inserted in the middle of the second page,
+  # one gains tags, one is scored differently by elasticsearch and sort_key and one is deleted
+  await db.update_media(make_doc(0, ['dog', 't0'], 1000 + 2 * n))
+  await db.update_media(make_doc(n, ['cat', 'new', 'hapy'], 1000 + n - MAX_RESULTS_PER_PAGE - 1))
+  await db.update_media(make_doc(3, ['cat', 'dog', 'new', 'happy'], 1000 + 6))
+  await db.update_media(make_doc(n + 1, ['dog', 'happiness'], 1000 + 2 * n + 1))
+  await db.delete_media(OWNER, 8)
+  print(f'{n} documents, {len(db.get_overlay(OWNER, INDEX.main))} in the overlay')
+
+  pages = n // MAX_RESULTS_PER_PAGE + 1
+  before = await snapshot(pages)
+  db.recent_writes.clear()
+  after = await snapshot(pages)
+  different = [key for key in before if before[key] != after[key]]
+  for query, page, lean in different:
+    print(f'{query!r} page {page} lean={lean}:')
+    print(f'  overlay   {before[query, page, lean]}')
+    print(f'  refreshed {after[query, page, lean]}')
+  print(f'{len(before) - len(different)}/{len(before)} pages match')
+  return not different
+
+
+if __name__ == '__main__':
+  n = int(sys.argv[1]) if len(sys.argv) > 1 else 150
+  sys.exit(0 if asyncio.run(main(n)) else 1)
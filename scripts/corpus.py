@@ -0,0 +1,27 @@
+# Synthetic collections shared by the benchmarks
+
+import random
+
+from data_model import TaggedDocument, MediaTypeList
+from constants import MAX_MEDIA_PER_USER
+
+
+WORDS = [
+  'cat', 'dog', 'happy', 'sad', 'angry', 'cute', 'meme', 'reaction', 'anime', 'blob',
+  'smile', 'cry', 'laugh', 'wave', 'heart', 'party', 'sleepy', 'shock', 'thumbs', 'facepalm'
+]
+QUERIES = ['', 'cat', 'happy cat', 'reac', 'fn:png', 't:gif party', '-cat', 'animal', 'p:blob']
+
+
+def make_docs(n, seed=0):
+  """n documents of full collections, owned by users 0, 1, ..."""
+  rng = random.Random(seed)
+  users = max(1, n // MAX_MEDIA_PER_USER)
+  for i in range(n):
+    yield TaggedDocument(
+      owner=i % users, id=rng.getrandbits(62), access_hash=rng.getrandbits(62),
+      type=rng.choice(MediaTypeList[:-1]), ext=rng.choice(['webp', 'png', 'mp4', 'tgs']),
+      tags=rng.sample(WORDS, rng.randint(1, 5)),
+      title=' '.join(rng.sample(WORDS, 2)) if rng.random() < 0.2 else '',
+      pack_name=f'{rng.choice(WORDS)} pack' if rng.random() < 0.5 else '',
+    )
@@ -0,0 +1,417 @@
+# Synthetic load test of the bot's update handlers
+# generates inline queries, inline result selections and tag messages for many
+# users and feeds them through the handlers that the plugins register, with a
+# stub client in place of Telegram, then reports throughput, latency
+# percentiles and event loop lag
+# the elasticsearch backend writes to the main index, the synthetic users are
+# deleted from it afterwards
+# Usage: python -m scripts.loadgen [--backend fake] [--users 50] [--updates 5000]
+#   [--rate 0] [--concurrency 32] [--seed 0] [--json report.json]
+
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import platform
+import importlib
+import statistics
+import contextvars
+import tempfile
+import subprocess
+from types import SimpleNamespace
+from collections import Counter, defaultdict
+
+from telethon import events
+from telethon.extensions import markdown
+from telethon.client.buttons import ButtonMethods
+from telethon.client.messageparse import MessageParseMethods
+from telethon.client.updates import EventBuilderDict
+try:
+  from telethon._updates.entitycache import EntityCache
+except ImportError:
+  # telethon < 1.25
+  from telethon.entitycache import EntityCache
+from telethon.tl import types
+from telethon.tl.functions.messages import GetStickerSetRequest
+
+import constants
+import proxy_globals
+from data_model import TaggedDocument, InlineResultID
+from constants import PLUGINS
+from scripts.corpus import WORDS
+
+
+BOT_ID = 1
+# far away from real user ids
+FIRST_USER_ID = 10 ** 12
+STICKER_SETS_PER_USER = 4
+# share of each kind of update
+MIX = {'inline_query': 0.75, 'inline_send': 0.15, 'tag_message': 0.10}
+LAG_INTERVAL = 0.01
+PERCENTILES = [50, 90, 99]
+
+
+class StubClient(ButtonMethods, MessageParseMethods):
+  """
+  Stands in for TelegramClient, answers requests without a connection
+  building buttons and parsing text use the real implementations
+  """
+  def __init__(self, api_latency):
+    self.api_latency = api_latency
+    self._parse_mode = markdown
+    self._self_id = BOT_ID
+    self._mb_entity_cache = self._entity_cache = EntityCache()
+    self._event_builders = []
+    self.requests = Counter()
+    # message id -> the message it replies to
+    self.replies = {}
+    # sticker set id -> ids of its stickers
+    self.sticker_sets = defaultdict(list)
+
+  @property
+  def loop(self):
+    return asyncio.get_running_loop()
+
+  def on(self, builder):
+    def decorator(callback):
+      self._event_builders.append((builder, callback))
+      return callback
+    return decorator
+
+  async def request(self, name):
+    self.requests[name] += 1
+    await asyncio.sleep(self.api_latency)
+
+  async def __call__(self, request, ordered=False):
+    await self.request(type(request).__name__)
+    if isinstance(request, GetStickerSetRequest):
+      set_id = request.stickerset.id
+      return types.messages.StickerSet(
+        set=types.StickerSet(
+          id=set_id, access_hash=0, title=f'Pack {set_id}', short_name=f'pack_{set_id}',
+          count=len(self.sticker_sets[set_id]), hash=0
+        ),
+        packs=[types.StickerPack('😀', self.sticker_sets[set_id])],
+        keywords=[],
+        documents=[]
+      )
+    return True
+
+  async def send_message(self, *args, **kwargs):
+    await self.request('send_message')
+
+  async def send_file(self, *args, **kwargs):
+    await self.request('send_file')
+
+  async def get_messages(self, entity, ids=None, **kwargs):
+    await self.request('get_messages')
+    if isinstance(ids, types.InputMessageReplyTo):
+      return self.replies.get(ids.id)
+
+  def add_users(self, user_ids):
+    users = [types.User(id=id, access_hash=id) for id in user_ids]
+    if hasattr(self._entity_cache, 'extend'):
+      self._entity_cache.extend(users, [])
+    else:
+      self._entity_cache.add(users)
+
+  async def get_me(self, input_peer=False):
+    return proxy_globals.me
+
+  async def dispatch(self, update):
+    "Runs the handlers for update, like TelegramClient._dispatch_update"
+    update._entities = {}
+    built = EventBuilderDict(self, update, None)
+    for builder, callback in self._event_builders:
+      event = built[type(builder)]
+      if not event:
+        continue
+      if not builder.resolved:
+        await builder.resolve(self)
+      if not builder.filter(event):
+        continue
+      try:
+        await callback(event)
+      except events.StopPropagation:
+        break
+
+
+# errors logged while the update of the current task was handled
+logged_errors: contextvars.ContextVar[list] = contextvars.ContextVar('logged_errors', default=None)
+
+
+class ErrorCounter(logging.Handler):
+  "Collects the errors that handlers log instead of raising, like dispatcher.run_handler"
+  def __init__(self):
+    super().__init__(logging.ERROR)
+
+  def emit(self, record):
+    errors = logged_errors.get()
+    if errors is not None:
+      errors.append(record.exc_info[0].__name__ if record.exc_info else record.name)
+
+
+def make_document(rng, user, kind):
+  doc_id = rng.getrandbits(62)
+  if kind == 'sticker':
+    set_id = user.sticker_set_ids[rng.randrange(STICKER_SETS_PER_USER)]
+    client.sticker_sets[set_id].append(doc_id)
+    mime_type, attributes = 'image/webp', [
+      types.DocumentAttributeSticker('😀', types.InputStickerSetID(set_id, 0)),
+      types.DocumentAttributeImageSize(512, 512),
+    ]
+  else:
+    mime_type, attributes = 'video/mp4', [
+      types.DocumentAttributeAnimated(),
+      types.DocumentAttributeVideo(1.5, 256, 256),
+      types.DocumentAttributeFilename(f'{rng.choice(WORDS)}.mp4'),
+    ]
+  return types.Document(
+    id=doc_id, access_hash=rng.getrandbits(62), file_reference=b'', date=None,
+    mime_type=mime_type, size=1024, dc_id=1, attributes=attributes
+  )
+
+
+class LoadGenerator:
+  def __init__(self, seed, users):
+    self.rng = random.Random(seed)
+    self.msg_id = 0
+    self.users = [
+      SimpleNamespace(
+        id=FIRST_USER_ID + i,
+        sticker_set_ids=[self.rng.getrandbits(62) for _ in range(STICKER_SETS_PER_USER)],
+        doc_ids=[],
+      )
+      for i in range(users)
+    ]
+
+  def next_msg_id(self):
+    self.msg_id += 1
+    return self.msg_id
+
+  def tags(self):
+    return ' '.join(self.rng.sample(WORDS, self.rng.randint(1, 3)))
+
+  def inline_query(self, user):
+    text = self.rng.choice(['', self.tags(), self.rng.choice(WORDS)[:self.rng.randint(2, 5)]])
+    peer_type = self.rng.choice([types.InlineQueryPeerTypePM(), types.InlineQueryPeerTypeSameBotPM()])
+    return types.UpdateBotInlineQuery(
+      query_id=self.rng.getrandbits(62), user_id=user.id, query=text,
+      offset=self.rng.choice(['', '', '', '1']), peer_type=peer_type
+    )
+
+  def inline_send(self, user):
+    doc_id = self.rng.choice(user.doc_ids) if user.doc_ids else 0
+    return types.UpdateBotInlineSend(
+      user_id=user.id, query=self.tags(), id=InlineResultID(doc_id, False).pack()
+    )
+
+  def tag_message(self, user):
+    "Replies to new media with tags"
+    peer = types.PeerUser(user.id)
+    media_msg = types.Message(
+      id=self.next_msg_id(), peer_id=peer, message='',
+      media=types.MessageMediaDocument(
+        document=make_document(self.rng, user, self.rng.choice(['sticker', 'gif']))
+      )
+    )
+    media_msg._finish_init(client, {}, None)
+    user.doc_ids.append(media_msg.media.document.id)
+
+    msg = types.Message(
+      id=self.next_msg_id(), peer_id=peer, message=self.tags(),
+      reply_to=types.MessageReplyHeader(reply_to_msg_id=media_msg.id)
+    )
+    client.replies[msg.id] = media_msg
+    return types.UpdateNewMessage(msg, pts=0, pts_count=0)
+
+  def next_update(self):
+    user = self.rng.choice(self.users)
+    kind = self.rng.choices(list(MIX), weights=list(MIX.values()))[0]
+    return kind, getattr(self, kind)(user)
+
+
+def percentiles(values):
+  if not values:
+    return {}
+  values = sorted(values)
+  out = {
+    f'p{p}': values[min(len(values) - 1, int(len(values) * p / 100))] * 1e3
+    for p in PERCENTILES
+  }
+  out['max'] = values[-1] * 1e3
+  out['mean'] = statistics.mean(values) * 1e3
+  return out
+
+
+async def monitor_loop_lag(lags):
+  while True:
+    start = time.perf_counter()
+    await asyncio.sleep(LAG_INTERVAL)
+    lags.append(time.perf_counter() - start - LAG_INTERVAL)
+
+
+async def run_load(gen, args):
+  latencies = defaultdict(list)
+  errors = Counter()
+  failed = 0
+
+  async def run_update(kind, update):
+    nonlocal failed
+    start = time.perf_counter()
+    update_errors = []
+    logged_errors.set(update_errors)
+    try:
+      await client.dispatch(update)
+    except Exception as e:
+      update_errors.append(type(e).__name__)
+    latencies[kind].append(time.perf_counter() - start)
+    for name in update_errors:
+      errors[f'{kind}: {name}'] += 1
+    failed += bool(update_errors)
+
+  updates = (gen.next_update() for _ in range(args.updates))
+  error_counter = ErrorCounter()
+  logging.getLogger().addHandler(error_counter)
+  lags = []
+  lag_task = asyncio.create_task(monitor_loop_lag(lags))
+  start = time.perf_counter()
+
+  if args.rate:
+    # open loop, updates arrive independently of how fast they're handled
+    tasks = []
+    arrival = start
+    for kind, update in updates:
+      tasks.append(asyncio.create_task(run_update(kind, update)))
+      arrival += gen.rng.expovariate(args.rate)
+      await asyncio.sleep(max(0, arrival - time.perf_counter()))
+    await asyncio.gather(*tasks)
+  else:
+    async def worker():
+      for kind, update in updates:
+        await run_update(kind, update)
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+
+  elapsed = time.perf_counter() - start
+  lag_task.cancel()
+  logging.getLogger().removeHandler(error_counter)
+  return {
+    'elapsed_s': elapsed,
+    # of the updates that were handled without errors
+    'throughput_per_s': (args.updates - failed) / elapsed,
+    'failed_updates': failed,
+    'latency_ms': {kind: percentiles(values) for kind, values in sorted(latencies.items())},
+    'loop_lag_ms': percentiles(lags),
+    'errors': dict(errors),
+    'api_requests': dict(client.requests),
+  }
+
+
+async def seed(gen, docs_per_user):
+  "Fills the collections of the users"
+  import db
+  for user in gen.users:
+    for _ in range(docs_per_user):
+      kind = gen.rng.choice(['sticker', 'gif'])
+      document = make_document(gen.rng, user, kind)
+      user.doc_ids.append(document.id)
+      await db.update_media(TaggedDocument(
+        owner=user.id, id=document.id, access_hash=document.access_hash, type=kind,
+        ext='webp' if kind == 'sticker' else 'mp4', tags=gen.tags().split(),
+        title=gen.tags() if gen.rng.random() < 0.2 else ''
+      ))
+
+
+async def cleanup(gen):
+  import db
+  from constants import INDEX
+  if constants.DB_BACKEND == 'sqlite':
+    return
+  await db.es.delete_by_query(
+    index=INDEX.main, body={'query': {'terms': {'owner': [u.id for u in gen.users]}}},
+    refresh=True
+  )
+
+
+def print_report(report):
+  config = report['config']
+  print(f'backend={config["backend"]} users={config["users"]} updates={config["updates"]} '
+        f'rate={config["rate"] or "closed loop"} concurrency={config["concurrency"]}')
+  results = report['results']
+  print(
+    f'{results["throughput_per_s"]:.1f} updates/s in {results["elapsed_s"]:.2f}s'
+    f', {results["failed_updates"]} failed'
+  )
+  header = ''.join(f'{name:>9}' for name in [*(f'p{p}' for p in PERCENTILES), 'max', 'mean'])
+  print(f'{"ms":<12}{header}')
+  rows = list(results['latency_ms'].items()) + [('loop lag', results['loop_lag_ms'])]
+  for name, values in rows:
+    print(f'{name:<12}' + ''.join(f'{v:>9.2f}' for v in values.values()))
+  if results['errors']:
+    print('errors:', results['errors'])
+  print('api requests:', results['api_requests'])
+
+
+async def main(args):
+  global client
+  client = StubClient(args.api_latency / 1000)
+  proxy_globals.client = client
+  proxy_globals.me = types.User(id=BOT_ID, bot=True, username='tagbot')
+
+  gen = LoadGenerator(args.seed, args.users)
+  client.add_users(u.id for u in gen.users)
+
+  import db, utils
+  utils.WHITELISTED_IDS.update(u.id for u in gen.users)
+  await db.init()
+  for module_name in PLUGINS:
+    proxy_globals.logger = logging.getLogger(module_name)
+    module = importlib.import_module(module_name)
+    init = getattr(module, 'on_done_loading', None)
+    if init:
+      await init()
+  client.requests.clear()
+
+  try:
+    await seed(gen, args.docs)
+    results = await run_load(gen, args)
+  finally:
+    await cleanup(gen)
+
+  try:
+    revision = subprocess.run(
+      ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True
+    ).stdout.strip()
+  except OSError:
+    revision = None
+  report = {
+    'config': vars(args) | {'revision': revision, 'python': platform.python_version()},
+    'results': results,
+  }
+  print_report(report)
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Synthetic load test of the update handlers')
+  parser.add_argument('--backend', choices=['fake', 'elasticsearch', 'sqlite'], default='fake')
+  parser.add_argument('--users', type=int, default=50)
+  parser.add_argument('--docs', type=int, default=200, help='documents per user before the run')
+  parser.add_argument('--updates', type=int, default=5000)
+  parser.add_argument('--rate', type=float, default=0, help='updates per second, 0 for a closed loop')
+  parser.add_argument('--concurrency', type=int, default=32, help='workers of the closed loop')
+  parser.add_argument('--api-latency', type=float, default=0, help='ms per Telegram request')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--json', help='also write the report to this file')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.WARNING)
+  constants.DB_BACKEND = args.backend
+  if args.backend == 'sqlite':
+    constants.SQLITE_PATH = os.path.join(tempfile.mkdtemp(), 'loadgen.sqlite3')
+  asyncio.run(main(args))
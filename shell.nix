@@ -5,7 +5,7 @@ pkgs.mkShell {
     (pkgs.python39.withPackages (ps: with ps; [
       (callPackage ./nix/telethon.nix {})
       elasticsearch aiohttp elasticsearch-dsl
-      cachetools boltons regex emoji
+      cachetools boltons regex emoji numpy yappi
     ]))
   ];
 }
\ No newline at end of file
@@ -0,0 +1,147 @@
+# Records db calls that take longer than SLOW_QUERY_TIME, with what's needed
+# to find out why: the parsed query, the request bodies and the shape of the
+# user's collection, a sample of the searches is run again with profiling
+# records are written as json lines to a rotating file, see /slowlog in p_slowlog
+
+import time
+import json
+import random
+import asyncio
+import inspect
+import logging
+import functools
+import contextvars
+from collections import deque
+from dataclasses import dataclass, field, asdict
+from logging.handlers import RotatingFileHandler
+from typing import Awaitable, Callable
+
+from query_parser import ParsedQuery
+from constants import (
+  SLOW_QUERY_TIME, SLOW_QUERY_PROFILE_RATE, SLOWLOG_PATH, SLOWLOG_MAX_BYTES, SLOWLOG_BACKUPS
+)
+
+
+@dataclass
+class SlowCall:
+  name: str
+  duration: float
+  owner: int = None
+  # [field, is_neg, values] for each field of the ParsedQuery
+  query: list = None
+  # {'index', 'body'} of the requests made during the call, added with add_request
+  requests: list = field(default_factory=list)
+  time: float = field(default_factory=time.time)
+  # added by the listeners
+  collection: dict = None
+  profile: list = None
+  # whether this call should be profiled, decided when it's recorded
+  sampled: bool = False
+
+
+logger = logging.getLogger('slowlog')
+current_call: contextvars.ContextVar[SlowCall] = contextvars.ContextVar('current_call', default=None)
+# set while the listeners run, so that their own db calls aren't recorded
+is_describing = contextvars.ContextVar('is_describing', default=False)
+slow_listeners: list[Callable[[SlowCall], Awaitable]] = []
+# most recent slow calls, for /slowlog
+recent: deque[SlowCall] = deque(maxlen=1000)
+tasks: set[asyncio.Task] = set()
+file_logger = None
+
+
+def on_slow(listener):
+  """Registers a coroutine that can add details to each SlowCall before it's written"""
+  slow_listeners.append(listener)
+  return listener
+
+
+def get_file_logger():
+  global file_logger
+  if not file_logger:
+    file_logger = logging.getLogger('slowlog.file')
+    file_logger.propagate = False
+    file_logger.setLevel(logging.INFO)
+    file_logger.addHandler(RotatingFileHandler(
+      SLOWLOG_PATH, maxBytes=SLOWLOG_MAX_BYTES, backupCount=SLOWLOG_BACKUPS
+    ))
+  return file_logger
+
+
+def add_request(index, body):
+  """Adds a request body to the call that is being timed, if any"""
+  call = current_call.get()
+  if call:
+    call.requests.append({'index': index, 'body': body})
+
+
+def describe_args(func, args, kwargs):
+  "Returns the owner and the query a db function was called with"
+  try:
+    arguments = inspect.signature(func).bind_partial(*args, **kwargs).arguments
+  except TypeError:
+    return None, None
+  owner = arguments.get('owner')
+  if owner is None:
+    owner = getattr(arguments.get('doc'), 'owner', None)
+  query = arguments.get('query')
+  if isinstance(query, ParsedQuery):
+    query = [[field, is_neg, values] for (field, is_neg), values in query.fields.items()]
+  return owner, query
+
+
+def timed(func):
+  """Records calls of an async db function that take longer than SLOW_QUERY_TIME"""
+  @functools.wraps(func)
+  async def wrapper(*args, **kwargs):
+    if is_describing.get():
+      return await func(*args, **kwargs)
+    call = SlowCall(func.__name__, 0)
+    token = current_call.set(call)
+    start = time.perf_counter()
+    try:
+      return await func(*args, **kwargs)
+    finally:
+      call.duration = time.perf_counter() - start
+      current_call.reset(token)
+      if call.duration >= SLOW_QUERY_TIME:
+        call.owner, call.query = describe_args(func, args, kwargs)
+        record(call)
+  return wrapper
+
+
+def record(call: SlowCall):
+  call.sampled = bool(call.requests) and random.random() < SLOW_QUERY_PROFILE_RATE
+  recent.append(call)
+  logger.warning(
+    f'{call.name} took {call.duration:.3f}s [u:{call.owner or "NA"}] query: {call.query}'
+  )
+  task = asyncio.create_task(write(call))
+  tasks.add(task)
+  task.add_done_callback(tasks.discard)
+
+
+async def write(call: SlowCall):
+  is_describing.set(True)
+  for listener in slow_listeners:
+    try:
+      await listener(call)
+    except Exception:
+      logger.exception(f'Unhandled exception in slow call listener {listener.__name__}')
+  get_file_logger().info(json.dumps(asdict(call), default=str))
+
+
+def worst_calls(n=10):
+  return sorted(recent, key=lambda call: call.duration, reverse=True)[:n]
+
+
+def slowest_users(n=10):
+  """Returns (owner, number of slow calls, total duration) with the largest total duration"""
+  totals = {}
+  for call in recent:
+    count, duration = totals.get(call.owner, (0, 0))
+    totals[call.owner] = count + 1, duration + call.duration
+  return sorted(
+    ((owner, count, duration) for owner, (count, duration) in totals.items()),
+    key=lambda row: row[2], reverse=True
+  )[:n]
@@ -1,4 +1,5 @@
 import functools
+from collections import Counter
 
 from cachetools import keys
 from telethon.tl.custom.button import Button
@@ -7,6 +8,11 @@ from data_model import MediaTypes
 
 
 WHITELISTED_IDS = {232787997, 151462131}
+UPDATE_CONTEXT_ATTR = '_update_context'
+
+# counts of Telegram API lookups done through UpdateContext
+# "<name>.fetched" is a lookup that was made, "<name>.saved" is one that was avoided
+api_call_stats = Counter()
 
 
 def inline_pm_button(text, query=''):
@@ -43,6 +49,38 @@ def acached(cache, key=keys.hashkey):
   return decorator
 
 
+class UpdateContext:
+  """
+  Fetches data related to an update at most once,
+  the result is shared by every handler that processes the same update
+  """
+  def __init__(self, event):
+    self.event = event
+    self.results = {}
+
+  async def get(self, name, fetch):
+    if name in self.results:
+      api_call_stats[f'{name}.saved'] += 1
+      return self.results[name]
+    api_call_stats[f'{name}.fetched'] += 1
+    self.results[name] = await fetch()
+    return self.results[name]
+
+  async def get_reply_message(self):
+    return await self.get('reply', self.event.get_reply_message)
+
+  async def get_input_chat(self):
+    return await self.get('input_chat', self.event.get_input_chat)
+
+
+def update_context(event) -> UpdateContext:
+  ctx = getattr(event, UPDATE_CONTEXT_ATTR, None)
+  if not ctx:
+    ctx = UpdateContext(event)
+    setattr(event, UPDATE_CONTEXT_ATTR, ctx)
+  return ctx
+
+
 def whitelist(handler):
   @functools.wraps(handler)
   async def wrapper(event, *args, **kwargs):
@@ -55,7 +93,7 @@ def whitelist(handler):
 def extract_taggable_media(handler):
   @functools.wraps(handler)
   async def wrapper(event, *args, **kwargs):
-    reply = await event.get_reply_message()
+    reply = await update_context(event).get_reply_message()
     m_type = MediaTypes.from_media(reply.file.media) if reply and reply.file else None
     ret = await handler(event, reply=reply, m_type=m_type, *args, **kwargs)
     if isinstance(ret, str):
@@ -0,0 +1,176 @@
+# Per-user tag vocabulary with frequencies, used for completing tags
+# while typing an inline query and for "did you mean" when nothing was found
+
+import copy
+import asyncio
+import logging
+from collections import Counter
+
+import numpy as np
+from cachetools import TTLCache
+
+import db
+from constants import INDEX
+from query_parser import ParsedQuery
+from scheduler import Priority, Overloaded, priority
+
+
+logger = logging.getLogger('vocabulary')
+
+# minimum trigram similarity (dice coefficient) for a correction
+MIN_CORRECTION_SCORE = 0.5
+
+
+def trigrams(text: str):
+  text = f' {text.lower()} '
+  return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class TagVocabulary:
+  def __init__(self, frequencies: dict[str, int]):
+    self.counts = Counter(frequencies)
+    # tags of documents that were written since the vocabulary was built
+    self.doc_tags: dict[int, set[str]] = {}
+    self.is_stale = True
+
+  def apply_write(self, write: db.MediaWrite):
+    old_tags = self.doc_tags.pop(write.id, None)
+    new_tags = set(write.doc.tags) if write.doc else set()
+    if old_tags is None:
+      if write.created:
+        old_tags = set()
+      else:
+        # tags before this write are unknown, assume the ones we know about were there
+        # removed tags are corrected when the vocabulary expires
+        old_tags = {tag for tag in new_tags if tag in self.counts}
+    if write.doc:
+      self.doc_tags[write.id] = new_tags
+
+    for tag in new_tags - old_tags:
+      self.counts[tag] += 1
+    for tag in old_tags - new_tags:
+      self.counts[tag] -= 1
+      if self.counts[tag] <= 0:
+        del self.counts[tag]
+    if new_tags != old_tags:
+      self.is_stale = True
+
+  def build_index(self):
+    """(Re-)builds the arrays used for matching"""
+    self.tags = np.array(list(self.counts) or [''])
+    self.freqs = np.array([self.counts[tag] for tag in self.counts] or [0])
+
+    trigram_ids = {}
+    rows, ids = [], []
+    self.trigram_counts = np.zeros(len(self.tags), dtype=np.int32)
+    for row, tag in enumerate(self.counts):
+      tag_trigrams = trigrams(tag)
+      self.trigram_counts[row] = len(tag_trigrams)
+      for t in tag_trigrams:
+        rows.append(row)
+        ids.append(trigram_ids.setdefault(t, len(trigram_ids)))
+    self.trigram_ids = trigram_ids
+    self.entry_rows = np.array(rows, dtype=np.int32)
+    self.entry_trigrams = np.array(ids, dtype=np.int32)
+    self.is_stale = False
+
+  def ensure_index(self):
+    if self.is_stale:
+      self.build_index()
+
+  def complete(self, prefix: str, limit=3):
+    """Returns the most used tags that start with prefix (excluding prefix itself)"""
+    self.ensure_index()
+    matches = np.flatnonzero(
+      np.char.startswith(self.tags, prefix) & (self.tags != prefix)
+    )
+    top = matches[np.argsort(-self.freqs[matches], kind='stable')[:limit]]
+    return self.tags[top].tolist()
+
+  def correct(self, token: str):
+    """Returns the most similar known tag to token, or None"""
+    self.ensure_index()
+    if token in self.counts or not self.counts:
+      return None
+    token_trigrams = trigrams(token)
+    query_ids = [self.trigram_ids[t] for t in token_trigrams if t in self.trigram_ids]
+    if not query_ids:
+      return None
+
+    is_match = np.isin(self.entry_trigrams, query_ids)
+    overlap = np.bincount(self.entry_rows[is_match], minlength=len(self.tags))
+    scores = 2 * overlap / (self.trigram_counts + len(token_trigrams))
+    # prefer more used tags when scores are close
+    scores = scores + 1e-3 * np.log1p(self.freqs)
+    best = int(np.argmax(scores))
+    if scores[best] < MIN_CORRECTION_SCORE:
+      return None
+    return str(self.tags[best])
+
+  def correct_query(self, q: ParsedQuery):
+    """Returns a copy of q with misspelled tags replaced, or None if nothing changed"""
+    tags = q.get('tags')
+    corrected = [self.correct(tag) or tag for tag in tags]
+    if corrected == tags:
+      return None
+    new_q = copy.deepcopy(q)
+    new_q.replace('tags', corrected)
+    return new_q
+
+
+# vocabularies expire so that frequencies which drifted get corrected
+vocabularies = TTLCache(1024, ttl=60 * 30)
+
+
+async def get_vocabulary(owner: int):
+  vocab = vocabularies.get(owner)
+  if vocab is None:
+    vocab = TagVocabulary(await db.get_tag_frequencies(owner))
+    vocabularies[owner] = vocab
+  return vocab
+
+
+# vocabularies that are being loaded for get_cached_vocabulary, by owner
+loading: dict[int, asyncio.Task] = {}
+
+
+def get_cached_vocabulary(owner: int):
+  """
+  Returns the vocabulary of owner if it's cached, otherwise starts loading it
+  in the background and returns None, for inline queries which can't wait for it
+  """
+  vocab = vocabularies.get(owner)
+  if vocab is None and owner not in loading:
+    with priority(Priority.background):
+      task = asyncio.create_task(get_vocabulary(owner))
+    loading[owner] = task
+    task.add_done_callback(lambda task: finish_loading(owner, task))
+  return vocab
+
+
+def finish_loading(owner: int, task: asyncio.Task):
+  loading.pop(owner, None)
+  if task.cancelled():
+    return
+  e = task.exception()
+  if e and not isinstance(e, Overloaded):
+    logger.error('Unhandled exception while loading a vocabulary', exc_info=e)
+
+
+@db.on_write
+def update_vocabulary(write: db.MediaWrite):
+  # partial updates don't change tags, except for retag_media
+  if write.index != INDEX.main or (write.changes is not None and 'tags' not in write.changes):
+    return
+  if write.id is None:
+    # unknown documents were changed, rebuild on next use
+    vocabularies.pop(write.owner, None)
+    return
+  vocab = vocabularies.get(write.owner)
+  if vocab is None:
+    return
+  if write.is_delete and write.id not in vocab.doc_tags:
+    # the tags of the deleted document are unknown, rebuild on next use
+    vocabularies.pop(write.owner, None)
+    return
+  vocab.apply_write(write)